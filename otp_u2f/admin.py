@@ -1,10 +1,170 @@
-from django.contrib import admin
+from base64 import urlsafe_b64decode
+import binascii
 
-from .models import U2fDevice
+from django import forms
+from django.apps import apps
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.auth import get_user_model
+from django.contrib.sites.shortcuts import get_current_site
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _, ngettext
+
+from .cache import get_credential_cache, get_throttle_store
+from .db import estimate_count, update_returning
+from .metadata import get_metadata
+from .models import U2fDevice, hash_credential
+
+
+class EstimatedCountPaginator(Paginator):
+    '''
+    Use the planner estimate for the number of unfiltered rows when it
+    exceeds OTP_U2F_ADMIN_ESTIMATED_COUNT.
+    '''
+    @cached_property
+    def count(self):
+        threshold = getattr(settings, 'OTP_U2F_ADMIN_ESTIMATED_COUNT', None)
+        if threshold is not None:
+            estimate = estimate_count(self.object_list)
+            if estimate is not None and estimate > threshold:
+                return estimate
+        return super().count
+
+
+class VersionListFilter(admin.SimpleListFilter):
+    # The versions are known, avoid a SELECT DISTINCT over all devices.
+    title = _('version')
+    parameter_name = 'version'
+
+    def lookups(self, request, model_admin):
+        return [('webauthn', 'WebAuthn'), ('U2F_V2', 'U2F')]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(version=self.value())
+        return queryset
+
+
+class RpIdListFilter(admin.SimpleListFilter):
+    # The rp ids are the configured or site domains, avoid a SELECT DISTINCT
+    # over all devices.
+    title = _('rp id')
+    parameter_name = 'rp_id'
+
+    def lookups(self, request, model_admin):
+        rp_id = getattr(settings, 'OTP_U2F_RP_ID', None)
+        if rp_id is not None:
+            rp_ids = [rp_id]
+        elif apps.is_installed('django.contrib.sites'):
+            from django.contrib.sites.models import Site
+            rp_ids = Site.objects.order_by('domain').values_list(
+                'domain', flat=True)
+        else:
+            rp_ids = [get_current_site(request).domain]
+        return [(rp_id, rp_id) for rp_id in rp_ids]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            # Legacy U2F devices are stored with the app id.
+            app_id = getattr(
+                settings, 'OTP_U2F_APP_ID', None) or f'https://{self.value()}'
+            return queryset.filter(rp_id__in=[self.value(), app_id])
+        return queryset
+
+
+def get_credential_hash(value):
+    '''
+    Return the hash of a base64 encoded credential id or None.
+    '''
+    from fido2.utils import websafe_decode
+    try:
+        credential_id = websafe_decode(value.rstrip('='))
+    except (TypeError, ValueError):
+        return None
+    return hash_credential(credential_id) if credential_id else None
+
+
+def update_devices(queryset, **values):
+    '''
+    Update the devices in a single statement and invalidate the cached
+    credentials of their users.
+    '''
+    rows = update_returning(queryset, values, ['user'])
+    if rows is None:
+        user_pks = set()
+        if get_credential_cache() is not None:
+            user_pks = set(queryset.values_list('user', flat=True))
+        count = queryset.update(**values)
+    else:
+        user_pks = {user_pk for user_pk, in rows}
+        count = len(rows)
+    for user_pk in user_pks:
+        U2fDevice.invalidate_credentials(user_pk)
+    return count
+
+
+def decode_base64(value):
+    value = value.strip().rstrip('=')
+    return urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+class U2fDeviceAdminForm(forms.ModelForm):
+    '''
+    Edit the binary credential id and public key as base64.
+    '''
+    credential = forms.CharField(
+        help_text=_('Base64 encoded credential id.'))
+    public_key = forms.CharField(
+        help_text=_('Base64 encoded public key.'))
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk is not None:
+            self.fields['credential'].initial = self.instance.credential
+            self.fields['public_key'].initial = self.instance.public_key
+
+    def clean_credential(self):
+        try:
+            credential_id = decode_base64(self.cleaned_data['credential'])
+        except (binascii.Error, ValueError):
+            raise forms.ValidationError(_('Enter a base64 encoded value.'))
+        if not credential_id:
+            raise forms.ValidationError(_('The credential id is empty.'))
+        # The unique constraint is not validated for fields of the form.
+        if U2fDevice.objects.filter(
+                credential_hash=hash_credential(credential_id)).exclude(
+                    pk=self.instance.pk).exists():
+            raise forms.ValidationError(
+                _('A device with this credential id already exists.'))
+        return credential_id
+
+    def clean_public_key(self):
+        try:
+            return decode_base64(self.cleaned_data['public_key'])
+        except (binascii.Error, ValueError):
+            raise forms.ValidationError(_('Enter a base64 encoded value.'))
+
+    def save(self, commit=True):
+        self.instance.credential_id = self.cleaned_data['credential']
+        self.instance.public_key_data = self.cleaned_data['public_key']
+        return super().save(commit)
+
+    class Meta:
+        model = U2fDevice
+        fields = '__all__'
 
 
 class U2fDeviceAdmin(admin.ModelAdmin):
-    list_display = ['user', 'name', 'confirmed']
+    form = U2fDeviceAdminForm
+    list_display = [
+        'user', 'name', 'version', 'authenticator', 'rp_id', 'confirmed']
+    list_select_related = ['user']
+    list_filter = [VersionListFilter, 'confirmed', RpIdListFilter]
+    search_help_text = _('Username or base64 encoded credential id')
+    paginator = EstimatedCountPaginator
+    actions = ['disable_devices', 'enable_devices', 'reset_throttling']
 
     fieldsets = [
         ('Identity', {
@@ -12,13 +172,76 @@ class U2fDeviceAdmin(admin.ModelAdmin):
         }),
         ('Configuration', {
             'fields': [
-                'rp_id', 'version', 'credential', 'aaguid', 'public_key'],
+                'rp_id', 'version', 'credential', 'aaguid', 'authenticator',
+                'public_key'],
         }),
         ('State', {
             'fields': ['counter'],
         }),
     ]
     raw_id_fields = ['user']
+    readonly_fields = ['authenticator']
+
+    @property
+    def show_full_result_count(self):
+        # The total is counted again for filtered results.
+        return getattr(
+            settings, 'OTP_U2F_ADMIN_ESTIMATED_COUNT', None) is None
+
+    @admin.display(description=_('authenticator'))
+    def authenticator(self, obj):
+        # The model name from the metadata blob, see OTP_U2F_METADATA.
+        metadata = get_metadata()
+        if metadata is not None:
+            authenticator = metadata.get(obj.aaguid)
+            if authenticator is not None:
+                return authenticator.description
+        return '-'
+
+    def get_search_fields(self, request):
+        # The username field of custom user models, like email.
+        return [f'user__{get_user_model().USERNAME_FIELD}']
+
+    def get_search_results(self, request, queryset, search_term):
+        '''
+        Search by exact username and credential id so the lookups use the
+        unique indexes instead of scanning with the default contains lookups.
+        '''
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        query = Q(**{self.get_search_fields(request)[0]: search_term})
+        credential_hash = get_credential_hash(search_term)
+        if credential_hash is not None:
+            query |= Q(credential_hash=credential_hash)
+        return queryset.filter(query), False
+
+    @admin.action(description=_('Disable selected devices'))
+    def disable_devices(self, request, queryset):
+        count = update_devices(queryset, confirmed=False)
+        self.message_user(request, ngettext(
+            'Disabled %d device.', 'Disabled %d devices.', count) % count,
+            messages.SUCCESS)
+
+    @admin.action(description=_('Enable selected devices'))
+    def enable_devices(self, request, queryset):
+        count = update_devices(queryset, confirmed=True)
+        self.message_user(request, ngettext(
+            'Enabled %d device.', 'Enabled %d devices.', count) % count,
+            messages.SUCCESS)
+
+    @admin.action(description=_('Reset throttling of selected devices'))
+    def reset_throttling(self, request, queryset):
+        throttle_store = get_throttle_store()
+        if throttle_store is not None:
+            throttle_store.reset(
+                *queryset.values_list('credential_hash', flat=True))
+        count = queryset.update(
+            throttling_failure_count=0, throttling_failure_timestamp=None)
+        self.message_user(request, ngettext(
+            'Reset throttling of %d device.',
+            'Reset throttling of %d devices.', count) % count,
+            messages.SUCCESS)
 
 
 admin.site.register(U2fDevice, U2fDeviceAdmin)
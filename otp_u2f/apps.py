@@ -1,20 +1,38 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
+import sys
+
 from django.apps import AppConfig, apps
 
 
+def clear_servers(**kwargs):
+    # The servers are only shared once the utils are imported.
+    utils = sys.modules.get('otp_u2f.utils')
+    if utils is not None:
+        utils.clear_servers(**kwargs)
+
+
 class OtpU2fConfig(AppConfig):
     name = 'otp_u2f'
     verbose_name = 'Django OTP U2F'
 
     def ready(self):
+        # Discard the relying party servers when a site changes.
+        if apps.is_installed('django.contrib.sites'):  # pragma: no cover
+            from django.contrib.sites.models import Site
+            from django.db.models.signals import post_delete, post_save
+            post_save.connect(
+                clear_servers, sender=Site, dispatch_uid='otp_u2f_site_save')
+            post_delete.connect(
+                clear_servers, sender=Site,
+                dispatch_uid='otp_u2f_site_delete')
+
         # Check if known devices are installed and register them as plugins.
         if apps.is_installed('kleides_mfa'):  # pragma: no branch
             from kleides_mfa.registry import registry
             from .models import U2fDevice
-            from .forms import U2fDeviceCreateForm, U2fVerifyForm
-            registry.register(
-                'U2F', U2fDevice, create_form_class=U2fDeviceCreateForm,
-                verify_form_class=U2fVerifyForm, show_create_button=False,
-                show_verify_button=False)
+            from .plugins import U2fPlugin
+            registry.register_plugin(U2fPlugin(
+                'U2F', U2fDevice, show_create_button=False,
+                show_verify_button=False))
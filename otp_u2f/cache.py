@@ -0,0 +1,410 @@
+import asyncio
+from datetime import datetime, timezone
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from asgiref.sync import sync_to_async
+
+CHALLENGE_PREFIX = 'otp_u2f:challenge:'
+CHALLENGE_TIMEOUT = 300
+CREDENTIAL_CACHE_PREFIX = 'otp_u2f:rp-credentials:'
+CREDENTIAL_CACHE_TIMEOUT = 300
+# How long a loader may hold the single-flight lock and how long others wait
+# for it to finish before they load the credentials themselves.
+CREDENTIAL_LOCK_TIMEOUT = 10
+CREDENTIAL_LOCK_WAIT = 1
+CREDENTIAL_LOCK_POLL = 0.05
+THROTTLE_PREFIX = 'otp_u2f:throttle:'
+THROTTLE_TIMEOUT = 86400
+THROTTLE_FLUSH_INTERVAL = 60
+COUNTER_PREFIX = 'otp_u2f:counter:'
+COUNTER_TIMEOUT = 86400
+COUNTER_FLUSH_INTERVAL = 60
+# How long the compare-and-set of a counter may hold its lock and how long
+# others wait for it.
+COUNTER_LOCK_TIMEOUT = 5
+COUNTER_LOCK_WAIT = 1
+COUNTER_LOCK_POLL = 0.01
+# Log of the credentials with a counter that is ahead of the database.
+DIRTY_PREFIX = 'otp_u2f:counter-dirty:'
+
+
+class CredentialCache:
+    '''
+    Cache the parsed credentials of a user in a shared Django cache as
+    (rp_id, credential) pairs.
+
+    Concurrent misses for the same user are collapsed into a single load, the
+    other callers wait for the result instead of querying the database.
+    '''
+    def __init__(self, alias, timeout=CREDENTIAL_CACHE_TIMEOUT):
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    def make_key(self, user_pk):
+        return f'{CREDENTIAL_CACHE_PREFIX}{user_pk}'
+
+    def get_credentials(self, user_pk, loader):
+        key = self.make_key(user_pk)
+        credentials = self.cache.get(key)
+        if credentials is not None:
+            return credentials
+
+        lock_key = f'{key}:lock'
+        if self.cache.add(lock_key, 1, CREDENTIAL_LOCK_TIMEOUT):
+            try:
+                credentials = loader()
+                self.cache.set(key, credentials, self.timeout)
+            finally:
+                self.cache.delete(lock_key)
+            return credentials
+
+        # Another worker is loading the credentials, wait for the result.
+        deadline = time.monotonic() + CREDENTIAL_LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(CREDENTIAL_LOCK_POLL)
+            credentials = self.cache.get(key)
+            if credentials is not None:
+                return credentials
+        return loader()
+
+    async def aget_credentials(self, user_pk, loader):
+        key = self.make_key(user_pk)
+        credentials = await self.cache.aget(key)
+        if credentials is not None:
+            return credentials
+
+        lock_key = f'{key}:lock'
+        if await self.cache.aadd(lock_key, 1, CREDENTIAL_LOCK_TIMEOUT):
+            try:
+                credentials = await loader()
+                await self.cache.aset(key, credentials, self.timeout)
+            finally:
+                await self.cache.adelete(lock_key)
+            return credentials
+
+        deadline = time.monotonic() + CREDENTIAL_LOCK_WAIT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(CREDENTIAL_LOCK_POLL)
+            credentials = await self.cache.aget(key)
+            if credentials is not None:
+                return credentials
+        return await loader()
+
+    def invalidate(self, user_pk):
+        key = self.make_key(user_pk)
+        self.cache.delete(key)
+        # A concurrent load may have cached the state before the transaction
+        # that changed the device was committed.
+        transaction.on_commit(lambda: self.cache.delete(key))
+
+
+def get_credential_cache():
+    '''
+    Return the configured credential cache or None when it is disabled.
+    '''
+    alias = getattr(settings, 'OTP_U2F_CREDENTIAL_CACHE', None)
+    if alias is None:
+        return None
+    return CredentialCache(alias, getattr(
+        settings, 'OTP_U2F_CREDENTIAL_CACHE_TIMEOUT',
+        CREDENTIAL_CACHE_TIMEOUT))
+
+
+class ChallengeStore:
+    '''
+    Store the state of issued challenges until they are used.
+
+    A challenge can be popped once. Redis backends use the atomic GETDEL
+    command, other backends claim the challenge with add() before reading it.
+    '''
+    def __init__(self, alias='default', prefix=CHALLENGE_PREFIX,
+                 timeout=CHALLENGE_TIMEOUT):
+        self.cache = caches[alias]
+        self.prefix = prefix
+        self.timeout = timeout
+
+    def make_key(self, challenge):
+        return f'{self.prefix}{challenge}'
+
+    def set(self, challenge, state):
+        self.cache.set(self.make_key(challenge), state, self.timeout)
+
+    async def aset(self, challenge, state):
+        await self.cache.aset(self.make_key(challenge), state, self.timeout)
+
+    def pop(self, challenge):
+        key = self.make_key(challenge)
+        getdel = get_getdel(self.cache)
+        if getdel is not None:
+            try:
+                return getdel(key)
+            except Exception:  # pragma: no cover
+                # Redis < 6.2 lacks GETDEL.
+                pass
+
+        if not self.cache.add(f'{key}:lock', 1, self.timeout):
+            return None
+        state = self.cache.get(key)
+        if state is not None:
+            self.cache.delete(key)
+        return state
+
+    async def apop(self, challenge):
+        key = self.make_key(challenge)
+        getdel = get_getdel(self.cache)
+        if getdel is not None:  # pragma: no cover
+            return await sync_to_async(self.pop)(challenge)
+
+        if not await self.cache.aadd(f'{key}:lock', 1, self.timeout):
+            return None
+        state = await self.cache.aget(key)
+        if state is not None:
+            await self.cache.adelete(key)
+        return state
+
+
+def get_getdel(cache):
+    '''
+    Return an atomic get and delete function for Redis cache backends.
+    '''
+    module = type(cache).__module__
+    if module == 'django.core.cache.backends.redis':  # pragma: no cover
+        def getdel(key):
+            key = cache.make_and_validate_key(key)
+            value = cache._cache.get_client(key, write=True).getdel(key)
+            if value is None:
+                return None
+            return cache._cache._serializer.loads(value)
+        return getdel
+    if module.startswith('django_redis.'):  # pragma: no cover
+        def getdel(key):
+            key = cache.client.make_key(key)
+            value = cache.client.get_client(write=True).getdel(key)
+            if value is None:
+                return None
+            return cache.client.decode(value)
+        return getdel
+    return None
+
+
+def get_challenge_store():
+    '''
+    Return the configured challenge store.
+    '''
+    return ChallengeStore(
+        getattr(settings, 'OTP_U2F_CHALLENGE_CACHE', 'default'),
+        getattr(settings, 'OTP_U2F_CHALLENGE_PREFIX', CHALLENGE_PREFIX),
+        getattr(settings, 'OTP_U2F_CHALLENGE_TIMEOUT', CHALLENGE_TIMEOUT))
+
+
+class ThrottleStore:
+    '''
+    Keep the failure count and timestamp of a credential in a shared Django
+    cache instead of the database.
+
+    The failures are written behind to the device at most once per flush
+    interval. The count is seeded from the device when the cache has no
+    entry so an evicted entry falls back to the last flushed state.
+    '''
+    def __init__(self, alias, timeout=THROTTLE_TIMEOUT,
+                 flush_interval=THROTTLE_FLUSH_INTERVAL):
+        self.cache = caches[alias]
+        self.timeout = timeout
+        self.flush_interval = flush_interval
+
+    def make_key(self, credential_hash):
+        return f'{THROTTLE_PREFIX}{credential_hash}'
+
+    def get(self, credential_hash):
+        '''
+        Return the (failure count, failure timestamp) of the credential or
+        None when the cache has no entry.
+        '''
+        key = self.make_key(credential_hash)
+        values = self.cache.get_many([f'{key}:count', f'{key}:timestamp'])
+        if len(values) != 2:
+            return None
+        return (
+            values[f'{key}:count'],
+            datetime.fromtimestamp(values[f'{key}:timestamp'], timezone.utc))
+
+    def increment(self, credential_hash, count, now):
+        '''
+        Add a failure to the count and return the new count, count is the
+        failure count of the device when the cache has no entry.
+        '''
+        key = self.make_key(credential_hash)
+        self.cache.add(f'{key}:count', count, self.timeout)
+        try:
+            count = self.cache.incr(f'{key}:count')
+        except ValueError:
+            # The entry was evicted after it was added.
+            count += 1
+            self.cache.set(f'{key}:count', count, self.timeout)
+        else:
+            self.cache.touch(f'{key}:count', self.timeout)
+        self.cache.set(f'{key}:timestamp', now.timestamp(), self.timeout)
+        return count
+
+    def claim_flush(self, credential_hash):
+        '''
+        Return True when the caller should write the failures to the
+        database, once per flush interval.
+        '''
+        return self.cache.add(
+            f'{self.make_key(credential_hash)}:flush', 1, self.flush_interval)
+
+    def reset(self, *credential_hashes):
+        self.cache.delete_many([
+            f'{self.make_key(credential_hash)}:{name}'
+            for credential_hash in credential_hashes
+            for name in ('count', 'timestamp')])
+
+
+def get_throttle_store():
+    '''
+    Return the configured throttle store or None when the failures are
+    stored in the database.
+    '''
+    alias = getattr(settings, 'OTP_U2F_THROTTLE_CACHE', None)
+    if alias is None:
+        return None
+    return ThrottleStore(
+        alias,
+        getattr(settings, 'OTP_U2F_THROTTLE_CACHE_TIMEOUT', THROTTLE_TIMEOUT),
+        getattr(
+            settings, 'OTP_U2F_THROTTLE_FLUSH_INTERVAL',
+            THROTTLE_FLUSH_INTERVAL))
+
+
+class CounterStore:
+    '''
+    Keep the highest signature counter of a credential in a shared Django
+    cache and write it to the database in batches.
+
+    The compare-and-set of a counter holds a short lock that is claimed
+    with add(). The highest counter is never lower than the counter of the
+    device, so an evicted entry falls back to the last flushed counter.
+
+    Counters that are not written to the database are appended to a log of
+    numbered entries, so a flush only reads the dirty credentials. A marker
+    per credential keeps it in the log once until it is flushed.
+    '''
+    def __init__(self, alias, timeout=COUNTER_TIMEOUT,
+                 flush_interval=COUNTER_FLUSH_INTERVAL):
+        self.cache = caches[alias]
+        self.timeout = timeout
+        self.flush_interval = flush_interval
+
+    def make_key(self, credential_hash):
+        return f'{COUNTER_PREFIX}{credential_hash}'
+
+    def update(self, credential_hash, counter, stored):
+        '''
+        Set the highest counter when counter exceeds it and return
+        (accepted, highest counter), stored is the counter of the device.
+        A counter of 0 is accepted while the highest counter is 0. Return
+        None when the lock could not be claimed.
+        '''
+        key = self.make_key(credential_hash)
+        lock_key = f'{key}:lock'
+        deadline = time.monotonic() + COUNTER_LOCK_WAIT
+        while not self.cache.add(lock_key, 1, COUNTER_LOCK_TIMEOUT):
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(COUNTER_LOCK_POLL)
+        try:
+            highest = max(self.cache.get(key, stored), stored)
+            if counter == highest == 0:
+                return (True, 0)
+            if counter <= highest:
+                return (False, highest)
+            self.cache.set(key, counter, self.timeout)
+            return (True, counter)
+        finally:
+            self.cache.delete(lock_key)
+
+    def get_many(self, credential_hashes):
+        '''
+        Return the highest counters of the credentials that are cached.
+        '''
+        keys = {
+            self.make_key(credential_hash): credential_hash
+            for credential_hash in credential_hashes}
+        return {
+            keys[key]: counter
+            for key, counter in self.cache.get_many(list(keys)).items()}
+
+    def claim_flush(self, credential_hash):
+        '''
+        Return True when the caller should write the counter to the
+        database, once per flush interval.
+        '''
+        return self.cache.add(
+            f'{self.make_key(credential_hash)}:flush', 1, self.flush_interval)
+
+    def mark_dirty(self, credential_hash):
+        '''
+        Record that the counter of the credential is ahead of the database.
+        '''
+        if not self.cache.add(
+                f'{self.make_key(credential_hash)}:dirty', 1, self.timeout):
+            return
+        self.cache.add(f'{DIRTY_PREFIX}last', 0, None)
+        number = self.cache.incr(f'{DIRTY_PREFIX}last')
+        self.cache.set(
+            f'{DIRTY_PREFIX}{number}', credential_hash, self.timeout)
+
+    def pop_dirty(self, batch_size):
+        '''
+        Yield lists of at most batch_size dirty credential hashes and remove
+        them from the log when the next list is requested.
+
+        The log is read up to the first missing entry, which may still be
+        written by mark_dirty. An entry that is still missing in the next
+        flush was evicted and is skipped.
+        '''
+        position = self.cache.get(f'{DIRTY_PREFIX}flushed', 0)
+        last = self.cache.get(f'{DIRTY_PREFIX}last', 0)
+        missing = self.cache.get(f'{DIRTY_PREFIX}missing')
+        while position < last:
+            numbers = range(position + 1, min(position + batch_size, last) + 1)
+            keys = [f'{DIRTY_PREFIX}{number}' for number in numbers]
+            entries = self.cache.get_many(keys)
+            credential_hashes = []
+            for number, key in zip(numbers, keys):
+                if key not in entries and number != missing:
+                    self.cache.set(f'{DIRTY_PREFIX}missing', number, None)
+                    last = number - 1
+                    break
+                if key in entries:
+                    credential_hashes.append(entries[key])
+                position = number
+            # Updates after the markers are removed are logged again.
+            self.cache.delete_many([
+                f'{self.make_key(credential_hash)}:dirty'
+                for credential_hash in credential_hashes])
+            if credential_hashes:
+                yield credential_hashes
+            self.cache.delete_many(keys[:position - numbers[0] + 1])
+            self.cache.set(f'{DIRTY_PREFIX}flushed', position, None)
+
+
+def get_counter_store():
+    '''
+    Return the configured counter store or None when the counters are
+    updated in the database.
+    '''
+    alias = getattr(settings, 'OTP_U2F_COUNTER_CACHE', None)
+    if alias is None:
+        return None
+    return CounterStore(
+        alias,
+        getattr(settings, 'OTP_U2F_COUNTER_CACHE_TIMEOUT', COUNTER_TIMEOUT),
+        getattr(
+            settings, 'OTP_U2F_COUNTER_FLUSH_INTERVAL',
+            COUNTER_FLUSH_INTERVAL))
@@ -0,0 +1,143 @@
+'''
+Run data migrations of large tables in chunks of primary key ranges.
+
+Each chunk is committed in its own transaction, unless the migration runs in
+a transaction, so rows are only locked for the duration of a chunk. The last
+migrated primary key of each database is stored in a shared cache to resume
+an interrupted run.
+'''
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Max
+
+log = logging.getLogger(__name__)
+
+DATA_MIGRATION_DEFAULTS = {
+    'BATCH_SIZE': 1000,
+    'SLEEP': 0,
+    'CACHE': 'default',
+    'DEFER': False,
+}
+CHECKPOINT_PREFIX = 'otp_u2f:datamigration:'
+
+
+def get_options():
+    return {
+        **DATA_MIGRATION_DEFAULTS,
+        **getattr(settings, 'OTP_U2F_DATA_MIGRATION', {})}
+
+
+def get_checkpoint_cache():
+    '''
+    Return the cache of the checkpoints or None when the cache is not shared
+    between processes and an interrupted run can not be resumed.
+    '''
+    cache = caches[get_options()['CACHE']]
+    if isinstance(cache, (DummyCache, LocMemCache)):
+        return None
+    return cache
+
+
+def make_checkpoint_key(name, using):
+    return f'{CHECKPOINT_PREFIX}{using}:{name}'
+
+
+def get_checkpoint(name, using=DEFAULT_DB_ALIAS):
+    '''
+    Return the last migrated primary key of an interrupted run on the
+    database or None.
+    '''
+    cache = get_checkpoint_cache()
+    if cache is None:
+        return None
+    return cache.get(make_checkpoint_key(name, using))
+
+
+def set_checkpoint(name, pk, using=DEFAULT_DB_ALIAS):
+    cache = get_checkpoint_cache()
+    if cache is not None:
+        cache.set(make_checkpoint_key(name, using), pk, None)
+
+
+def clear_checkpoint(name, using=DEFAULT_DB_ALIAS):
+    cache = get_checkpoint_cache()
+    if cache is not None:
+        cache.delete(make_checkpoint_key(name, using))
+
+
+def resume(name, queryset, pending=None):
+    '''
+    Return the checkpoint of an interrupted run or None. The checkpoint is
+    discarded when pending returns rows up to it that are not migrated,
+    for example after a backup of the database was restored.
+    '''
+    start = get_checkpoint(name, queryset.db)
+    if start is None:
+        return None
+    migrated = queryset.filter(pk__lte=start)
+    if pending is not None and pending(migrated).exists():
+        log.warning(
+            'Discarded the checkpoint of data migration %s, the rows up to '
+            'pk %s are not migrated', name, start)
+        clear_checkpoint(name, queryset.db)
+        return None
+    log.info('Resuming data migration %s after pk %s', name, start)
+    return start
+
+
+def chunks(queryset, batch_size, start=None):
+    '''
+    Yield the queryset and last primary key of consecutive primary key
+    ranges of at most batch_size rows after start.
+    '''
+    while True:
+        remaining = queryset if start is None else queryset.filter(
+            pk__gt=start)
+        # The bound is found with an index scan of batch_size keys.
+        end = list(remaining.order_by('pk').values_list(
+            'pk', flat=True)[batch_size - 1:batch_size])
+        if not end:
+            break
+        yield remaining.filter(pk__lte=end[0]), end[0]
+        start = end[0]
+    # The last chunk contains less than batch_size rows.
+    end = remaining.aggregate(end=Max('pk'))['end']
+    if end is not None:
+        yield remaining.filter(pk__lte=end), end
+
+
+def run(name, queryset, function, batch_size=None, sleep=None, start=None,
+        progress=None, pending=None):
+    '''
+    Call function with the queryset of each chunk of queryset and sleep
+    between the chunks. The run resumes after the checkpoint of an
+    interrupted run of the same name on the same database unless start is
+    given, see resume. progress is called with the last primary key of each
+    migrated chunk.
+    '''
+    options = get_options()
+    batch_size = batch_size or options['BATCH_SIZE']
+    sleep = options['SLEEP'] if sleep is None else sleep
+    if start is None:
+        start = resume(name, queryset, pending)
+
+    # A checkpoint is only valid once the chunk is committed.
+    checkpoint = not connections[queryset.db].in_atomic_block
+    for index, (chunk, end) in enumerate(
+            chunks(queryset, batch_size, start)):
+        if index and sleep:
+            time.sleep(sleep)
+        with transaction.atomic(using=queryset.db):
+            function(chunk)
+        if checkpoint:
+            set_checkpoint(name, end, queryset.db)
+        log.debug('Data migration %s migrated up to pk %s', name, end)
+        if progress is not None:
+            progress(end)
+    clear_checkpoint(name, queryset.db)
@@ -0,0 +1,116 @@
+import random
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, router, transaction
+from django.db.models.sql import UpdateQuery
+
+READ_REPLICA_DEFAULTS = {
+    'DATABASES': [],
+    'PIN_TIMEOUT': 10,
+    'CACHE': 'default',
+}
+READ_PIN_PREFIX = 'otp_u2f:pin:'
+
+
+def supports_update_returning(connection):
+    '''
+    Return True if the database supports UPDATE ... RETURNING.
+    '''
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 35)
+    return False
+
+
+def update_returning(queryset, values, returning):
+    '''
+    Update the rows of the queryset in a single statement and return the new
+    values of the returning fields for each row.
+
+    Returns None when the database does not support UPDATE ... RETURNING, the
+    caller must perform the update itself.
+    '''
+    queryset = queryset.all()
+    queryset._for_write = True
+    connection = connections[queryset.db]
+    if not supports_update_returning(connection):
+        return None
+
+    query = queryset.query.chain(UpdateQuery)
+    query.add_update_values(values)
+    sql, params = query.get_compiler(queryset.db).as_sql()
+    opts = queryset.model._meta
+    columns = ', '.join(
+        connection.ops.quote_name(opts.get_field(name).column)
+        for name in returning)
+    with transaction.mark_for_rollback_on_error(using=queryset.db):
+        with connection.cursor() as cursor:
+            cursor.execute(f'{sql} RETURNING {columns}', params)
+            return cursor.fetchall()
+
+
+def estimate_count(queryset):
+    '''
+    Return the planner estimate of the number of rows of an unfiltered
+    queryset on PostgreSQL.
+
+    Returns None when the queryset is filtered, the database is not
+    PostgreSQL or the table has not been analyzed.
+    '''
+    connection = connections[queryset.db]
+    if queryset.query.where or connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+            [connection.ops.quote_name(queryset.model._meta.db_table)])
+        row = cursor.fetchone()
+    if row is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+def get_read_replica_options():
+    return {
+        **READ_REPLICA_DEFAULTS,
+        **getattr(settings, 'OTP_U2F_READ_REPLICAS', {}),
+    }
+
+
+def get_read_database(model, user_pk):
+    '''
+    Return the database alias for reads of the devices of a user.
+
+    Returns a random replica of OTP_U2F_READ_REPLICAS, the primary when the
+    user is pinned to it after a write or None for the default routing when
+    no replicas are configured.
+    '''
+    options = get_read_replica_options()
+    if not options['DATABASES']:
+        return None
+    if user_pk is not None and caches[options['CACHE']].get(
+            f'{READ_PIN_PREFIX}{user_pk}'):
+        return router.db_for_write(model)
+    return random.choice(options['DATABASES'])
+
+
+def pin_primary(user_pk):
+    '''
+    Read the devices of a user from the primary for PIN_TIMEOUT seconds so
+    the replica lag does not hide a write.
+    '''
+    options = get_read_replica_options()
+    if options['DATABASES'] and options['PIN_TIMEOUT']:
+        caches[options['CACHE']].set(
+            f'{READ_PIN_PREFIX}{user_pk}', 1, options['PIN_TIMEOUT'])
+
+
+def use_primary(instance):
+    '''
+    Bind an instance that was read from a replica to the primary so it is
+    saved to and refreshed from the primary.
+    '''
+    instance._state.db = router.db_for_write(type(instance))
+    return instance
@@ -0,0 +1,176 @@
+'''
+Bounded executor for the signature verification of assertions and
+attestations.
+
+The verification functions only depend on fido2 so they can run in a process
+pool without a configured Django environment.
+'''
+import asyncio
+from concurrent.futures import (
+    ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError)
+import functools
+import logging
+import threading
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+EXECUTOR_DEFAULTS = {
+    'BACKEND': 'thread',
+    'MAX_WORKERS': 4,
+    'MAX_QUEUE': 16,
+    'TIMEOUT': 10,
+}
+
+
+class VerificationBusy(Exception):
+    pass
+
+
+class VerificationExecutor:
+    '''
+    Run verifications in a thread or process pool with at most MAX_WORKERS
+    running and MAX_QUEUE waiting verifications. Additional verifications
+    are rejected with VerificationBusy.
+    '''
+    def __init__(self, backend='thread', max_workers=4, max_queue=16,
+                 timeout=10):
+        if backend == 'process':
+            self.executor = ProcessPoolExecutor(max_workers)
+        elif backend == 'thread':
+            self.executor = ThreadPoolExecutor(
+                max_workers, thread_name_prefix='otp_u2f_verify')
+        else:
+            raise ValueError(f'Unknown executor backend {backend!r}')
+        self.backend = backend
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._completed = 0
+        self._rejected = 0
+
+    @property
+    def uses_processes(self):
+        return self.backend == 'process'
+
+    def submit(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                self._rejected += 1
+                log.warning(
+                    'Verification executor saturated, %d pending',
+                    self._pending)
+                raise VerificationBusy('Too many pending verifications')
+            self._pending += 1
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+            self._completed += future is not None
+
+    def run(self, fn, *args):
+        try:
+            return self.submit(fn, *args).result(self.timeout)
+        except TimeoutError:
+            raise VerificationBusy('Verification timed out')
+
+    async def arun(self, fn, *args):
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(self.submit(fn, *args)), self.timeout)
+        except asyncio.TimeoutError:
+            raise VerificationBusy('Verification timed out')
+
+    def stats(self):
+        '''
+        Return the current utilization of the executor.
+        '''
+        with self._lock:
+            return {
+                'backend': self.backend,
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'pending': self._pending,
+                'running': min(self._pending, self.max_workers),
+                'queued': max(self._pending - self.max_workers, 0),
+                'completed': self._completed,
+                'rejected': self._rejected,
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+_executor = None
+_executor_config = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    '''
+    Return the configured verification executor or None when verification
+    runs on the calling thread.
+    '''
+    global _executor, _executor_config
+
+    config = getattr(settings, 'OTP_U2F_VERIFICATION_EXECUTOR', None)
+    with _executor_lock:
+        if config != _executor_config:
+            if _executor is not None:
+                _executor.shutdown()
+            _executor = None
+            _executor_config = config
+            if config is not None:
+                options = {**EXECUTOR_DEFAULTS, **config}
+                _executor = VerificationExecutor(
+                    options['BACKEND'], options['MAX_WORKERS'],
+                    options['MAX_QUEUE'], options['TIMEOUT'])
+        return _executor
+
+
+@functools.lru_cache(maxsize=32)
+def build_server(rp_id, rp_name, app_id):
+    from fido2.server import U2FFido2Server
+    from fido2.webauthn import PublicKeyCredentialRpEntity
+    return U2FFido2Server(
+        app_id, rp=PublicKeyCredentialRpEntity(id=rp_id, name=rp_name),
+        attestation='direct')
+
+
+def verify_assertion(server, state, credentials, credential_id,
+                     client_data, auth_data, signature):
+    '''
+    Verify an assertion, server is a server instance or the
+    (rp_id, rp_name, app_id) key of the server when run in another process.
+    '''
+    from fido2.webauthn import AuthenticatorData, CollectedClientData
+    if isinstance(server, tuple):
+        server = build_server(*server)
+    auth_data = AuthenticatorData(auth_data)
+    credential = server.authenticate_complete(
+        state, credentials=credentials, credential_id=credential_id,
+        client_data=CollectedClientData(client_data), auth_data=auth_data,
+        signature=signature)
+    return (credential, auth_data)
+
+
+def verify_attestation(server, state, client_data, attestation_object):
+    '''
+    Verify an attestation, see verify_assertion.
+    '''
+    from fido2.webauthn import AttestationObject, CollectedClientData
+    if isinstance(server, tuple):
+        server = build_server(*server)
+    return server.register_complete(
+        state, client_data=CollectedClientData(client_data),
+        attestation_object=AttestationObject(attestation_object))
@@ -1,28 +1,65 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
-from base64 import urlsafe_b64encode
 from uuid import UUID
 
 from django import forms
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 
 from kleides_mfa.forms import BaseVerifyForm, DeviceCreateForm
 
-from .models import DeviceClonedError, U2fDevice
-from .utils import Webauthn
+from . import metrics, tokens, tracing
+from .executor import VerificationBusy
+from .models import DeviceClonedError, U2fDevice, hash_credential
+from .tokens import stateless_challenges
+from .utils import Webauthn, to_json
 
 U2F_AUTHENTICATION_KEY = 'kleides-mfa-u2f-authentication-key'
 U2F_REGISTRATION_KEY = 'kleides-mfa-u2f-registration-key'
+U2F_PASSKEY_KEY = 'kleides-mfa-u2f-passkey-key'
+
+
+def save_state(request, state, purpose, user):
+    '''
+    Store the challenge state in the session or return it as a stateless
+    token.
+    '''
+    if stateless_challenges():
+        return tokens.dumps(state, purpose, user)
+    request.session[purpose] = state
+    return None
+
+
+def load_state(token, purpose, user):
+    '''
+    Return the challenge state from a stateless token or None if the token
+    is missing or invalid.
+    '''
+    if not token:
+        return None
+    try:
+        return tokens.loads(token, purpose, user)
+    except tokens.InvalidToken:
+        return None
 
 
 class U2fDeviceCreateForm(DeviceCreateForm):
     otp_token = forms.CharField(label=_('U2F'), widget=forms.HiddenInput())
+    otp_state = forms.CharField(required=False, widget=forms.HiddenInput())
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._webauthn = Webauthn(self.request)
-        self._state = self.request.session.pop(U2F_REGISTRATION_KEY, None)
+        if stateless_challenges():
+            # The state is provided by the client in otp_state.
+            self._state = None
+        else:
+            with tracing.span(tracing.CHALLENGE_GET):
+                self._state = self.request.session.pop(
+                    U2F_REGISTRATION_KEY, None)
 
     def clean(self):
         super().clean()
@@ -32,30 +69,48 @@ class U2fDeviceCreateForm(DeviceCreateForm):
             authenticator_data = self._webauthn.register_complete(
                 self._state, data)
         except Exception as e:
+            metrics.increment(metrics.REGISTRATIONS, result='failure')
             raise forms.ValidationError(
                 _('Device registration failure (reason: {})').format(e))
         finally:
-            if U2F_REGISTRATION_KEY in self.request.session:  # noqa: E501; pragma: no cover
-                del self.request.session[U2F_REGISTRATION_KEY]
+            if not stateless_challenges():
+                self.request.session.pop(U2F_REGISTRATION_KEY, None)
 
+        from fido2 import cbor
         credential_data = authenticator_data.credential_data
+        credential_hash = hash_credential(credential_data.credential_id)
+        with tracing.span(tracing.DEVICE):
+            exists = U2fDevice.objects.filter(
+                credential_hash=credential_hash).exists()
+        if exists:
+            metrics.increment(metrics.REGISTRATIONS, result='duplicate')
+            raise forms.ValidationError(
+                _('The device is already registered'))
+        metrics.increment(metrics.REGISTRATIONS, result='success')
+
         self.instance.rp_id = self._webauthn.rp_id
         self.instance.version = 'webauthn'
         self.instance.aaguid = UUID(bytes=credential_data.aaguid)
-        self.instance.credential = urlsafe_b64encode(
-            credential_data.credential_id).decode()
-        self.instance.public_key = self._webauthn.encode(
+        self.instance.credential_id = credential_data.credential_id
+        self.instance.public_key_data = cbor.encode(
             credential_data.public_key)
         self.instance.counter = authenticator_data.counter
 
     def clean_input(self):
+        if stateless_challenges():
+            with tracing.span(tracing.CHALLENGE_GET):
+                self._state = load_state(
+                    self.cleaned_data.get('otp_state'), U2F_REGISTRATION_KEY,
+                    self.request.user)
         if self._state is None:
+            metrics.increment(metrics.CHALLENGE_MISSES, purpose='register')
             raise forms.ValidationError(
                 _('The registration request has expired, try again'))
 
         try:
-            return self._webauthn.decode(
-                self.cleaned_data['otp_token'] + '===')
+            with tracing.span(tracing.DECODE):
+                return self._webauthn.decode(
+                    self.cleaned_data['otp_token'] + '===')
         except (KeyError, TypeError, ValueError):
             raise forms.ValidationError(
                 _('The registration request is invalid'))
@@ -67,11 +122,39 @@ class U2fDeviceCreateForm(DeviceCreateForm):
 
 class U2fVerifyForm(BaseVerifyForm):
     otp_token = forms.CharField(label=_('U2F'), widget=forms.HiddenInput())
+    otp_state = forms.CharField(required=False, widget=forms.HiddenInput())
+
+    state_key = U2F_AUTHENTICATION_KEY
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._webauthn = Webauthn(self.request)
-        self._state = self.request.session.pop(U2F_AUTHENTICATION_KEY, None)
+        if stateless_challenges():
+            # The state is provided by the client in otp_state.
+            self._state = None
+        else:
+            with tracing.span(tracing.CHALLENGE_GET):
+                self._state = self.request.session.pop(self.state_key, None)
+
+    @cached_property
+    def inline_challenge(self):
+        '''
+        Return the authentication challenge to embed in the page so the
+        browser does not have to request it. The options are included as
+        base64 encoded CBOR and as WebAuthn JSON.
+        '''
+        if self.is_bound or not getattr(
+                settings, 'OTP_U2F_INLINE_CHALLENGE', False):
+            return None
+
+        options, state = self.begin()
+        token = save_state(
+            self.request, state, self.state_key, self.unverified_user)
+        return {
+            'options': self._webauthn.encode(options).rstrip('='),
+            'json': to_json(options),
+            'state': token or '',
+        }
 
     def clean(self):
         super().clean()
@@ -80,39 +163,112 @@ class U2fVerifyForm(BaseVerifyForm):
         self.device = self.clean_device(data)
 
         try:
-            credential, authenticator = self._webauthn.authenticate_complete(
-                self._state, data, self.unverified_user)
+            credential, authenticator = self.complete(data)
+        except VerificationBusy:
+            metrics.increment(metrics.VERIFICATIONS, result='busy')
+            raise forms.ValidationError(
+                _('The server is busy, try again'))
         except ValueError as e:
+            metrics.increment(metrics.VERIFICATIONS, result='failure')
             self.device.increment_failure_counter()
             raise forms.ValidationError(
                 _('Device authentication failure (reason: {})').format(e))
 
         try:
             self.device.update_usage_counter(authenticator.counter)
+        except VerificationBusy:
+            metrics.increment(metrics.VERIFICATIONS, result='busy')
+            raise forms.ValidationError(
+                _('The server is busy, try again'))
         except DeviceClonedError as e:
+            metrics.increment(metrics.VERIFICATIONS, result='cloned')
             raise forms.ValidationError(
                 _('Device authentication failure (reason: {})').format(e))
+        metrics.increment(metrics.VERIFICATIONS, result='success')
+
+    def begin(self):
+        return self._webauthn.authenticate_begin(self.unverified_user)
+
+    def complete(self, data):
+        return self._webauthn.authenticate_complete(
+            self._state, data, self.unverified_user)
 
     def clean_input(self):
+        if stateless_challenges():
+            with tracing.span(tracing.CHALLENGE_GET):
+                self._state = load_state(
+                    self.cleaned_data.get('otp_state'), self.state_key,
+                    self.unverified_user)
         if self._state is None:
+            metrics.increment(
+                metrics.CHALLENGE_MISSES, purpose='authenticate')
             raise forms.ValidationError(
                 _('The authentication request has expired, try again'))
 
         try:
-            return self._webauthn.decode(
-                self.cleaned_data['otp_token'] + '===')
+            with tracing.span(tracing.DECODE):
+                return self._webauthn.decode(
+                    self.cleaned_data['otp_token'] + '===')
         except (KeyError, TypeError, ValueError):
             raise forms.ValidationError(
                 _('The authentication request is invalid'))
 
+    def get_device_for(self, data):
+        return U2fDevice.get_device(
+            self.unverified_user, data['credentialId'],
+            self._webauthn.rp_ids)
+
     def clean_device(self, data):
         try:
-            device = U2fDevice.get_device(
-                self.unverified_user, data['credentialId'])
+            with tracing.span(tracing.THROTTLE):
+                allowed = U2fDevice.verify_credential_is_allowed(
+                    data['credentialId'])[0]
+        except KeyError:
+            raise forms.ValidationError(_('The device is not available'))
+        if not allowed:
+            metrics.increment(metrics.THROTTLED)
+            raise forms.ValidationError(_('The device is not available'))
+
+        try:
+            with tracing.span(tracing.DEVICE):
+                device = self.get_device_for(data)
         except (KeyError, U2fDevice.DoesNotExist):
             raise forms.ValidationError(_('The device is not available'))
 
-        if not device.verify_is_allowed()[0]:
+        with tracing.span(tracing.THROTTLE):
+            allowed = device.verify_is_allowed()[0]
+        if not allowed:
+            metrics.increment(metrics.THROTTLED)
             raise forms.ValidationError(_('The device is not available'))
 
         return device
+
+
+class U2fPasskeyForm(U2fVerifyForm):
+    '''
+    Log in with a discoverable credential without a username or password.
+    The device and its user are resolved from the credential id and user
+    handle of the assertion.
+    '''
+    state_key = U2F_PASSKEY_KEY
+
+    def __init__(self, request, *args, **kwargs):
+        # The user is unknown until the assertion is verified, challenge
+        # tokens are bound to the anonymous user.
+        super().__init__(None, None, request, AnonymousUser(), *args, **kwargs)
+
+    def begin(self):
+        return self._webauthn.passkey_begin()
+
+    def complete(self, data):
+        return self._webauthn.passkey_complete(self._state, data, self.device)
+
+    def get_device_for(self, data):
+        return U2fDevice.get_discoverable_device(
+            data['credentialId'], data.get('userHandle'),
+            self._webauthn.rp_ids)
+
+    def get_user(self):
+        if self.is_valid():
+            return self.device.user
+        return None
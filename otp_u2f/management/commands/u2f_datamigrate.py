@@ -0,0 +1,85 @@
+'''
+Run deferred data migrations in chunks.
+'''
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.migrations.loader import MigrationLoader
+
+from ... import datamigrations
+from ...operations import RunPythonChunked
+
+
+def get_data_migrations(connection):
+    '''
+    Return the deferrable data migrations of the applied migrations by name.
+    '''
+    loader = MigrationLoader(connection)
+    data_migrations = {}
+    for key in sorted(loader.applied_migrations):
+        migration = loader.disk_migrations.get(key)
+        for operation in getattr(migration, 'operations', ()):
+            if (isinstance(operation, RunPythonChunked)
+                    and operation.deferrable):
+                data_migrations[operation.name] = (key[0], operation)
+    return data_migrations
+
+
+class Command(BaseCommand):
+    help = (
+        'Run deferred data migrations in chunks of primary key ranges. Each '
+        'chunk is committed separately and an interrupted run resumes after '
+        'the last committed chunk. Without names the deferrable data '
+        'migrations are listed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'names', nargs='*', help='Names of the data migrations to run.')
+        parser.add_argument(
+            '--batch-size', type=int,
+            help='Number of rows per chunk.')
+        parser.add_argument(
+            '--sleep', type=float,
+            help='Number of seconds to sleep between chunks.')
+        parser.add_argument(
+            '--start', type=int,
+            help='Only migrate rows after this primary key instead of '
+                 'resuming after the checkpoint.')
+        parser.add_argument(
+            '--database', default=DEFAULT_DB_ALIAS,
+            help='Database to migrate.')
+
+    def handle(self, *args, **options):
+        data_migrations = get_data_migrations(connections[options['database']])
+        if not options['names']:
+            for name in data_migrations:
+                checkpoint = datamigrations.get_checkpoint(
+                    name, options['database'])
+                state = '' if checkpoint is None else (
+                    f' (interrupted after pk {checkpoint})')
+                self.stdout.write(f'{name}{state}')
+            return
+
+        unknown = set(options['names']) - set(data_migrations)
+        if unknown:
+            raise CommandError(
+                f'Unknown data migrations: {", ".join(sorted(unknown))}')
+        for name in options['names']:
+            app_label, operation = data_migrations[name]
+            self.migrate(name, app_label, operation, options)
+
+    def migrate(self, name, app_label, operation, options):
+        model = apps.get_model(app_label, operation.model_name)
+        queryset = model._default_manager.using(options['database'])
+        last_pk = queryset.order_by('-pk').values_list('pk', flat=True).first()
+
+        def progress(pk):
+            if options['verbosity'] > 0:
+                self.stdout.write(
+                    f'{name}: migrated up to pk {pk} of {last_pk}')
+
+        datamigrations.run(
+            name, queryset, operation.function, options['batch_size'],
+            options['sleep'], options['start'], progress, operation.pending)
+        if options['verbosity'] > 0:
+            self.stdout.write(self.style.SUCCESS(f'{name}: done'))
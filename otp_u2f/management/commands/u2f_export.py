@@ -0,0 +1,75 @@
+'''
+Export the devices as JSON lines.
+'''
+import json
+
+from django.core.management.base import BaseCommand
+
+from ...models import U2fDevice
+
+BATCH_SIZE = 1000
+
+
+def export_device(device):
+    '''
+    Return the device as a JSON serializable dict, the user is stored by its
+    natural key.
+    '''
+    return {
+        'user': list(device.user.natural_key()),
+        'name': device.name,
+        'confirmed': device.confirmed,
+        'rp_id': device.rp_id,
+        'version': device.version,
+        'aaguid': str(device.aaguid),
+        'credential': device.credential,
+        'public_key': device.public_key,
+        'counter': device.counter,
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        'Export the devices as JSON lines ordered by primary key. The devices '
+        'are read in batches so the memory use does not depend on the number '
+        'of devices.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output', default='-',
+            help='File to write to, - for stdout.')
+        parser.add_argument(
+            '--batch-size', type=int, default=BATCH_SIZE,
+            help='Number of devices to read per query.')
+        parser.add_argument(
+            '--after', type=int, default=0,
+            help='Only export devices with a greater primary key, to resume '
+                 'an interrupted export.')
+
+    def handle(self, *args, **options):
+        if options['output'] == '-':
+            self.export(self.stdout, options)
+        else:
+            with open(options['output'], 'w') as output:
+                self.export(output, options)
+
+    def export(self, output, options):
+        # Keyset pagination keeps every query cheap, unlike offsets.
+        queryset = U2fDevice.objects.select_related('user').order_by('pk')
+        last_pk = options['after']
+        count = 0
+        while True:
+            devices = list(
+                queryset.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not devices:
+                break
+            for device in devices:
+                output.write(json.dumps(export_device(device)) + '\n')
+            last_pk = devices[-1].pk
+            count += len(devices)
+            if options['verbosity'] > 1:
+                # Written to stderr to keep stdout usable for the export.
+                self.stderr.write(
+                    f'Exported {count} devices up to pk {last_pk}')
+        if options['verbosity'] > 0:
+            self.stderr.write(f'Exported {count} devices')
@@ -0,0 +1,33 @@
+'''
+Write the signature counters of the counter store to the database.
+'''
+from django.core.management.base import BaseCommand, CommandError
+
+from ...cache import get_counter_store
+from ...models import U2fDevice
+
+
+class Command(BaseCommand):
+    help = (
+        'Write the signature counters in OTP_U2F_COUNTER_CACHE that are ahead '
+        'of the database. Run it periodically to write the dirty counters '
+        'and with --all when the application starts to reconcile the '
+        'counters after a restart.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of devices per batch.')
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Read the counters of all devices instead of the dirty '
+                 'counters.')
+
+    def handle(self, *args, **options):
+        if get_counter_store() is None:
+            raise CommandError('OTP_U2F_COUNTER_CACHE is not configured')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        count = U2fDevice.flush_counters(
+            options['batch_size'], full=options['all'])
+        self.stdout.write(f'Updated {count} counters')
@@ -0,0 +1,208 @@
+'''
+Import devices exported with u2f_export.
+'''
+from itertools import islice
+import json
+import os
+import sys
+from uuid import UUID
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from fido2.utils import websafe_decode
+
+from ...models import U2fDevice, hash_credential
+
+BATCH_SIZE = 1000
+# The user is never changed, the counter is only raised and devices are only
+# disabled, see Command.update_devices.
+UPDATE_FIELDS = ['name', 'rp_id', 'version', 'aaguid', 'public_key_data']
+
+
+def import_device(row, user):
+    '''
+    Return an unsaved device for an exported row.
+    '''
+    credential_id = websafe_decode(row['credential'].rstrip('='))
+    return U2fDevice(
+        user=user,
+        name=row.get('name') or 'Imported device',
+        confirmed=row.get('confirmed', True),
+        rp_id=row['rp_id'],
+        version=row['version'],
+        aaguid=UUID(row['aaguid']),
+        credential_id=credential_id,
+        # bulk_create does not call save() which sets the hash.
+        credential_hash=hash_credential(credential_id),
+        public_key_data=websafe_decode(row['public_key'].rstrip('=')),
+        counter=int(row.get('counter', 0)),
+    )
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as checkpoint:
+            return int(checkpoint.read())
+    except FileNotFoundError:
+        return 0
+
+
+def write_checkpoint(path, line):
+    # Replace the checkpoint atomically so an interruption can not leave a
+    # truncated file behind.
+    with open(f'{path}.tmp', 'w') as checkpoint:
+        checkpoint.write(str(line))
+    os.replace(f'{path}.tmp', path)
+
+
+class Command(BaseCommand):
+    help = (
+        'Import devices from JSON lines written by u2f_export. The lines are '
+        'read and inserted in batches, each batch is committed in its own '
+        'transaction and recorded in the checkpoint file so an interrupted '
+        'import can be resumed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'input', help='File to read from, - for stdin.')
+        parser.add_argument(
+            '--batch-size', type=int, default=BATCH_SIZE,
+            help='Number of devices to insert per transaction.')
+        parser.add_argument(
+            '--checkpoint',
+            help='File that records the number of imported lines. An '
+                 'existing checkpoint skips the lines that were imported '
+                 'before, it is removed when the import completes.')
+        parser.add_argument(
+            '--update', action='store_true',
+            help='Update devices with a credential that already exists '
+                 'instead of skipping them. The counter is never lowered, '
+                 'disabled devices are not enabled and devices of another '
+                 'user are skipped.')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        if options['input'] == '-':
+            self.import_lines(sys.stdin, options)
+        else:
+            with open(options['input']) as lines:
+                self.import_lines(lines, options)
+        if options['checkpoint']:
+            try:
+                os.remove(options['checkpoint'])
+            except FileNotFoundError:
+                pass
+
+    def import_lines(self, lines, options):
+        checkpoint = options['checkpoint']
+        line = read_checkpoint(checkpoint) if checkpoint else 0
+        # Skip the lines of a previous run without keeping them in memory.
+        for _ in islice(lines, line):
+            pass
+
+        self.imported = self.missing = self.conflicts = 0
+        while True:
+            batch = list(islice(lines, options['batch_size']))
+            if not batch:
+                break
+            self.import_batch(batch, line, options)
+            line += len(batch)
+            if checkpoint:
+                write_checkpoint(checkpoint, line)
+            if options['verbosity'] > 1:
+                self.stdout.write(f'Imported {line} lines')
+
+        if options['verbosity'] > 0:
+            self.stdout.write(
+                f'Processed {self.imported} devices, skipped {self.missing} '
+                f'devices of unknown users and {self.conflicts} devices of '
+                f'other users')
+
+    def parse(self, batch, first_line):
+        rows = []
+        for number, text in enumerate(batch, first_line + 1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+                key = tuple(row['user'])
+                if len(key) != 1:
+                    raise ValueError('user is not a natural key')
+            except (KeyError, TypeError, ValueError) as e:
+                raise CommandError(f'Line {number} is invalid: {e}')
+            rows.append((number, key, row))
+        return rows
+
+    def get_users(self, keys):
+        # The natural key of the user model is the username.
+        User = get_user_model()
+        users = User._default_manager.filter(**{
+            f'{User.USERNAME_FIELD}__in': [key[0] for key in keys]})
+        return {user.natural_key(): user for user in users}
+
+    def import_batch(self, batch, first_line, options):
+        rows = self.parse(batch, first_line)
+        users = self.get_users({key for number, key, row in rows})
+        devices = []
+        for number, key, row in rows:
+            user = users.get(key)
+            if user is None:
+                self.missing += 1
+                if options['verbosity'] > 1:
+                    self.stderr.write(
+                        f'Line {number}: user {key!r} does not exist')
+                continue
+            try:
+                devices.append(import_device(row, user))
+            except (KeyError, TypeError, ValueError) as e:
+                raise CommandError(f'Line {number} is invalid: {e}')
+
+        if options['update']:
+            with transaction.atomic():
+                self.update_devices(devices, options)
+        else:
+            with transaction.atomic():
+                U2fDevice.objects.bulk_create(devices, ignore_conflicts=True)
+        # bulk_create does not send post_save.
+        for user_pk in {device.user_id for device in devices}:
+            U2fDevice.invalidate_credentials(user_pk)
+        self.imported += len(devices)
+
+    def update_devices(self, devices, options):
+        '''
+        Insert the devices or update the existing devices with the same
+        credential. Devices of another user are removed from devices and
+        reported. The counter of existing devices is only raised and
+        disabled devices are not enabled again.
+        '''
+        existing = dict(U2fDevice.objects.filter(credential_hash__in=[
+            device.credential_hash for device in devices]).values_list(
+                'credential_hash', 'user'))
+        for device in list(devices):
+            user_pk = existing.get(device.credential_hash, device.user_id)
+            if user_pk != device.user_id:
+                devices.remove(device)
+                self.conflicts += 1
+                if options['verbosity'] > 0:
+                    self.stderr.write(
+                        f'Device {device.credential} belongs to another user '
+                        f'than {device.user.get_username()!r}')
+
+        U2fDevice.objects.bulk_create(
+            devices, update_conflicts=True, unique_fields=['credential_hash'],
+            update_fields=UPDATE_FIELDS)
+        for device in devices:
+            if device.credential_hash not in existing:
+                continue
+            queryset = U2fDevice.objects.filter(
+                credential_hash=device.credential_hash)
+            # Lowering the counter would allow replaying older assertions.
+            queryset.filter(counter__lt=device.counter).update(
+                counter=device.counter)
+            # Devices disabled by clone detection or an administrator stay
+            # disabled.
+            if not device.confirmed:
+                queryset.update(confirmed=False)
@@ -0,0 +1,341 @@
+'''
+Simulate concurrent logins through the kleides-mfa and otp_u2f views with
+virtual authenticators.
+'''
+from base64 import urlsafe_b64decode
+from collections import Counter, defaultdict
+import functools
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import Resolver404, resolve, reverse
+from django.utils.crypto import get_random_string
+
+from fido2 import cbor
+from fido2.webauthn import AuthenticatorData
+
+from ...models import U2fDevice
+from ...testing import ALGORITHMS, Latencies, VirtualAuthenticator, encode
+from ...views import U2F_STATE_HEADER
+
+PHASES = ('login', 'authenticate', 'verify', 'register', 'create')
+CACHE_METHODS = (
+    'add', 'get', 'set', 'touch', 'delete', 'get_many', 'get_or_set',
+    'has_key', 'incr', 'decr', 'set_many', 'delete_many')
+
+
+class PhaseError(Exception):
+    pass
+
+
+class CacheCalls:
+    '''
+    Count the calls to the configured cache backends by the current thread.
+    Calls made by another cache method, like get_many calling get, are not
+    counted.
+    '''
+    def __init__(self):
+        self.local = threading.local()
+        self.patched = []
+
+    @property
+    def count(self):
+        return getattr(self.local, 'count', 0)
+
+    def reset(self):
+        self.local.count = 0
+
+    def wrap(self, method):
+        @functools.wraps(method)
+        def wrapper(cache, *args, **kwargs):
+            depth = getattr(self.local, 'depth', 0)
+            if not depth:
+                self.local.count = self.count + 1
+            self.local.depth = depth + 1
+            try:
+                return method(cache, *args, **kwargs)
+            finally:
+                self.local.depth = depth
+        return wrapper
+
+    def __enter__(self):
+        for cls in {type(caches[alias]) for alias in settings.CACHES}:
+            for name in CACHE_METHODS:
+                self.patched.append((cls, name, cls.__dict__.get(name)))
+                setattr(cls, name, self.wrap(getattr(cls, name)))
+        return self
+
+    def __exit__(self, *exc_info):
+        for cls, name, method in reversed(self.patched):
+            if method is None:
+                delattr(cls, name)
+            else:
+                setattr(cls, name, method)
+        self.patched.clear()
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(Latencies)
+        self.errors = defaultdict(Counter)
+        self.queries = Counter()
+        self.cache_calls = Counter()
+        self.logins = 0
+        # The highest counter that was accepted for each credential.
+        self.counters = {}
+
+    def add(self, phase, seconds, queries, cache_calls, error=None):
+        with self.lock:
+            self.latencies[phase].add(seconds)
+            self.queries[phase] += queries
+            self.cache_calls[phase] += cache_calls
+            if error is not None:
+                self.errors[phase][error] += 1
+
+    def add_error(self, phase, error):
+        with self.lock:
+            self.errors[phase][error] += 1
+
+    def add_login(self, credential_id, counter):
+        with self.lock:
+            self.logins += 1
+            self.counters[credential_id] = max(
+                counter, self.counters.get(credential_id, 0))
+
+
+class VirtualUser:
+    def __init__(self, command, user, authenticator):
+        self.command = command
+        self.pk = user.pk
+        self.username = user.get_username()
+        self.authenticator = authenticator
+        # Serializes signing and submitting the assertion of the threads
+        # that share the user, a counter that is submitted after a higher
+        # counter of the same credential is rejected as a clone.
+        self.lock = threading.Lock()
+
+    def request(self, client, phase, path, data=None, status=200):
+        cache_calls = self.command.cache_calls
+        cache_calls.reset()
+        error = None
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            try:
+                response = client.post(
+                    path, data or {}, secure=True,
+                    HTTP_HOST=self.command.host)
+            except Exception as e:
+                response = None
+                error = f'{type(e).__name__}: {e}'
+            elapsed = time.perf_counter() - start
+        if response is not None and response.status_code != status:
+            error = f'HTTP {response.status_code}'
+        self.command.stats.add(
+            phase, elapsed, len(queries), cache_calls.count, error)
+        if error is not None:
+            raise PhaseError(error)
+        return response
+
+    def challenge(self, client, phase, path):
+        response = self.request(client, phase, path)
+        options = cbor.decode(urlsafe_b64decode(response.content + b'==='))
+        return options, response.get(U2F_STATE_HEADER, '')
+
+    def login(self):
+        client = Client()
+        response = self.request(
+            client, 'login', reverse('kleides_mfa:login'),
+            {'username': self.username, 'password': self.command.password},
+            status=302)
+        verify_url = response['Location']
+        try:
+            match = resolve(urlsplit(verify_url).path)
+        except Resolver404:
+            match = None
+        if match is None or match.view_name != 'kleides_mfa:verify':
+            # The user has no confirmed devices left.
+            self.command.stats.add_error('login', 'No confirmed device')
+            return
+
+        options, state = self.challenge(
+            client, 'authenticate', reverse('otp_u2f:authenticate'))
+        with self.lock:
+            assertion = self.authenticator.authenticate(options)
+            self.request(
+                client, 'verify', verify_url,
+                {'otp_token': encode(assertion), 'otp_state': state},
+                status=302)
+        self.command.stats.add_login(
+            assertion['credentialId'],
+            AuthenticatorData(assertion['authenticatorData']).counter)
+
+        if self.command.register:
+            options, state = self.challenge(
+                client, 'register', reverse('otp_u2f:register'))
+            # Register another security key.
+            registration = VirtualAuthenticator(
+                self.authenticator.origin).register(
+                    options, self.command.algorithm)
+            self.request(
+                client, 'create', reverse('kleides_mfa:create', args=['u2f']),
+                {'name': 'Load test', 'otp_token': encode(registration),
+                 'otp_state': state}, status=302)
+
+    def run(self, deadline):
+        try:
+            while time.monotonic() < deadline:
+                try:
+                    self.login()
+                except PhaseError:
+                    pass
+        finally:
+            connections.close_all()
+
+
+class Command(BaseCommand):
+    help = (
+        'Simulate concurrent logins with virtual authenticators and report '
+        'the latency, errors, queries and cache calls of each phase. '
+        'The login phase includes hashing the password. '
+        'The users and devices are created in the configured database and '
+        'removed afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int, default=4,
+            help='Number of concurrent users.')
+        parser.add_argument(
+            '--duration', type=float, default=10,
+            help='Number of seconds to run.')
+        parser.add_argument(
+            '--devices', type=int, default=1,
+            help='Number of devices of each user.')
+        parser.add_argument(
+            '--algorithm', choices=ALGORITHMS, default='ES256',
+            help='Algorithm of the device credentials.')
+        parser.add_argument(
+            '--shared-device', action='store_true',
+            help='Log in all concurrent users with the same user and device '
+                 'to verify the counter updates. The assertions are signed '
+                 'and submitted one at a time.')
+        parser.add_argument(
+            '--register', action='store_true',
+            help='Register a new device after each login.')
+        parser.add_argument(
+            '--host', default='testserver',
+            help='Host name of the requests.')
+        parser.add_argument(
+            '--keep', action='store_true',
+            help='Keep the users and devices.')
+
+    def handle(self, *args, **options):
+        if options['users'] < 1 or options['devices'] < 1:
+            raise CommandError('--users and --devices must be at least 1')
+        if options['register'] and options['algorithm'] == 'U2F_V2':
+            raise CommandError('U2F_V2 devices can not be registered')
+        self.host = options['host']
+        self.algorithm = options['algorithm']
+        self.register = options['register']
+        self.password = get_random_string(16)
+        self.stats = Stats()
+
+        allowed_hosts = [*settings.ALLOWED_HOSTS, self.host]
+        with override_settings(ALLOWED_HOSTS=allowed_hosts):
+            users = self.create_users(options)
+            try:
+                with CacheCalls() as self.cache_calls:
+                    elapsed = self.run(users, options)
+                self.report(users, elapsed, options)
+            finally:
+                if not options['keep']:
+                    get_user_model()._default_manager.filter(
+                        pk__in=[user.pk for user in users]).delete()
+
+    def create_users(self, options):
+        User = get_user_model()
+        rp_id = getattr(settings, 'OTP_U2F_RP_ID', None) or self.host
+        origin = f'https://{self.host}'
+        prefix = f'u2f-loadtest-{get_random_string(8).lower()}'
+        password = make_password(self.password)
+
+        users = []
+        count = 1 if options['shared_device'] else options['users']
+        for i in range(count):
+            user = User._default_manager.create(
+                **{User.USERNAME_FIELD: f'{prefix}-{i}'}, password=password)
+            authenticator = VirtualAuthenticator(origin)
+            for j in range(options['devices']):
+                credential = authenticator.create_credential(self.algorithm)
+                U2fDevice.objects.create(
+                    user=user, name=f'Load test {j}',
+                    **credential.device_kwargs(rp_id))
+            users.append(VirtualUser(self, user, authenticator))
+        return users
+
+    def run(self, users, options):
+        start = time.monotonic()
+        deadline = start + options['duration']
+        threads = [
+            threading.Thread(
+                target=users[i % len(users)].run, args=(deadline,),
+                name=f'u2f_loadtest_{i}')
+            for i in range(options['users'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.monotonic() - start
+
+    def report(self, users, elapsed, options):
+        stats = self.stats
+        self.stdout.write(
+            f'{options["users"]} users, {elapsed:.1f} seconds, '
+            f'{stats.logins} logins ({stats.logins / elapsed:.1f}/s)')
+        self.stdout.write(
+            f'{"phase":<14} {"requests":>8} {"errors":>6} {"p50 ms":>8} '
+            f'{"p95 ms":>8} {"p99 ms":>8} {"queries":>7} {"cache":>7}')
+        for phase in PHASES:
+            latencies = stats.latencies.get(phase)
+            if not latencies:
+                continue
+            summary = latencies.summary()
+            count = summary['count']
+            self.stdout.write(
+                f'{phase:<14} {count:>8} '
+                f'{sum(stats.errors[phase].values()):>6} '
+                f'{summary["p50"]:>8.1f} {summary["p95"]:>8.1f} '
+                f'{summary["p99"]:>8.1f} '
+                f'{stats.queries[phase] / count:>7.1f} '
+                f'{stats.cache_calls[phase] / count:>7.1f}')
+        for phase in PHASES:
+            for error, count in stats.errors[phase].most_common():
+                self.stdout.write(f'{phase} error: {error} ({count}x)')
+        self.report_counters(users)
+
+    def report_counters(self, users):
+        # The stored counter must match the highest accepted counter, a lower
+        # value is a lost update.
+        U2fDevice.flush_counters()
+        devices = U2fDevice.objects.filter(
+            user__in=[user.pk for user in users]).order_by('pk')
+        for device in devices:
+            accepted = self.stats.counters.get(bytes(device.credential_id))
+            if accepted is None:
+                continue
+            if device.counter != accepted:
+                self.stdout.write(self.style.ERROR(
+                    f'Device {device.pk} counter is {device.counter}, '
+                    f'expected {accepted}'))
+            if not device.confirmed:
+                self.stdout.write(self.style.WARNING(
+                    f'Device {device.pk} was disabled by clone detection'))
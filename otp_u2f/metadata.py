@@ -0,0 +1,244 @@
+'''
+Index of a local FIDO Metadata Service (MDS3) blob by AAGUID.
+
+The blob is parsed when it is first used by a process and parsed again when
+the file changes. Only the description, the latest status and the
+attestation root certificates of each authenticator are kept.
+'''
+from base64 import b64decode
+import json
+import logging
+import os
+import threading
+from typing import NamedTuple
+from uuid import UUID
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+METADATA_DEFAULTS = {
+    'PATH': None,
+    'TRUST_ROOT': None,
+    'ALLOWED_AAGUIDS': None,
+    'DENIED_AAGUIDS': [],
+    'DENIED_STATUSES': [
+        'REVOKED', 'USER_VERIFICATION_BYPASS', 'ATTESTATION_KEY_COMPROMISE',
+        'USER_KEY_REMOTE_COMPROMISE', 'USER_KEY_PHYSICAL_COMPROMISE'],
+    'REQUIRE_METADATA': False,
+    'VERIFY_ATTESTATION': False,
+}
+
+
+class Authenticator(NamedTuple):
+    description: str
+    status: str
+    roots: tuple
+
+
+class MetadataIndex:
+    '''
+    The authenticators of a metadata blob by AAGUID.
+    '''
+    def __init__(self, authenticators, number=None):
+        self.authenticators = authenticators
+        self.number = number
+
+    def __len__(self):
+        return len(self.authenticators)
+
+    def get(self, aaguid):
+        return self.authenticators.get(aaguid)
+
+    @classmethod
+    def parse(cls, blob, trust_root=None):
+        '''
+        Parse a metadata blob, the signature is verified when the DER
+        encoded trust root of the blob is given.
+        '''
+        from fido2.utils import websafe_decode
+
+        message, signature = blob.strip().decode('ascii').rsplit('.', 1)
+        header, payload = (
+            json.loads(websafe_decode(part)) for part in message.split('.'))
+        if trust_root is not None:
+            verify_blob(
+                message.encode('ascii'), websafe_decode(signature), header,
+                trust_root)
+
+        authenticators = {}
+        for entry in payload.get('entries', ()):
+            if not entry.get('aaguid'):
+                # U2F and UAF authenticators are identified otherwise.
+                continue
+            statement = entry.get('metadataStatement') or {}
+            reports = entry.get('statusReports') or [{}]
+            authenticators[UUID(entry['aaguid'])] = Authenticator(
+                statement.get('description', ''),
+                reports[-1].get('status', ''),
+                tuple(
+                    b64decode(root) for root in statement.get(
+                        'attestationRootCertificates', ())))
+        return cls(authenticators, payload.get('no'))
+
+
+def verify_blob(message, signature, header, trust_root):
+    '''
+    Verify the certificate chain and signature of a metadata blob.
+    '''
+    from cryptography import x509
+    from fido2.attestation import verify_x509_chain
+    from fido2.cose import CoseKey
+
+    chain = [b64decode(cert) for cert in header.get('x5c', ())]
+    verify_x509_chain(chain + [trust_root])
+    leaf = x509.load_der_x509_certificate(chain[0])
+    CoseKey.for_name(header['alg']).from_cryptography_key(
+        leaf.public_key()).verify(message, signature)
+
+
+def read_certificate(path):
+    '''
+    Return the DER encoding of a DER or PEM encoded certificate file.
+    '''
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    if b'-----BEGIN' not in data:
+        return data
+    from cryptography import x509
+    from cryptography.hazmat.primitives.serialization import Encoding
+    return x509.load_pem_x509_certificate(data).public_bytes(Encoding.DER)
+
+
+def get_metadata_options():
+    return {
+        **METADATA_DEFAULTS, **getattr(settings, 'OTP_U2F_METADATA', {})}
+
+
+def load_metadata(path, trust_root=None):
+    '''
+    Return the MetadataIndex of the blob at path, the signature is verified
+    when the path of the trust root certificate is given.
+    '''
+    with open(path, 'rb') as fp:
+        blob = fp.read()
+    if trust_root is not None:
+        trust_root = read_certificate(trust_root)
+    return MetadataIndex.parse(blob, trust_root)
+
+
+_index = None
+_index_key = None
+_index_lock = threading.Lock()
+
+
+def get_metadata():
+    '''
+    Return the MetadataIndex of OTP_U2F_METADATA['PATH'] or None.
+
+    The file is parsed again when its modification time or size changes. The
+    previous index is kept when the changed file can not be read or parsed.
+    '''
+    options = get_metadata_options()
+    path, trust_root = options['PATH'], options['TRUST_ROOT']
+    if path is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError as e:
+        log.warning('Unable to read the metadata blob: %s', e)
+        if _index_key is not None and _index_key[:2] == (path, trust_root):
+            return _index
+        return None
+
+    key = (path, trust_root, stat.st_mtime_ns, stat.st_size)
+    if key != _index_key:
+        reload_metadata(key)
+    return _index
+
+
+def reload_metadata(key):
+    global _index, _index_key
+
+    with _index_lock:
+        if key == _index_key:
+            return
+        if _index_key is None or _index_key[:2] != key[:2]:
+            _index = None
+        try:
+            _index = load_metadata(*key[:2])
+            log.info(
+                'Loaded %d authenticators from the metadata blob',
+                len(_index))
+        except Exception:
+            log.exception('Unable to load the metadata blob')
+        # Failures are not retried until the file changes.
+        _index_key = key
+
+
+def check_authenticator(aaguid):
+    '''
+    Raise ValueError when the policy of OTP_U2F_METADATA does not allow the
+    authenticator with the UUID aaguid and return its metadata or None.
+    '''
+    options = get_metadata_options()
+    allowed = options['ALLOWED_AAGUIDS']
+    if allowed is not None and aaguid not in {UUID(str(a)) for a in allowed}:
+        raise ValueError('The authenticator is not allowed')
+    if aaguid in {UUID(str(a)) for a in options['DENIED_AAGUIDS']}:
+        raise ValueError('The authenticator is not allowed')
+
+    metadata = get_metadata()
+    authenticator = metadata.get(aaguid) if metadata is not None else None
+    if authenticator is None:
+        if options['REQUIRE_METADATA']:
+            raise ValueError('The authenticator is unknown')
+        return None
+    if authenticator.status in options['DENIED_STATUSES']:
+        raise ValueError(
+            f'The authenticator status is {authenticator.status}')
+    return authenticator
+
+
+def get_attestation_verifier(authenticator):
+    '''
+    Return a fido2 attestation verifier that trusts the attestation roots of
+    the authenticator metadata.
+    '''
+    from fido2.attestation import AttestationVerifier
+
+    class MetadataAttestationVerifier(AttestationVerifier):
+        def ca_lookup(self, attestation_result, auth_data):
+            from cryptography import x509
+            if not attestation_result.trust_path:
+                return None
+            issuer = x509.load_der_x509_certificate(
+                attestation_result.trust_path[-1]).issuer
+            for root in authenticator.roots:
+                if x509.load_der_x509_certificate(root).subject == issuer:
+                    return root
+            return None
+
+    return MetadataAttestationVerifier()
+
+
+def check_registration(auth_data, client_data, attestation_object):
+    '''
+    Raise ValueError when the policy of OTP_U2F_METADATA does not allow the
+    verified registration.
+    '''
+    authenticator = check_authenticator(
+        UUID(bytes=auth_data.credential_data.aaguid))
+    if not get_metadata_options()['VERIFY_ATTESTATION']:
+        return
+    if authenticator is None or not authenticator.roots:
+        raise ValueError('The authenticator attestation can not be verified')
+
+    from fido2.attestation import InvalidAttestation
+    from fido2.webauthn import AttestationObject, CollectedClientData
+    try:
+        get_attestation_verifier(authenticator).verify_attestation(
+            AttestationObject(attestation_object),
+            CollectedClientData(client_data).hash)
+    except InvalidAttestation as e:
+        raise ValueError(f'The authenticator attestation is invalid: {e}')
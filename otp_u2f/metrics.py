@@ -0,0 +1,188 @@
+'''
+Metrics of the authentication and registration ceremonies.
+
+The metrics are reported to the backend configured with
+OTP_U2F_METRICS_BACKEND, nothing is recorded when it is not set.
+'''
+import asyncio
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+import functools
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# Counters.
+CHALLENGES = 'otp_u2f_challenges_total'
+CHALLENGE_MISSES = 'otp_u2f_challenge_misses_total'
+VERIFICATIONS = 'otp_u2f_verifications_total'
+REGISTRATIONS = 'otp_u2f_registrations_total'
+CLONE_DETECTIONS = 'otp_u2f_clone_detections_total'
+THROTTLED = 'otp_u2f_throttled_total'
+# Histograms in seconds.
+CHALLENGE_SECONDS = 'otp_u2f_challenge_seconds'
+CREDENTIALS_SECONDS = 'otp_u2f_credentials_seconds'
+SIGNATURE_SECONDS = 'otp_u2f_signature_seconds'
+COUNTER_UPDATE_SECONDS = 'otp_u2f_counter_update_seconds'
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class MetricsBackend:
+    '''
+    Interface of the metrics backends, labels is a dict of strings.
+    '''
+    def increment(self, name, value=1, labels=None):
+        pass
+
+    def observe(self, name, value, labels=None):
+        pass
+
+
+class PrometheusBackend(MetricsBackend):
+    '''
+    Keep the metrics of the current process in memory and render them in the
+    Prometheus text format.
+    '''
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+
+    def key(self, name, labels):
+        return (name, tuple(sorted((labels or {}).items())))
+
+    def increment(self, name, value=1, labels=None):
+        with self.lock:
+            self.counters[self.key(name, labels)] += value
+
+    def observe(self, name, value, labels=None):
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    'buckets': [0] * len(self.buckets), 'sum': 0.0,
+                    'count': 0}
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, {**value, 'buckets': list(value['buckets'])})
+                for key, value in self.histograms.items())
+
+        lines = []
+        types = set()
+        for (name, labels), value in counters:
+            if name not in types:
+                types.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{format_labels(labels)} {value:g}')
+        for (name, labels), histogram in histograms:
+            if name not in types:
+                types.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bucket, count in zip(self.buckets, histogram['buckets']):
+                cumulative += count
+                le = format_labels(labels + (('le', f'{bucket:g}'),))
+                lines.append(f'{name}_bucket{le} {cumulative}')
+            le = format_labels(labels + (('le', '+Inf'),))
+            lines.append(f'{name}_bucket{le} {histogram["count"]}')
+            lines.append(
+                f'{name}_sum{format_labels(labels)} {histogram["sum"]:g}')
+            lines.append(
+                f'{name}_count{format_labels(labels)} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+         .replace('\n', '\\n'))
+        for name, value in labels)
+    return '{' + ','.join(
+        f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+_backend = None
+_backend_path = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    '''
+    Return the configured metrics backend or None.
+    '''
+    global _backend, _backend_path
+
+    path = getattr(settings, 'OTP_U2F_METRICS_BACKEND', None)
+    if path != _backend_path:
+        with _backend_lock:
+            if path != _backend_path:
+                _backend = import_string(path)() if path else None
+                _backend_path = path
+    return _backend
+
+
+def increment(name, value=1, **labels):
+    backend = get_backend()
+    if backend is not None:
+        backend.increment(name, value, labels)
+
+
+def observe(name, value, **labels):
+    backend = get_backend()
+    if backend is not None:
+        backend.observe(name, value, labels)
+
+
+@contextmanager
+def timer(name, **labels):
+    '''
+    Observe the duration of the block in seconds.
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name, count=None, **labels):
+    '''
+    Decorator to observe the duration of a function or coroutine function and
+    increment the count counter when it returns without an exception.
+    '''
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with timer(name, **labels):
+                    result = await func(*args, **kwargs)
+                if count is not None:
+                    increment(count, **labels)
+                return result
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with timer(name, **labels):
+                    result = func(*args, **kwargs)
+                if count is not None:
+                    increment(count, **labels)
+                return result
+        return wrapper
+    return decorator
@@ -0,0 +1,42 @@
+from django.utils.decorators import sync_and_async_middleware
+
+from asgiref.sync import iscoroutinefunction
+
+from . import tracing
+
+
+def add_server_timing(response, timings):
+    if not timings:
+        return
+    values = [
+        f'{name};dur={duration * 1000:.3f}' for name, duration in timings]
+    if response.has_header('Server-Timing'):
+        values.insert(0, response['Server-Timing'])
+    response['Server-Timing'] = ', '.join(values)
+
+
+@sync_and_async_middleware
+def ServerTimingMiddleware(get_response):
+    '''
+    Add the timings of the U2F phases of the request to the Server-Timing
+    header.
+    '''
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            token = tracing.start()
+            try:
+                response = await get_response(request)
+            finally:
+                timings = tracing.stop(token)
+            add_server_timing(response, timings)
+            return response
+    else:
+        def middleware(request):
+            token = tracing.start()
+            try:
+                response = get_response(request)
+            finally:
+                timings = tracing.stop(token)
+            add_server_timing(response, timings)
+            return response
+    return middleware
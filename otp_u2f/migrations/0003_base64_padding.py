@@ -0,0 +1,53 @@
+from django.db import migrations
+from django.db.models import F, Value
+from django.db.models.functions import Concat, Length, Mod
+
+from otp_u2f.operations import RunPythonChunked
+
+
+def add_base64_padding(queryset):
+    credential_qs = queryset.annotate(
+        padding=Value(4) - Mod(Length('credential'), Value(4))
+    )
+    credential_qs.filter(padding=1).update(
+        credential=Concat(F('credential'), Value('=')))
+    credential_qs.filter(padding=2).update(
+        credential=Concat(F('credential'), Value('==')))
+    credential_qs.filter(padding=3).update(
+        credential=Concat(F('credential'), Value('===')))
+
+    public_key_qs = queryset.annotate(
+        padding=Value(4) - Mod(Length('public_key'), Value(4))
+    )
+    public_key_qs.filter(padding=1).update(
+        public_key=Concat(F('public_key'), Value('=')))
+    public_key_qs.filter(padding=2).update(
+        public_key=Concat(F('public_key'), Value('==')))
+    public_key_qs.filter(padding=3).update(
+        public_key=Concat(F('public_key'), Value('===')))
+
+
+def padding_pending(queryset):
+    return queryset.annotate(
+        credential_padding=Mod(Length('credential'), Value(4)),
+        public_key_padding=Mod(Length('public_key'), Value(4)),
+    ).exclude(credential_padding=0, public_key_padding=0)
+
+
+class Migration(migrations.Migration):
+    # The padding is added in chunks that are committed separately. Devices
+    # that are padded by a previous release of 0002_webauthn are skipped.
+    atomic = False
+
+    dependencies = [
+        ('otp_u2f', '0002_webauthn'),
+    ]
+
+    operations = [
+        RunPythonChunked(
+            model_name='u2fdevice',
+            name='0003_add_base64_padding',
+            function=add_base64_padding,
+            pending=padding_pending,
+        ),
+    ]
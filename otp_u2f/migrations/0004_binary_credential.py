@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('otp_u2f', '0003_base64_padding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='u2fdevice',
+            name='credential_hash',
+            field=models.CharField(default='', editable=False, max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='u2fdevice',
+            name='credential_id',
+            field=models.BinaryField(default=b''),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='u2fdevice',
+            name='public_key_data',
+            field=models.BinaryField(default=b''),
+            preserve_default=False,
+        ),
+    ]
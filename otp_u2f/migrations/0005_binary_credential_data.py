@@ -0,0 +1,54 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import hashlib
+
+from django.db import migrations
+
+from otp_u2f.operations import RunPythonChunked
+
+
+def decode(data):
+    return urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def encode_binary_credentials(queryset):
+    for device in queryset.only('pk', 'credential', 'public_key'):
+        credential_id = decode(device.credential)
+        queryset.filter(pk=device.pk).update(
+            credential_id=credential_id,
+            credential_hash=hashlib.sha256(credential_id).hexdigest(),
+            public_key_data=decode(device.public_key))
+
+
+def decode_binary_credentials(queryset):
+    for device in queryset.only('pk', 'credential_id', 'public_key_data'):
+        queryset.filter(pk=device.pk).update(
+            credential=urlsafe_b64encode(device.credential_id).decode(),
+            public_key=urlsafe_b64encode(device.public_key_data).decode())
+
+
+def encoded_pending(queryset):
+    return queryset.filter(credential_hash='')
+
+
+def decoded_pending(queryset):
+    return queryset.filter(credential='')
+
+
+class Migration(migrations.Migration):
+    # The credentials are converted in chunks that are committed separately.
+    atomic = False
+
+    dependencies = [
+        ('otp_u2f', '0004_binary_credential'),
+    ]
+
+    operations = [
+        RunPythonChunked(
+            model_name='u2fdevice',
+            name='0005_encode_binary_credentials',
+            function=encode_binary_credentials,
+            reverse_function=decode_binary_credentials,
+            pending=encoded_pending,
+            reverse_pending=decoded_pending,
+        ),
+    ]
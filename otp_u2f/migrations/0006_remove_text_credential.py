@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('otp_u2f', '0005_binary_credential_data'),
+    ]
+
+    operations = [
+        # Provide a default to allow the columns to be restored on reversal.
+        migrations.AlterField(
+            model_name='u2fdevice',
+            name='credential',
+            field=models.TextField(default=''),
+        ),
+        migrations.AlterField(
+            model_name='u2fdevice',
+            name='public_key',
+            field=models.TextField(default=''),
+        ),
+        migrations.RemoveField(
+            model_name='u2fdevice',
+            name='credential',
+        ),
+        migrations.RemoveField(
+            model_name='u2fdevice',
+            name='public_key',
+        ),
+    ]
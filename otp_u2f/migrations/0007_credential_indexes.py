@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+from otp_u2f.operations import (
+    AddIndexConcurrently, AddUniqueConstraintConcurrently)
+
+
+class Migration(migrations.Migration):
+    # Indexes are created concurrently on PostgreSQL.
+    atomic = False
+
+    dependencies = [
+        ('otp_u2f', '0006_remove_text_credential'),
+    ]
+
+    operations = [
+        AddUniqueConstraintConcurrently(
+            model_name='u2fdevice',
+            constraint=models.UniqueConstraint(fields=('credential_hash',), name='otp_u2f_credential_hash_unique'),
+        ),
+        AddIndexConcurrently(
+            model_name='u2fdevice',
+            index=models.Index(fields=['user', 'confirmed'], name='otp_u2f_user_confirmed_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+from otp_u2f.operations import AddIndexConcurrently, RemoveIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # Indexes are created concurrently on PostgreSQL.
+    atomic = False
+
+    dependencies = [
+        ('otp_u2f', '0007_credential_indexes'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='u2fdevice',
+            index=models.Index(fields=['rp_id', 'user', 'confirmed'], name='otp_u2f_rp_user_confirmed_idx'),
+        ),
+        # The credentials are looked up by rp id, the user foreign key index
+        # covers the other lookups.
+        RemoveIndexConcurrently(
+            model_name='u2fdevice',
+            name='otp_u2f_user_confirmed_idx',
+        ),
+    ]
@@ -1,41 +1,115 @@
-from base64 import urlsafe_b64decode, urlsafe_b64encode
+from base64 import urlsafe_b64encode
+import hashlib
 import logging
 
 from django.conf import settings
-from django.core.cache import cache
 from django.core.exceptions import SuspiciousOperation
+from django.db import router, transaction
 from django.db.models import (
-    CharField, F, PositiveIntegerField, TextField, UUIDField)
+    BinaryField, Case, CharField, F, Index, PositiveIntegerField, Q,
+    UniqueConstraint, UUIDField, Value, When)
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
+from django.utils.crypto import constant_time_compare
 from django.utils.functional import cached_property
 
 from django_otp.models import Device, ThrottlingMixin
 
-from fido2 import cbor
-from fido2.webauthn import AttestedCredentialData
+from asgiref.sync import sync_to_async
+
+from . import metrics, tracing
+from .cache import (
+    CHALLENGE_TIMEOUT, get_challenge_store, get_counter_store,
+    get_credential_cache, get_throttle_store)
+from .db import get_read_database, pin_primary, update_returning, use_primary
+from .executor import VerificationBusy
 
 log = logging.getLogger(__name__)
 
 
-U2F_REQUEST_TIMEOUT = 300
+U2F_REQUEST_TIMEOUT = CHALLENGE_TIMEOUT
 
 
 class DeviceClonedError(SuspiciousOperation):
     pass
 
 
+def hash_credential(credential_id):
+    '''
+    Return the fixed width digest used to look up a credential id.
+    '''
+    return hashlib.sha256(credential_id).hexdigest()
+
+
+def select_credentials(credentials, rp_ids):
+    '''
+    Return the credentials of (rp_id, credential) pairs of one of rp_ids or
+    all credentials when rp_ids is None.
+    '''
+    return [
+        credential for rp_id, credential in credentials
+        if rp_ids is None or rp_id in rp_ids]
+
+
 class U2fDevice(ThrottlingMixin, Device):
     rp_id = CharField(max_length=100)
     version = CharField(max_length=16)
     aaguid = UUIDField()
-    credential = TextField()
-    public_key = TextField()
+    credential_id = BinaryField()
+    credential_hash = CharField(max_length=64, editable=False)
+    public_key_data = BinaryField()
     counter = PositiveIntegerField(default=0)
 
+    class Meta:
+        indexes = [
+            Index(
+                fields=['rp_id', 'user', 'confirmed'],
+                name='otp_u2f_rp_user_confirmed_idx'),
+        ]
+        constraints = [
+            UniqueConstraint(
+                fields=['credential_hash'],
+                name='otp_u2f_credential_hash_unique'),
+        ]
+
+    @property
+    def credential(self):
+        '''
+        The base64 encoded credential id.
+        '''
+        return urlsafe_b64encode(self.credential_id).decode()
+
+    @credential.setter
+    def credential(self, value):
+        from fido2.utils import websafe_decode
+        self.credential_id = websafe_decode(value)
+
+    @property
+    def public_key(self):
+        '''
+        The base64 encoded public key.
+        '''
+        return urlsafe_b64encode(self.public_key_data).decode()
+
+    @public_key.setter
+    def public_key(self, value):
+        from fido2.utils import websafe_decode
+        self.public_key_data = websafe_decode(value)
+
+    def save(self, *args, **kwargs):
+        self.credential_hash = hash_credential(self.credential_id)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'credential_id' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'credential_hash'}
+        super().save(*args, **kwargs)
+
     # django-otp api
     def generate_challenge(self):
-        request, state = self.webauthn.authenticate_begin(self.user)
-        cache.set(state['challenge'], state, U2F_REQUEST_TIMEOUT)
+        with tracing.span(tracing.CHALLENGE):
+            request, state = self.webauthn.authenticate_begin(self.user)
+        with tracing.span(tracing.CHALLENGE_SET):
+            get_challenge_store().set(state['challenge'], state)
         return request
 
     def verify_token(self, token):
@@ -48,17 +122,19 @@ class U2fDevice(ThrottlingMixin, Device):
         each specific device like django-otp recommends.
         '''
         try:
-            response = self.webauthn.decode(token)
+            with tracing.span(tracing.DECODE):
+                response = self.webauthn.decode(token)
         except (TypeError, ValueError):
             return False
 
         try:
-            state = cache.get(response['clientData']['challenge'])
+            with tracing.span(tracing.CHALLENGE_GET):
+                state = get_challenge_store().pop(
+                    response['clientData']['challenge'])
             if state is None:
+                metrics.increment(metrics.CHALLENGE_MISSES, purpose='token')
                 return False
-            cache.delete(response['clientData']['challenge'])
-            if self.credential != urlsafe_b64encode(
-                    response['credentialId']).decode():
+            if bytes(self.credential_id) != response['credentialId']:
                 # Using a different device.
                 return False
         except KeyError:
@@ -76,61 +152,371 @@ class U2fDevice(ThrottlingMixin, Device):
         try:
             credential, authenticator = self.webauthn.authenticate_complete(
                 state, response, self.user)
+        except VerificationBusy:
+            metrics.increment(metrics.VERIFICATIONS, result='busy')
+            return False
         except ValueError:
+            metrics.increment(metrics.VERIFICATIONS, result='failure')
             self.increment_failure_counter()
             return False
 
         try:
             self.update_usage_counter(authenticator.counter)
+        except VerificationBusy:
+            metrics.increment(metrics.VERIFICATIONS, result='busy')
+            return False
         except DeviceClonedError:
+            metrics.increment(metrics.VERIFICATIONS, result='cloned')
             return False
+        metrics.increment(metrics.VERIFICATIONS, result='success')
         return True
 
     def get_throttle_factor(self):
         return getattr(settings, 'OTP_U2F_THROTTLE_FACTOR', 1)
 
+    def verify_is_allowed(self):
+        throttle_store = get_throttle_store()
+        if throttle_store is not None:
+            state = throttle_store.get(self.credential_hash)
+            if state is not None:
+                (self.throttling_failure_count,
+                 self.throttling_failure_timestamp) = state
+        return super().verify_is_allowed()
+
+    @classmethod
+    def verify_credential_is_allowed(cls, credential):
+        '''
+        Check the throttle store before the device is loaded so throttled
+        attempts do not query the database.
+        '''
+        if get_throttle_store() is None:
+            return (True, None)
+        return cls(credential_hash=hash_credential(credential)) \
+            .verify_is_allowed()
+
+    @classmethod
+    def get_device_queryset(cls, user, rp_ids=None):
+        '''
+        Return the confirmed devices of a user, only the devices of one of
+        rp_ids when given.
+        '''
+        queryset = cls.objects.using(get_read_database(cls, user.pk)).filter(
+            user=user, confirmed=True)
+        if rp_ids is not None:
+            queryset = queryset.filter(rp_id__in=rp_ids)
+        return queryset
+
+    @classmethod
+    def get_credentials(cls, user, rp_ids=None):
+        '''
+        Return the credentials of the confirmed devices of a user, see
+        get_device_queryset. The credential cache holds the devices of all
+        relying parties.
+        '''
+        credential_cache = get_credential_cache()
+
+        def load():
+            with metrics.timer(
+                    metrics.CREDENTIALS_SECONDS, source='database'):
+                return [
+                    (key.rp_id, key.as_credential())
+                    for key in cls.get_device_queryset(
+                        user, None if credential_cache else rp_ids)]
+
+        if credential_cache is None:
+            return select_credentials(load(), rp_ids)
+        with metrics.timer(metrics.CREDENTIALS_SECONDS, source='cache'):
+            return select_credentials(
+                credential_cache.get_credentials(user.pk, load), rp_ids)
+
     @classmethod
-    def get_credentials(cls, user):
-        return [
-            key.as_credential()
-            for key in cls.objects.filter(user=user, confirmed=True)]
+    async def aget_credentials(cls, user, rp_ids=None):
+        credential_cache = get_credential_cache()
+
+        async def load():
+            with metrics.timer(
+                    metrics.CREDENTIALS_SECONDS, source='database'):
+                return [
+                    (key.rp_id, key.as_credential())
+                    async for key in cls.get_device_queryset(
+                        user, None if credential_cache else rp_ids)]
+
+        if credential_cache is None:
+            return select_credentials(await load(), rp_ids)
+        with metrics.timer(metrics.CREDENTIALS_SECONDS, source='cache'):
+            return select_credentials(
+                await credential_cache.aget_credentials(user.pk, load),
+                rp_ids)
+
+    @classmethod
+    def invalidate_credentials(cls, user_pk):
+        # Read the changed devices from the primary.
+        pin_primary(user_pk)
+        credential_cache = get_credential_cache()
+        if credential_cache is not None:
+            credential_cache.invalidate(user_pk)
+
+    @classmethod
+    def get_device(cls, user, credential, rp_ids=None):
+        return use_primary(cls.get_device_queryset(user, rp_ids).get(
+            credential_hash=hash_credential(credential)))
+
+    @classmethod
+    def get_discoverable_device(cls, credential, user_handle, rp_ids=None):
+        '''
+        Return the confirmed device of an active user for a discoverable
+        credential. The user handle is the str(user.pk) of the registration.
+        '''
+        lookups = {
+            'confirmed': True, 'credential_hash': hash_credential(credential)}
+        if rp_ids is not None:
+            lookups['rp_id__in'] = rp_ids
+        queryset = cls.objects.select_related('user')
+        using = get_read_database(cls, None)
+        try:
+            device = queryset.using(using).get(**lookups)
+        except cls.DoesNotExist:
+            if using is None:
+                raise
+            # The user is unknown so a recent registration is not pinned to
+            # the primary.
+            device = queryset.using(router.db_for_write(cls)).get(**lookups)
+        use_primary(device)
+        if not user_handle or not constant_time_compare(
+                user_handle, str(device.user_id).encode()) or (
+                not device.user.is_active):
+            raise cls.DoesNotExist('U2fDevice matching query does not exist.')
+        return device
 
     @classmethod
-    def get_device(cls, user, credential):
-        return cls.objects.get(
-            user=user, confirmed=True,
-            credential=urlsafe_b64encode(credential).decode())
+    async def aget_device(cls, user, credential, rp_ids=None):
+        return use_primary(await cls.get_device_queryset(user, rp_ids).aget(
+            credential_hash=hash_credential(credential)))
+
+    async def aincrement_failure_counter(self):
+        # UPDATE ... RETURNING requires a cursor which is only available
+        # synchronously.
+        await sync_to_async(self.increment_failure_counter)()
 
     def increment_failure_counter(self):
-        U2fDevice.objects.filter(pk=self.pk).update(
-            throttling_failure_timestamp=timezone.now(),
-            throttling_failure_count=F('throttling_failure_count') + 1
-        )
-        self.refresh_from_db()
+        now = timezone.now()
+        queryset = U2fDevice.objects.filter(pk=self.pk)
+        pin_primary(self.user_id)
+        throttle_store = get_throttle_store()
+        if throttle_store is not None:
+            self.throttling_failure_count = throttle_store.increment(
+                self.credential_hash, self.throttling_failure_count, now)
+            self.throttling_failure_timestamp = now
+            if throttle_store.claim_flush(self.credential_hash):
+                queryset.update(
+                    throttling_failure_count=self.throttling_failure_count,
+                    throttling_failure_timestamp=now)
+            return
+
+        values = {
+            'throttling_failure_timestamp': now,
+            'throttling_failure_count': F('throttling_failure_count') + 1,
+        }
+        rows = update_returning(
+            queryset, values, ['throttling_failure_count'])
+        if rows is None:
+            queryset.update(**values)
+            self.refresh_from_db(fields=['throttling_failure_count'])
+        elif not rows:
+            raise self.DoesNotExist('U2fDevice matching query does not exist.')
+        else:
+            self.throttling_failure_count = rows[0][0]
+        self.throttling_failure_timestamp = now
+
+    async def aupdate_usage_counter(self, counter):
+        await sync_to_async(self.update_usage_counter)(counter)
 
     def update_usage_counter(self, counter):
+        now = timezone.now()
         queryset = U2fDevice.objects.filter(pk=self.pk)
-        n = queryset.filter(counter__lt=counter).update(
-            throttling_failure_timestamp=None, throttling_failure_count=0,
-            counter=counter)
-        if n == 0:
-            queryset.update(
-                confirmed=False,
-                throttling_failure_timestamp=timezone.now(),
-                throttling_failure_count=F('throttling_failure_count') + 1,
-            )
-            self.refresh_from_db()
+        pin_primary(self.user_id)
+        with tracing.span(tracing.COUNTER), \
+                metrics.timer(metrics.COUNTER_UPDATE_SECONDS):
+            cloned = self._update_cached_usage_counter(queryset, counter, now)
+            if cloned is None:
+                cloned = self._update_stored_usage_counter(
+                    queryset, counter, now)
+
+        # The database holds the throttling state after the update.
+        throttle_store = get_throttle_store()
+        if throttle_store is not None:
+            throttle_store.reset(self.credential_hash)
+
+        if cloned:
+            metrics.increment(metrics.CLONE_DETECTIONS)
+            self.confirmed = False
+            self.throttling_failure_timestamp = now
+            self.invalidate_credentials(self.user_id)
             raise DeviceClonedError(
                 'Device appears to be cloned, expected counter > {} but got '
                 '{} instead. The device {} has been disabled.'.format(
                     self.counter, counter, self.persistent_id))
-        self.refresh_from_db()
+
+        self.throttling_failure_timestamp = None
+
+    def _update_cached_usage_counter(self, queryset, counter, now):
+        '''
+        Compare and set the counter in the counter store and return whether
+        the device is cloned or None when the counter store is disabled.
+        The database is only updated once per flush interval, to reset the
+        throttling or to disable a cloned device.
+        '''
+        counter_store = get_counter_store()
+        if counter_store is None:
+            return None
+        result = counter_store.update(
+            self.credential_hash, counter, self.counter)
+        if result is None:
+            raise VerificationBusy('The counter of the device is locked')
+        accepted, highest = result
+
+        # Never lower the counter in the database.
+        highest_counter = Case(
+            When(counter__lt=highest, then=Value(highest)),
+            default=F('counter'),
+            output_field=self._meta.get_field('counter'))
+        if not accepted:
+            queryset.update(
+                counter=highest_counter, confirmed=False,
+                throttling_failure_timestamp=now,
+                throttling_failure_count=F('throttling_failure_count') + 1)
+            self.refresh_from_db(fields=['throttling_failure_count'])
+            self.counter = highest
+            return True
+
+        if (counter_store.claim_flush(self.credential_hash)
+                or self.throttling_failure_count
+                or self.throttling_failure_timestamp is not None):
+            queryset.update(
+                counter=highest_counter, throttling_failure_timestamp=None,
+                throttling_failure_count=0)
+        else:
+            counter_store.mark_dirty(self.credential_hash)
+        self.counter = counter
+        self.throttling_failure_count = 0
+        return False
+
+    def _update_stored_usage_counter(self, queryset, counter, now):
+        '''
+        Accept the counter or disable the device in a single statement and
+        return whether the device is cloned.
+        '''
+        accepted = self._counter_accepted(counter)
+        values = {
+            'counter': Case(
+                When(accepted, then=Value(counter)), default=F('counter'),
+                output_field=self._meta.get_field('counter')),
+            'confirmed': Case(
+                When(accepted, then=F('confirmed')), default=Value(False),
+                output_field=self._meta.get_field('confirmed')),
+            'throttling_failure_timestamp': Case(
+                When(accepted, then=Value(None)), default=Value(now),
+                output_field=self._meta.get_field(
+                    'throttling_failure_timestamp')),
+            'throttling_failure_count': Case(
+                When(accepted, then=Value(0)),
+                default=F('throttling_failure_count') + 1,
+                output_field=self._meta.get_field(
+                    'throttling_failure_count')),
+        }
+        rows = update_returning(
+            queryset, values, ['counter', 'throttling_failure_count'])
+        if rows is None:
+            return not self._update_usage_counter(queryset, counter, now)
+        if not rows:
+            raise self.DoesNotExist('U2fDevice matching query does not exist.')
+        self.counter, self.throttling_failure_count = rows[0]
+        # The failure count is only reset when the counter is accepted.
+        return self.throttling_failure_count != 0
+
+    @staticmethod
+    def _counter_accepted(counter):
+        # Authenticators without a signature counter, like synced passkeys,
+        # always report 0. The clone check is skipped when both are 0.
+        return Q(counter__lt=counter) if counter else Q(counter=0)
+
+    def _update_usage_counter(self, queryset, counter, now):
+        '''
+        Fallback for databases without UPDATE ... RETURNING.
+        '''
+        n = queryset.filter(self._counter_accepted(counter)).update(
+            throttling_failure_timestamp=None, throttling_failure_count=0,
+            counter=counter)
+        if n == 1:
+            self.counter = counter
+            self.throttling_failure_count = 0
+            return True
+
+        queryset.update(
+            confirmed=False,
+            throttling_failure_timestamp=now,
+            throttling_failure_count=F('throttling_failure_count') + 1,
+        )
+        self.refresh_from_db(fields=['counter', 'throttling_failure_count'])
+        return False
+
+    @classmethod
+    def flush_counters(cls, batch_size=1000, full=False):
+        '''
+        Write the counters of the counter store that are ahead of the
+        database and return the number of updated devices. Only the dirty
+        counters are read unless full is set, which reads the counters of
+        all devices, for example to reconcile after a restart.
+        '''
+        counter_store = get_counter_store()
+        if counter_store is None:
+            return 0
+        if not full:
+            return sum(
+                cls._flush_counters(counter_store, cls.objects.filter(
+                    credential_hash__in=credential_hashes).values_list(
+                        'pk', 'credential_hash', 'counter'))
+                for credential_hashes in counter_store.pop_dirty(batch_size))
+
+        count = 0
+        queryset = cls.objects.order_by('pk').values_list(
+            'pk', 'credential_hash', 'counter')
+        batch = list(queryset[:batch_size])
+        while batch:
+            count += cls._flush_counters(counter_store, batch)
+            batch = list(queryset.filter(pk__gt=batch[-1][0])[:batch_size])
+        return count
+
+    @classmethod
+    def _flush_counters(cls, counter_store, rows):
+        count = 0
+        rows = list(rows)
+        counters = counter_store.get_many(
+            credential_hash for pk, credential_hash, stored in rows)
+        with transaction.atomic():
+            for pk, credential_hash, stored in rows:
+                highest = counters.get(credential_hash)
+                if highest is not None and highest > stored:
+                    count += cls.objects.filter(
+                        pk=pk, counter__lt=highest).update(counter=highest)
+        return count
 
     def as_credential(self):
-        credential = urlsafe_b64decode(self.credential)
-        public_key = urlsafe_b64decode(self.public_key)
+        # fido2 and the cryptography backends are imported when a credential
+        # is first used instead of in every process that loads the models.
+        from fido2 import cbor
+        from fido2.webauthn import AttestedCredentialData
+
+        credential = bytes(self.credential_id)
+        public_key = bytes(self.public_key_data)
         if self.version == 'U2F_V2':
             return AttestedCredentialData.from_ctap1(credential, public_key)
         else:
             return AttestedCredentialData.create(
                 self.aaguid.bytes, credential, cbor.decode(public_key))
+
+
+@receiver(post_save, sender=U2fDevice)
+@receiver(post_delete, sender=U2fDevice)
+def invalidate_device_credentials(sender, instance, **kwargs):
+    sender.invalidate_credentials(instance.user_id)
@@ -0,0 +1,219 @@
+'''
+Migration operations that avoid long table locks on PostgreSQL.
+
+PostgreSQL builds the indexes with CONCURRENTLY which requires the migration
+to be non-atomic. Other databases use the regular schema editor operations.
+'''
+from django.db import IntegrityError
+from django.db.migrations.operations import (
+    AddConstraint, AddIndex, RemoveIndex)
+from django.db.migrations.operations.base import Operation
+from django.db.models import Count
+
+from . import datamigrations
+
+
+def is_postgresql(schema_editor):
+    return schema_editor.connection.vendor == 'postgresql'
+
+
+def ensure_not_in_transaction(schema_editor):
+    if schema_editor.connection.in_atomic_block:
+        raise NotImplementedError(
+            'Concurrent index operations can not be executed inside a '
+            'transaction, set atomic = False on the migration.')
+
+
+def check_unique(queryset, fields, limit=10):
+    '''
+    Raise IntegrityError naming the duplicate values of fields in queryset.
+    '''
+    duplicates = list(
+        queryset.values_list(*fields).annotate(count=Count('pk'))
+        .filter(count__gt=1).order_by(*fields)[:limit + 1])
+    if not duplicates:
+        return
+    values = ', '.join(
+        '/'.join(str(value) for value in row[:-1])
+        for row in duplicates[:limit])
+    if len(duplicates) > limit:
+        values += ', ...'
+    raise IntegrityError(
+        f'Duplicate values of {", ".join(fields)} in '
+        f'{queryset.model._meta.db_table}: {values}')
+
+
+class AddIndexConcurrently(AddIndex):
+    '''
+    Create an index with CREATE INDEX CONCURRENTLY on PostgreSQL. An invalid
+    index left by an interrupted build is dropped first.
+    '''
+    atomic = False
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return  # pragma: no cover
+        if is_postgresql(schema_editor):
+            ensure_not_in_transaction(schema_editor)
+            schema_editor.execute(
+                'DROP INDEX CONCURRENTLY IF EXISTS {}'.format(
+                    schema_editor.quote_name(self.index.name)))
+            schema_editor.add_index(model, self.index, concurrently=True)
+        else:
+            schema_editor.add_index(model, self.index)
+
+    def describe(self):
+        return 'Concurrently create index {} on {}'.format(
+            self.index.name, self.model_name)
+
+
+class RemoveIndexConcurrently(RemoveIndex):
+    '''
+    Drop an index with DROP INDEX CONCURRENTLY on PostgreSQL.
+    '''
+    atomic = False
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return  # pragma: no cover
+        index = from_state.models[app_label, self.model_name_lower] \
+            .get_index_by_name(self.name)
+        if is_postgresql(schema_editor):
+            ensure_not_in_transaction(schema_editor)
+            schema_editor.remove_index(model, index, concurrently=True)
+        else:
+            schema_editor.remove_index(model, index)
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return  # pragma: no cover
+        index = to_state.models[app_label, self.model_name_lower] \
+            .get_index_by_name(self.name)
+        if is_postgresql(schema_editor):
+            ensure_not_in_transaction(schema_editor)
+            schema_editor.add_index(model, index, concurrently=True)
+        else:
+            schema_editor.add_index(model, index)
+
+    def describe(self):
+        return 'Concurrently remove index {} from {}'.format(
+            self.name, self.model_name)
+
+
+class AddUniqueConstraintConcurrently(AddConstraint):
+    '''
+    Create a unique constraint on PostgreSQL by building the unique index
+    concurrently and attaching it to the table as a constraint afterwards.
+
+    The existing rows are checked for duplicates first, so the error names
+    them. An invalid index left by an interrupted build is dropped before the
+    index is built again.
+    '''
+    atomic = False
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return  # pragma: no cover
+        check_unique(
+            model._default_manager.using(schema_editor.connection.alias),
+            self.constraint.fields)
+        if not is_postgresql(schema_editor):
+            schema_editor.add_constraint(model, self.constraint)
+            return
+
+        ensure_not_in_transaction(schema_editor)
+        quote_name = schema_editor.quote_name
+        table = quote_name(model._meta.db_table)
+        name = quote_name(self.constraint.name)
+        columns = ', '.join(
+            quote_name(model._meta.get_field(field).column)
+            for field in self.constraint.fields)
+        schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+        schema_editor.execute(
+            f'CREATE UNIQUE INDEX CONCURRENTLY {name} ON {table} ({columns})')
+        schema_editor.execute(
+            f'ALTER TABLE {table} ADD CONSTRAINT {name} UNIQUE '
+            f'USING INDEX {name}')
+
+    def describe(self):
+        return 'Concurrently create constraint {} on {}'.format(
+            self.constraint.name, self.model_name)
+
+
+class RunPythonChunked(Operation):
+    '''
+    Call function with a queryset of each chunk of the model, see
+    otp_u2f.datamigrations. The function must be safe to repeat for a chunk.
+
+    name identifies the checkpoint and the data migration in u2f_datamigrate.
+    pending and reverse_pending return the rows of a queryset that are not
+    migrated, they are used to check a checkpoint before it is resumed.
+    Deferrable data migrations are skipped when OTP_U2F_DATA_MIGRATION['DEFER']
+    is set and run later with u2f_datamigrate. The schema must then support
+    the function with the current models until the command has finished.
+    '''
+    atomic = False
+    reduces_to_sql = False
+
+    def __init__(self, model_name, name, function, reverse_function=None,
+                 deferrable=False, pending=None, reverse_pending=None):
+        self.model_name = model_name
+        self.name = name
+        self.function = function
+        self.reverse_function = reverse_function
+        self.deferrable = deferrable
+        self.pending = pending
+        self.reverse_pending = reverse_pending
+        self.reversible = reverse_function is not None
+
+    def deconstruct(self):
+        kwargs = {
+            'model_name': self.model_name, 'name': self.name,
+            'function': self.function}
+        if self.reverse_function is not None:
+            kwargs['reverse_function'] = self.reverse_function
+        if self.deferrable:
+            kwargs['deferrable'] = True
+        if self.pending is not None:
+            kwargs['pending'] = self.pending
+        if self.reverse_pending is not None:
+            kwargs['reverse_pending'] = self.reverse_pending
+        return (self.__class__.__name__, [], kwargs)
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def run(self, name, function, pending, app_label, schema_editor, state):
+        model = state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return  # pragma: no cover
+        if self.deferrable and datamigrations.get_options()['DEFER']:
+            datamigrations.log.warning(
+                'Deferred data migration %s, run u2f_datamigrate %s', name,
+                name)
+            return
+        datamigrations.run(
+            name, model._default_manager.using(schema_editor.connection.alias),
+            function, pending=pending)
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        self.run(self.name, self.function, self.pending, app_label,
+                 schema_editor, from_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        self.run(f'{self.name}_reverse', self.reverse_function,
+                 self.reverse_pending, app_label, schema_editor, from_state)
+
+    def describe(self):
+        return 'Run data migration {} on {} in chunks'.format(
+            self.name, self.model_name)
@@ -0,0 +1,18 @@
+'''
+Kleides MFA plugin of the U2F devices.
+'''
+from kleides_mfa.registry import KleidesMfaPlugin
+
+
+class U2fPlugin(KleidesMfaPlugin):
+    '''
+    Import the forms, and with them fido2 and the cryptography backends,
+    when they are first used instead of when the app is ready.
+    '''
+    def get_create_form_class(self):
+        from .forms import U2fDeviceCreateForm
+        return U2fDeviceCreateForm
+
+    def get_verify_form_class(self):
+        from .forms import U2fVerifyForm
+        return U2fVerifyForm
@@ -0,0 +1,111 @@
+/*
+ * Request credentials from the browser for the otp_u2f challenges.
+ *
+ * Browsers with the WebAuthn JSON serialization exchange JSON with the
+ * server, the CBOR scripts from the data-cbor attribute of the script tag are
+ * only loaded for older browsers.
+ */
+'use strict';
+var OTP_U2F = (function () {
+    var cbor_urls = (document.currentScript.getAttribute('data-cbor') || '').split(' ');
+    var cbor_scripts = null;
+    var use_json = !!(window.PublicKeyCredential
+        && PublicKeyCredential.parseRequestOptionsFromJSON
+        && PublicKeyCredential.parseCreationOptionsFromJSON
+        && PublicKeyCredential.prototype.toJSON);
+
+    function load_cbor() {
+        if (!cbor_scripts) {
+            cbor_scripts = Promise.all(cbor_urls.map(function (src) {
+                return new Promise(function (resolve, reject) {
+                    var script = document.createElement('script');
+                    script.src = src;
+                    script.onload = resolve;
+                    script.onerror = reject;
+                    document.head.appendChild(script);
+                });
+            }));
+        }
+        return cbor_scripts;
+    }
+
+    // Request a challenge and store the stateless state in the state input.
+    function challenge(url, csrf_token, state_input) {
+        return fetch(url, {
+            method: 'POST',
+            headers: {
+                'Accept': use_json ? 'application/json' : 'text/plain',
+                'X-CSRFToken': csrf_token
+            }
+        }).then(function (response) {
+            if (response.ok) {
+                state_input.value = response.headers.get('X-OTP-U2F-State') || '';
+                return use_json ? response.json() : response.text();
+            }
+            throw new Error('Failed to get challenge');
+        });
+    }
+
+    // Return the otp_token of an assertion for the request options, the
+    // optional mediation and abort signal are passed to the browser.
+    function get(options, mediation, signal) {
+        if (use_json) {
+            var request = {
+                publicKey: PublicKeyCredential.parseRequestOptionsFromJSON(options.publicKey)
+            };
+            if (mediation) {
+                request.mediation = mediation;
+                request.signal = signal;
+            }
+            return navigator.credentials.get(request).then(function (assertion) {
+                return JSON.stringify(assertion.toJSON());
+            });
+        }
+        return load_cbor().then(function () {
+            var request = CBOR.decode(B64_AB.decode(options));
+            if (mediation) {
+                request.mediation = mediation;
+                request.signal = signal;
+            }
+            return navigator.credentials.get(request);
+        }).then(function (assertion) {
+            var response = {
+              'credentialId': new Uint8Array(assertion.rawId),
+              'authenticatorData': new Uint8Array(assertion.response.authenticatorData),
+              'clientDataJSON': new Uint8Array(assertion.response.clientDataJSON),
+              'signature': new Uint8Array(assertion.response.signature)
+            };
+            if (assertion.response.userHandle) {
+                response.userHandle = new Uint8Array(assertion.response.userHandle);
+            }
+            return B64_AB.encode(CBOR.encode(response));
+        });
+    }
+
+    // Return the otp_token of an attestation for the creation options.
+    function create(options) {
+        if (use_json) {
+            return navigator.credentials.create({
+                publicKey: PublicKeyCredential.parseCreationOptionsFromJSON(options.publicKey)
+            }).then(function (attestation) {
+                return JSON.stringify(attestation.toJSON());
+            });
+        }
+        return load_cbor().then(function () {
+            return navigator.credentials.create(CBOR.decode(B64_AB.decode(options)));
+        }).then(function (attestation) {
+            return B64_AB.encode(CBOR.encode({
+              'attestationObject': new Uint8Array(attestation.response.attestationObject),
+              'clientDataJSON': new Uint8Array(attestation.response.clientDataJSON)
+            }));
+        });
+    }
+
+    return {
+        use_json: use_json,
+        load_cbor: load_cbor,
+        challenge: challenge,
+        get: get,
+        create: create
+    };
+})();
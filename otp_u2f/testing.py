@@ -0,0 +1,297 @@
+'''
+Software authenticator for tests and benchmarks.
+
+The authenticator creates credentials and signs registrations and assertions
+like a security key so complete ceremonies can be run against the relying
+party without captured responses.
+'''
+from base64 import urlsafe_b64encode
+from contextlib import contextmanager
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from uuid import UUID
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import (
+    ec, ed25519, padding, rsa)
+
+from fido2 import cbor
+from fido2.cose import ES256, RS256, EdDSA
+from fido2.utils import websafe_encode
+from fido2.webauthn import (
+    AttestationObject, AttestedCredentialData, AuthenticatorData,
+    CollectedClientData)
+
+ALGORITHMS = ('ES256', 'EdDSA', 'RS256', 'U2F_V2')
+
+
+def rp_id_hash(rp_id):
+    return hashlib.sha256(rp_id.encode()).digest()
+
+
+def encode(response):
+    '''
+    Encode a response like the browser scripts for the otp_token field.
+    '''
+    return urlsafe_b64encode(cbor.encode(response)).decode()
+
+
+def encode_json(response):
+    '''
+    Encode a response like PublicKeyCredential.toJSON() in the browser.
+    '''
+    credential_id = response.get('credentialId')
+    if credential_id is None:
+        credential_id = AttestationObject(
+            response['attestationObject']).auth_data.credential_data \
+            .credential_id
+    return json.dumps({
+        'id': websafe_encode(credential_id),
+        'rawId': websafe_encode(credential_id),
+        'type': 'public-key',
+        'response': {
+            name: websafe_encode(value) for name, value in response.items()
+            if name != 'credentialId'},
+        'clientExtensionResults': {},
+    })
+
+
+class VirtualCredential:
+    '''
+    A credential of the virtual authenticator.
+
+    U2F_V2 credentials are legacy U2F registrations, they are scoped to the
+    appid instead of the rp id and stored as a raw public key. Credentials
+    with a user handle are discoverable. Credentials with a fixed counter
+    always report 0 like synced passkeys.
+    '''
+    def __init__(self, algorithm='ES256', credential_id=None,
+                 aaguid=bytes(16), counter=0, user_handle=None,
+                 fixed_counter=False):
+        if algorithm in ('ES256', 'U2F_V2'):
+            self.private_key = ec.generate_private_key(ec.SECP256R1())
+            cose = ES256
+        elif algorithm == 'EdDSA':
+            self.private_key = ed25519.Ed25519PrivateKey.generate()
+            cose = EdDSA
+        elif algorithm == 'RS256':
+            self.private_key = rsa.generate_private_key(65537, 2048)
+            cose = RS256
+        else:
+            raise ValueError(f'Unsupported algorithm {algorithm!r}')
+        self.algorithm = algorithm
+        self.cose_key = cose.from_cryptography_key(
+            self.private_key.public_key())
+        self.credential_id = credential_id or os.urandom(64)
+        self.aaguid = bytes(16) if algorithm == 'U2F_V2' else aaguid
+        self.counter = counter
+        self.user_handle = user_handle
+        self.fixed_counter = fixed_counter
+        self.lock = threading.Lock()
+
+    @property
+    def version(self):
+        return 'U2F_V2' if self.algorithm == 'U2F_V2' else 'webauthn'
+
+    @property
+    def public_key_data(self):
+        if self.algorithm == 'U2F_V2':
+            return self.private_key.public_key().public_bytes(
+                serialization.Encoding.X962,
+                serialization.PublicFormat.UncompressedPoint)
+        return cbor.encode(self.cose_key)
+
+    @property
+    def credential_data(self):
+        return AttestedCredentialData.create(
+            self.aaguid, self.credential_id, self.cose_key)
+
+    def device_kwargs(self, rp_id):
+        '''
+        Return the U2fDevice fields of the credential.
+        '''
+        return {
+            'rp_id': rp_id,
+            'version': self.version,
+            'aaguid': UUID(bytes=self.aaguid),
+            'credential_id': self.credential_id,
+            'public_key_data': self.public_key_data,
+            'counter': self.counter,
+        }
+
+    def next_counter(self):
+        if self.fixed_counter:
+            return self.counter
+        with self.lock:
+            self.counter += 1
+            return self.counter
+
+    def sign(self, data):
+        if self.algorithm == 'EdDSA':
+            return self.private_key.sign(data)
+        if self.algorithm == 'RS256':
+            return self.private_key.sign(
+                data, padding.PKCS1v15(), hashes.SHA256())
+        return self.private_key.sign(data, ec.ECDSA(hashes.SHA256()))
+
+
+class VirtualAuthenticator:
+    '''
+    Create registration and assertion responses for the options returned by
+    Webauthn.register_begin and Webauthn.authenticate_begin.
+    '''
+    def __init__(self, origin, aaguid=bytes(16)):
+        self.origin = origin
+        self.aaguid = aaguid
+        self.credentials = {}
+
+    def create_credential(self, algorithm='ES256', **kwargs):
+        '''
+        Return a new credential without registering it with the server.
+        '''
+        credential = VirtualCredential(
+            algorithm, aaguid=self.aaguid, **kwargs)
+        self.credentials[credential.credential_id] = credential
+        return credential
+
+    def register(self, options, algorithm='ES256'):
+        '''
+        Return the response to the creation options.
+        '''
+        if algorithm == 'U2F_V2':
+            raise ValueError('U2F_V2 credentials can not be registered')
+        options = options['publicKey']
+        excluded = {
+            descriptor['id']
+            for descriptor in options.get('excludeCredentials') or ()}
+        if excluded & set(self.credentials):
+            raise ValueError('The authenticator is already registered')
+
+        credential = VirtualCredential(
+            algorithm, aaguid=self.aaguid, user_handle=options['user']['id'])
+        if credential.cose_key.ALGORITHM not in {
+                param['alg'] for param in options['pubKeyCredParams']}:
+            raise ValueError(f'Algorithm {algorithm} is not allowed')
+        self.credentials[credential.credential_id] = credential
+        client_data = CollectedClientData.create(
+            CollectedClientData.TYPE.CREATE, options['challenge'],
+            self.origin)
+        auth_data = AuthenticatorData.create(
+            rp_id_hash(options['rp']['id']),
+            AuthenticatorData.FLAG.UP | AuthenticatorData.FLAG.AT,
+            credential.counter, credential.credential_data)
+        attestation_object = AttestationObject.create('none', auth_data, {})
+        return {
+            'clientDataJSON': bytes(client_data),
+            'attestationObject': bytes(attestation_object),
+        }
+
+    def authenticate(self, options, credential=None):
+        '''
+        Return the response to the request options signed with the first
+        allowed credential or the given credential. Without allowed
+        credentials the first discoverable credential is used.
+        '''
+        options = options['publicKey']
+        if credential is None:
+            allowed = [
+                descriptor['id']
+                for descriptor in options.get('allowCredentials') or ()]
+            if not allowed:
+                allowed = [
+                    credential_id
+                    for credential_id, credential in self.credentials.items()
+                    if credential.user_handle is not None]
+            try:
+                credential = next(
+                    self.credentials[credential_id]
+                    for credential_id in allowed
+                    if credential_id in self.credentials)
+            except StopIteration:
+                raise ValueError('No allowed credential is available')
+
+        if credential.algorithm == 'U2F_V2':
+            # The appid extension asserts the U2F application id.
+            rp_id = (options.get('extensions') or {})['appid']
+        else:
+            rp_id = options['rpId']
+        flags = AuthenticatorData.FLAG.UP
+        if options.get('userVerification') == 'required':
+            flags |= AuthenticatorData.FLAG.UV
+        client_data = CollectedClientData.create(
+            CollectedClientData.TYPE.GET, options['challenge'], self.origin)
+        auth_data = AuthenticatorData.create(
+            rp_id_hash(rp_id), flags, credential.next_counter())
+        response = {
+            'credentialId': credential.credential_id,
+            'clientDataJSON': bytes(client_data),
+            'authenticatorData': bytes(auth_data),
+            'signature': credential.sign(bytes(auth_data) + client_data.hash),
+        }
+        if credential.user_handle is not None:
+            response['userHandle'] = credential.user_handle
+        return response
+
+    def token(self, response):
+        '''
+        Return the assertion response as a U2fDevice.verify_token token.
+        '''
+        client_data = CollectedClientData(response['clientDataJSON'])
+        return encode({
+            **response,
+            'clientData': {'challenge': websafe_encode(client_data.challenge)},
+        })
+
+
+class Latencies:
+    '''
+    Collect latencies in seconds and summarize them in milliseconds.
+    '''
+    def __init__(self):
+        self.samples = []
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    @contextmanager
+    def measure(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(time.perf_counter() - start)
+
+    def percentile(self, percent):
+        '''
+        Return the nearest rank percentile.
+        '''
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        rank = max(math.ceil(percent / 100 * len(samples)), 1)
+        return samples[rank - 1]
+
+    def summary(self, duration=None):
+        '''
+        Return the count, throughput per second and latency percentiles.
+        The throughput is based on the total latency unless the wall clock
+        duration is given.
+        '''
+        total = sum(self.samples)
+        duration = total if duration is None else duration
+        return {
+            'count': len(self.samples),
+            'ops': len(self.samples) / duration if duration else 0.0,
+            'mean': total / len(self.samples) * 1000 if self.samples else 0.0,
+            'p50': self.percentile(50) * 1000,
+            'p95': self.percentile(95) * 1000,
+            'p99': self.percentile(99) * 1000,
+            'max': max(self.samples, default=0.0) * 1000,
+        }
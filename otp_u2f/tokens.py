@@ -0,0 +1,95 @@
+'''
+Stateless challenge state.
+
+The fido2 state of a challenge is returned to the client as an encrypted and
+authenticated token instead of being stored in the session. The token is bound
+to the purpose and the user of the challenge and can only be used once.
+'''
+import json
+import os
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.crypto import salted_hmac
+
+from .cache import CHALLENGE_TIMEOUT
+
+TOKEN_NONCE_PREFIX = 'otp_u2f:token:'
+NONCE_SIZE = 12
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def stateless_challenges():
+    return getattr(settings, 'OTP_U2F_STATELESS_CHALLENGES', False)
+
+
+def get_timeout():
+    return getattr(settings, 'OTP_U2F_CHALLENGE_TIMEOUT', CHALLENGE_TIMEOUT)
+
+
+def get_key(purpose, secret):
+    return salted_hmac(
+        'otp_u2f.tokens', purpose, secret=secret, algorithm='sha256').digest()
+
+
+def get_associated_data(purpose, user):
+    return f'{purpose}:{user.pk}'.encode()
+
+
+def dumps(state, purpose, user):
+    '''
+    Return a token with the challenge state for the user.
+    '''
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from fido2.utils import websafe_encode
+    nonce = os.urandom(NONCE_SIZE)
+    data = json.dumps({
+        'state': state, 'expires': time.time() + get_timeout()}).encode()
+    aead = AESGCM(get_key(purpose, settings.SECRET_KEY))
+    return websafe_encode(
+        nonce + aead.encrypt(nonce, data, get_associated_data(purpose, user)))
+
+
+def loads(token, purpose, user):
+    '''
+    Return the challenge state from the token.
+
+    The token must have been issued for the same purpose and user, must not be
+    expired and can only be loaded once.
+    '''
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from fido2.utils import websafe_decode, websafe_encode
+    try:
+        token = websafe_decode(token)
+    except (TypeError, ValueError):
+        raise InvalidToken('Malformed token')
+    nonce, ciphertext = token[:NONCE_SIZE], token[NONCE_SIZE:]
+
+    associated_data = get_associated_data(purpose, user)
+    secrets = [settings.SECRET_KEY, *getattr(
+        settings, 'SECRET_KEY_FALLBACKS', [])]
+    for secret in secrets:
+        aead = AESGCM(get_key(purpose, secret))
+        try:
+            data = json.loads(
+                aead.decrypt(nonce, ciphertext, associated_data))
+            break
+        except (InvalidTag, ValueError):
+            continue
+    else:
+        raise InvalidToken('Invalid token')
+
+    if data['expires'] < time.time():
+        raise InvalidToken('Expired token')
+
+    # Reject replayed tokens for as long as they are valid.
+    cache = caches[getattr(settings, 'OTP_U2F_CHALLENGE_CACHE', 'default')]
+    if not cache.add(
+            TOKEN_NONCE_PREFIX + websafe_encode(nonce), 1, get_timeout()):
+        raise InvalidToken('Token already used')
+    return data['state']
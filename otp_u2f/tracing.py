@@ -0,0 +1,86 @@
+'''
+Timing of the phases of the authentication and registration ceremonies.
+
+Every phase is logged to the otp_u2f.tracing logger at debug level, recorded
+for the Server-Timing header when the ServerTimingMiddleware is installed and
+wrapped in the context manager returned by OTP_U2F_TRACE_HOOK.
+'''
+from contextlib import contextmanager
+from contextvars import ContextVar
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+log = logging.getLogger(__name__)
+
+# Span names, also used as Server-Timing metric names.
+DECODE = 'u2f-decode'
+DEVICE = 'u2f-device'
+THROTTLE = 'u2f-throttle'
+SIGNATURE = 'u2f-signature'
+COUNTER = 'u2f-counter'
+CHALLENGE = 'u2f-challenge'
+CHALLENGE_GET = 'u2f-challenge-get'
+CHALLENGE_SET = 'u2f-challenge-set'
+
+_timings = ContextVar('otp_u2f_timings', default=None)
+
+_hook = None
+_hook_path = None
+_hook_lock = threading.Lock()
+
+
+def get_hook():
+    '''
+    Return the configured trace hook, a callable that returns a context
+    manager for a span name, for example an OpenTelemetry
+    tracer.start_as_current_span.
+    '''
+    global _hook, _hook_path
+
+    path = getattr(settings, 'OTP_U2F_TRACE_HOOK', None)
+    if path != _hook_path:
+        with _hook_lock:
+            if path != _hook_path:
+                _hook = import_string(path) if path else None
+                _hook_path = path
+    return _hook
+
+
+def start():
+    '''
+    Start recording the spans of the current context.
+    '''
+    return _timings.set([])
+
+
+def stop(token):
+    '''
+    Stop recording and return the (name, seconds) of the recorded spans.
+    '''
+    timings = _timings.get()
+    _timings.reset(token)
+    return timings
+
+
+@contextmanager
+def span(name):
+    hook = get_hook()
+    start = time.perf_counter()
+    try:
+        if hook is None:
+            yield
+        else:
+            with hook(name):
+                yield
+    finally:
+        duration = time.perf_counter() - start
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((name, duration))
+        log.debug(
+            '%s took %.3fms', name, duration * 1000,
+            extra={'otp_u2f_span': name, 'otp_u2f_duration': duration})
@@ -1,11 +1,24 @@
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
 app_name = 'otp_u2f'
 
+if getattr(settings, 'OTP_U2F_ASYNC_VIEWS', False):
+    authenticate_view = views.AsyncAuthenticateChallengeView
+    register_view = views.AsyncRegisterChallengeView
+else:
+    authenticate_view = views.AuthenticateChallengeView
+    register_view = views.RegisterChallengeView
+
 urlpatterns = [
-    path('authenticate/', views.AuthenticateChallengeView.as_view(),
-         name='authenticate'),
-    path('register/', views.RegisterChallengeView.as_view(), name='register'),
+    path('authenticate/', authenticate_view.as_view(), name='authenticate'),
+    path('register/', register_view.as_view(), name='register'),
+    path(
+        'passkey/', views.PasskeyChallengeView.as_view(),
+        name='passkey-challenge'),
+    path(
+        'passkey/login/', views.PasskeyLoginView.as_view(),
+        name='passkey-login'),
 ]
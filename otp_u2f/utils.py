@@ -1,24 +1,106 @@
 from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from collections.abc import Mapping
+from enum import Enum
+import json
+import threading
 
 from django.conf import settings
 from django.contrib.sites.shortcuts import get_current_site
 from django.utils.functional import cached_property
 
-from fido2.cbor import decode as cbor_decode, encode as cbor_encode
-from fido2.server import U2FFido2Server
-from fido2.webauthn import (
-    AttestationObject, AuthenticatorData, CollectedClientData,
-    PublicKeyCredentialRpEntity, UserVerificationRequirement)
+from asgiref.sync import sync_to_async
 
+from . import metrics, tracing
+from .executor import get_executor, verify_assertion, verify_attestation
+from .metadata import check_registration
 from .models import U2fDevice
 
+SERVER_POOL_SIZE = 128
+# Binary members of the response of a WebAuthn JSON serialized credential.
+JSON_RESPONSE_FIELDS = (
+    'clientDataJSON', 'authenticatorData', 'signature', 'userHandle',
+    'attestationObject')
+# Metric label of the verification functions.
+OPERATIONS = {verify_assertion: 'assertion', verify_attestation: 'attestation'}
 
-class Webauthn(U2FFido2Server):
+_servers = OrderedDict()
+_servers_lock = threading.Lock()
+
+
+def get_server(rp_id, rp_name, app_id):
+    '''
+    Return the shared relying party server for the given identity.
+
+    Servers are stateless and reused between requests and threads, the least
+    recently used server is discarded when the pool is full.
+    '''
+    key = (rp_id, rp_name, app_id)
+    with _servers_lock:
+        if key in _servers:
+            _servers.move_to_end(key)
+            return _servers[key]
+
+    from fido2.server import U2FFido2Server
+    from fido2.webauthn import PublicKeyCredentialRpEntity
+    server = U2FFido2Server(
+        app_id, rp=PublicKeyCredentialRpEntity(id=rp_id, name=rp_name),
+        attestation='direct')
+
+    with _servers_lock:
+        server = _servers.setdefault(key, server)
+        size = getattr(settings, 'OTP_U2F_SERVER_POOL_SIZE', SERVER_POOL_SIZE)
+        while len(_servers) > max(size, 1):
+            _servers.popitem(last=False)
+    return server
+
+
+def passkey_login():
+    return getattr(settings, 'OTP_U2F_PASSKEY_LOGIN', False)
+
+
+def get_resident_key_requirement():
+    # Passkey login requires discoverable credentials.
+    if passkey_login():
+        from fido2.webauthn import ResidentKeyRequirement
+        return ResidentKeyRequirement.PREFERRED
+    return None
+
+
+def to_json(data):
+    '''
+    Convert a Fido data structure to the WebAuthn JSON serialization with
+    unpadded base64url encoded binary values.
+    '''
+    from fido2.utils import websafe_encode
+    if isinstance(data, bytes):
+        return websafe_encode(data)
+    if isinstance(data, Enum):
+        return data.value
+    if isinstance(data, Mapping):
+        return {key: to_json(value) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [to_json(value) for value in data]
+    return data
+
+
+def clear_servers(**kwargs):
+    '''
+    Discard all shared servers, connected to the Site change signals.
+    '''
+    with _servers_lock:
+        _servers.clear()
+
+
+class Webauthn:
     def __init__(self, request=None):
         self.request = request
 
     @cached_property
-    def server(self):
+    def server_key(self):
+        '''
+        The (rp_id, rp_name, app_id) identity of the relying party.
+        '''
         rp_id = getattr(settings, 'OTP_U2F_RP_ID', None)
         rp_name = getattr(settings, 'OTP_U2F_RP_NAME', None)
         app_id = getattr(settings, 'OTP_U2F_APP_ID', None)
@@ -34,55 +116,207 @@ class Webauthn(U2FFido2Server):
             else:
                 app_id = f'https://{rp_id}'
 
-        return U2FFido2Server(
-            app_id, rp=PublicKeyCredentialRpEntity(id=rp_id, name=rp_name),
-            attestation='direct')
+        return (rp_id, rp_name, app_id)
+
+    @cached_property
+    def server(self):
+        return get_server(*self.server_key)
+
+    async def aget_server(self):
+        '''
+        Return the server, the current site is looked up synchronously.
+        '''
+        if 'server' not in self.__dict__ and getattr(
+                settings, 'OTP_U2F_RP_ID', None) is None:
+            return await sync_to_async(lambda: self.server)()
+        return self.server
+
+    def run_verification(self, verify, *args):
+        '''
+        Run the verification function in the configured executor.
+        '''
+        executor = get_executor()
+        with tracing.span(tracing.SIGNATURE), metrics.timer(
+                metrics.SIGNATURE_SECONDS, operation=OPERATIONS[verify]):
+            if executor is None:
+                return verify(self.server, *args)
+            if executor.uses_processes:
+                return executor.run(verify, self.server_key, *args)
+            return executor.run(verify, self.server, *args)
+
+    async def arun_verification(self, verify, *args):
+        server = await self.aget_server()
+        executor = get_executor()
+        with tracing.span(tracing.SIGNATURE), metrics.timer(
+                metrics.SIGNATURE_SECONDS, operation=OPERATIONS[verify]):
+            if executor is None:
+                # Keep the event loop responsive during verification.
+                return await sync_to_async(verify, thread_sensitive=False)(
+                    server, *args)
+            if executor.uses_processes:
+                return await executor.arun(verify, self.server_key, *args)
+            return await executor.arun(verify, server, *args)
 
     @property
     def rp_id(self):
         return self.server.rp.id
 
+    @property
+    def rp_ids(self):
+        '''
+        The rp ids of the devices of the relying party, legacy U2F devices
+        are stored with the app id.
+        '''
+        rp_id, rp_name, app_id = self.server_key
+        return (rp_id, app_id)
+
+    @metrics.timed(
+        metrics.CHALLENGE_SECONDS, metrics.CHALLENGES, purpose='authenticate')
     def authenticate_begin(self, user):
+        from fido2.webauthn import UserVerificationRequirement
         return self.server.authenticate_begin(
-            credentials=U2fDevice.get_credentials(user),
+            credentials=U2fDevice.get_credentials(user, self.rp_ids),
             # Disables PIN prompts but does require interactive keys to be
             # pressed.
             # https://chromium.googlesource.com/chromium/src/+/refs/heads/main/content/browser/webauth/uv_preferred.md  # NOQA
             user_verification=UserVerificationRequirement.DISCOURAGED,
         )
 
+    @metrics.timed(
+        metrics.CHALLENGE_SECONDS, metrics.CHALLENGES, purpose='authenticate')
+    async def aauthenticate_begin(self, user):
+        from fido2.webauthn import UserVerificationRequirement
+        server = await self.aget_server()
+        return server.authenticate_begin(
+            credentials=await U2fDevice.aget_credentials(user, self.rp_ids),
+            user_verification=UserVerificationRequirement.DISCOURAGED,
+        )
+
+    @metrics.timed(
+        metrics.CHALLENGE_SECONDS, metrics.CHALLENGES, purpose='passkey')
+    def passkey_begin(self):
+        '''
+        Return request options without allowed credentials, the
+        authenticator offers its discoverable credentials for the relying
+        party. User verification is required because the credential is the
+        only factor.
+        '''
+        from fido2.webauthn import UserVerificationRequirement
+        return self.server.authenticate_begin(
+            user_verification=UserVerificationRequirement.REQUIRED)
+
+    def passkey_complete(self, state, data, device):
+        '''
+        Verify the assertion of a discoverable credential with the device
+        that was resolved from the credential id.
+        '''
+        return self.run_verification(
+            verify_assertion, state, [device.as_credential()],
+            data['credentialId'], data['clientDataJSON'],
+            data['authenticatorData'], data['signature'])
+
     def authenticate_complete(self, state, data, user):
-        auth_data = AuthenticatorData(data['authenticatorData'])
-        credential = self.server.authenticate_complete(
-            state, credentials=U2fDevice.get_credentials(user),
-            credential_id=data['credentialId'],
-            client_data=CollectedClientData(data['clientDataJSON']),
-            auth_data=auth_data,
-            signature=data['signature'])
-        return (credential, auth_data)
+        return self.run_verification(
+            verify_assertion, state,
+            U2fDevice.get_credentials(user, self.rp_ids),
+            data['credentialId'], data['clientDataJSON'],
+            data['authenticatorData'], data['signature'])
 
+    async def aauthenticate_complete(self, state, data, user):
+        # The rp ids may require the current site.
+        await self.aget_server()
+        return await self.arun_verification(
+            verify_assertion, state,
+            await U2fDevice.aget_credentials(user, self.rp_ids),
+            data['credentialId'], data['clientDataJSON'],
+            data['authenticatorData'], data['signature'])
+
+    @metrics.timed(
+        metrics.CHALLENGE_SECONDS, metrics.CHALLENGES, purpose='register')
     def register_begin(self, user):
+        from fido2.webauthn import UserVerificationRequirement
         return self.server.register_begin({
             'id': str(user.pk).encode(),
             'name': user.get_username(),
             'displayName': user.get_full_name() or user.get_username()},
-            credentials=U2fDevice.get_credentials(user),
+            credentials=U2fDevice.get_credentials(user, self.rp_ids),
+            resident_key_requirement=get_resident_key_requirement(),
+            user_verification=UserVerificationRequirement.DISCOURAGED,
+        )
+
+    @metrics.timed(
+        metrics.CHALLENGE_SECONDS, metrics.CHALLENGES, purpose='register')
+    async def aregister_begin(self, user):
+        from fido2.webauthn import UserVerificationRequirement
+        server = await self.aget_server()
+        return server.register_begin({
+            'id': str(user.pk).encode(),
+            'name': user.get_username(),
+            'displayName': user.get_full_name() or user.get_username()},
+            credentials=await U2fDevice.aget_credentials(user, self.rp_ids),
+            resident_key_requirement=get_resident_key_requirement(),
             user_verification=UserVerificationRequirement.DISCOURAGED,
         )
 
     def register_complete(self, state, data):
-        return self.server.register_complete(
-            state, client_data=CollectedClientData(data['clientDataJSON']),
-            attestation_object=AttestationObject(data['attestationObject']))
+        authenticator_data = self.run_verification(
+            verify_attestation, state, data['clientDataJSON'],
+            data['attestationObject'])
+        check_registration(
+            authenticator_data, data['clientDataJSON'],
+            data['attestationObject'])
+        return authenticator_data
+
+    async def aregister_complete(self, state, data):
+        authenticator_data = await self.arun_verification(
+            verify_attestation, state, data['clientDataJSON'],
+            data['attestationObject'])
+        # The metadata blob may be parsed again when it has changed.
+        await sync_to_async(check_registration)(
+            authenticator_data, data['clientDataJSON'],
+            data['attestationObject'])
+        return authenticator_data
 
     def decode(self, data):
         '''
-        Decode base64 string to a CBOR data structure.
+        Decode base64 string to a CBOR data structure or a WebAuthn JSON
+        serialized credential, see decode_json.
+        '''
+        from fido2 import cbor
+        if data[:1] == '{':
+            # Ignore the base64 padding that is added by the forms.
+            return self.decode_json(data.rstrip('='))
+        return cbor.decode(urlsafe_b64decode(data))
+
+    def decode_json(self, data):
+        '''
+        Decode the JSON of PublicKeyCredential.toJSON() to the structure of
+        decode. Raise ValueError when the credential is malformed.
         '''
-        return cbor_decode(urlsafe_b64decode(data))
+        from fido2.utils import websafe_decode
+        credential = json.loads(data)
+        if not isinstance(credential, dict) or not isinstance(
+                credential.get('response'), dict):
+            raise ValueError('The credential has no response')
+        response = credential['response']
+        values = {
+            name: response[name]
+            for name in JSON_RESPONSE_FIELDS
+            if response.get(name) not in (None, '')}
+        values['credentialId'] = credential.get('rawId')
+        if not all(isinstance(value, str) for value in values.values()):
+            raise ValueError('The credential values must be strings')
+        return {name: websafe_decode(value) for name, value in values.items()}
 
     def encode(self, data):
         '''
         Encode Fido data structure to a base64 encoded CBOR data structure.
         '''
-        return urlsafe_b64encode(cbor_encode(data)).decode()
+        from fido2 import cbor
+        return urlsafe_b64encode(cbor.encode(data)).decode()
+
+    def encode_json(self, data):
+        '''
+        Encode Fido data structure to the WebAuthn JSON serialization.
+        '''
+        return json.dumps(to_json(data), separators=(',', ':'))
@@ -1,28 +1,167 @@
-from django.http import HttpResponse
+from django.conf import settings
+from django.contrib.auth import get_user_model, login
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.signals import user_login_failed
+from django.contrib.auth.views import LoginView
+from django.http import Http404, HttpResponse, HttpResponseRedirect
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
 from django.views import View
 
+from asgiref.sync import sync_to_async
+
 from kleides_mfa.views.mixins import (
-    SetupOrMFARequiredMixin, UnverifiedUserMixin)
+    VERIFIED_SESSION_KEY, SetupOrMFARequiredMixin, UnverifiedUserMixin)
+
+from . import metrics, tracing
+from .forms import (
+    U2F_AUTHENTICATION_KEY, U2F_PASSKEY_KEY, U2F_REGISTRATION_KEY,
+    U2fPasskeyForm, save_state)
+from .utils import Webauthn, passkey_login
+
+# Response header with the stateless challenge state.
+U2F_STATE_HEADER = 'X-OTP-U2F-State'
+
 
-from .forms import U2F_AUTHENTICATION_KEY, U2F_REGISTRATION_KEY
-from .utils import Webauthn
+def accepts_json(request):
+    '''
+    Return whether the client asked for the WebAuthn JSON serialization of
+    the options. Clients that accept any type receive base64 encoded CBOR.
+    '''
+    return 'application/json' in request.headers.get('Accept', '')
+
+
+def challenge_response(webauthn, challenge, state, purpose, user, request):
+    if accepts_json(request):
+        response = HttpResponse(
+            webauthn.encode_json(challenge), content_type='application/json')
+    else:
+        response = HttpResponse(
+            webauthn.encode(challenge).rstrip('='), content_type='text/plain')
+    patch_vary_headers(response, ['Accept'])
+    with tracing.span(tracing.CHALLENGE_SET):
+        token = save_state(request, state, purpose, user)
+    if token is not None:
+        response[U2F_STATE_HEADER] = token
+    return response
 
 
 class AuthenticateChallengeView(UnverifiedUserMixin, View):
     def post(self, request):
         webauthn = Webauthn(self.request)
-        authenticate, state = webauthn.authenticate_begin(self.unverified_user)
-        self.request.session[U2F_AUTHENTICATION_KEY] = state
-        return HttpResponse(
-            webauthn.encode(authenticate).rstrip('='),
-            content_type='text/plain')
+        with tracing.span(tracing.CHALLENGE):
+            authenticate, state = webauthn.authenticate_begin(
+                self.unverified_user)
+        return challenge_response(
+            webauthn, authenticate, state, U2F_AUTHENTICATION_KEY,
+            self.unverified_user, self.request)
 
 
 class RegisterChallengeView(SetupOrMFARequiredMixin, View):
     def post(self, request):
         webauthn = Webauthn(request)
-        registration, state = webauthn.register_begin(request.user)
-        self.request.session[U2F_REGISTRATION_KEY] = state
+        with tracing.span(tracing.CHALLENGE):
+            registration, state = webauthn.register_begin(request.user)
+        return challenge_response(
+            webauthn, registration, state, U2F_REGISTRATION_KEY,
+            request.user, self.request)
+
+
+class PasskeyLoginMixin:
+    def dispatch(self, request, *args, **kwargs):
+        if not passkey_login():
+            raise Http404('Passkey login is not enabled')
+        return super().dispatch(request, *args, **kwargs)
+
+
+class PasskeyChallengeView(PasskeyLoginMixin, View):
+    def post(self, request):
+        webauthn = Webauthn(request)
+        with tracing.span(tracing.CHALLENGE):
+            authenticate, state = webauthn.passkey_begin()
+        return challenge_response(
+            webauthn, authenticate, state, U2F_PASSKEY_KEY, AnonymousUser(),
+            request)
+
+
+class PasskeyLoginView(PasskeyLoginMixin, LoginView):
+    '''
+    Log in with a discoverable credential instead of a username, password
+    and second factor.
+    '''
+    form_class = U2fPasskeyForm
+    template_name = 'otp_u2f/passkey_login.html'
+
+    def form_valid(self, form):
+        user = form.get_user()
+        # Pass the otp device to django-otp.
+        user.otp_device = form.get_device()
+        login(self.request, user, getattr(
+            settings, 'OTP_U2F_PASSKEY_BACKEND',
+            settings.AUTHENTICATION_BACKENDS[0]))
+        # Mark the session as verified like kleides-mfa does after the
+        # second factor.
+        self.request.session[VERIFIED_SESSION_KEY] = (
+            timezone.now().isoformat())
+        return HttpResponseRedirect(self.get_success_url())
+
+    def form_invalid(self, form):
+        device = getattr(form, 'device', None)
+        if device is not None:
+            User = get_user_model()
+            user_login_failed.send(
+                sender=__name__,
+                credentials={
+                    'username': getattr(device.user, User.USERNAME_FIELD)},
+                request=self.request, user=device.user, device=device)
+        return super().form_invalid(form)
+
+
+class AsyncChallengeMixin:
+    '''
+    Run the synchronous access checks of the kleides-mfa mixins in a thread
+    and dispatch to the async handlers.
+    '''
+    async def dispatch(self, request, *args, **kwargs):
+        if not await sync_to_async(self.get_test_func())():
+            return await sync_to_async(self.handle_no_permission)()
+        return await View.dispatch(self, request, *args, **kwargs)
+
+
+class AsyncAuthenticateChallengeView(
+        AsyncChallengeMixin, UnverifiedUserMixin, View):
+    async def post(self, request):
+        webauthn = Webauthn(self.request)
+        with tracing.span(tracing.CHALLENGE):
+            authenticate, state = await webauthn.aauthenticate_begin(
+                self.unverified_user)
+        # The session was loaded by the access check.
+        return challenge_response(
+            webauthn, authenticate, state, U2F_AUTHENTICATION_KEY,
+            self.unverified_user, self.request)
+
+
+class AsyncRegisterChallengeView(
+        AsyncChallengeMixin, SetupOrMFARequiredMixin, View):
+    async def post(self, request):
+        webauthn = Webauthn(request)
+        # The user and session were loaded by the access check.
+        with tracing.span(tracing.CHALLENGE):
+            registration, state = await webauthn.aregister_begin(
+                request.user)
+        return challenge_response(
+            webauthn, registration, state, U2F_REGISTRATION_KEY,
+            request.user, self.request)
+
+
+class PrometheusMetricsView(View):
+    '''
+    Render the metrics of the PrometheusBackend. The view is not included in
+    otp_u2f.urls, restrict access when it is added to the urls.
+    '''
+    def get(self, request):
+        backend = metrics.get_backend()
+        if not isinstance(backend, metrics.PrometheusBackend):
+            raise Http404('The Prometheus metrics backend is not configured')
         return HttpResponse(
-            webauthn.encode(registration).rstrip('='),
-            content_type='text/plain')
+            backend.render(), content_type='text/plain; version=0.0.4')
@@ -1,11 +1,104 @@
+import json
+
+from django.test import RequestFactory
+
 import pytest
 
+from otp_u2f.testing import Latencies
 from otp_u2f.utils import Webauthn
 
 
+def pytest_addoption(parser):
+    group = parser.getgroup('u2f-benchmark')
+    group.addoption(
+        '--u2f-benchmark', action='store_true',
+        help='Run the benchmarks.')
+    group.addoption(
+        '--u2f-benchmark-iterations', type=int, default=100,
+        help='Number of calls to measure per benchmark.')
+    group.addoption(
+        '--u2f-benchmark-json', metavar='PATH',
+        help='Save the benchmark results.')
+    group.addoption(
+        '--u2f-benchmark-compare', metavar='PATH',
+        help='Fail benchmarks which are slower than the saved results.')
+    group.addoption(
+        '--u2f-benchmark-tolerance', type=float, default=1.5,
+        help='Allowed ratio of the median latency to the saved results.')
+
+
+def pytest_configure(config):
+    config.u2f_benchmark_results = {}
+    config.u2f_benchmark_baseline = {}
+    path = config.getoption('u2f_benchmark_compare')
+    if path:
+        with open(path) as fp:
+            config.u2f_benchmark_baseline = json.load(fp)
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('u2f_benchmark'):
+        return
+    skip = pytest.mark.skip(reason='use --u2f-benchmark to run the benchmarks')
+    for item in items:
+        if 'u2f_benchmark' in item.keywords:
+            item.add_marker(skip)
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    results = config.u2f_benchmark_results
+    if not results:
+        return
+    terminalreporter.section('benchmarks')
+    terminalreporter.write_line(
+        f'{"name":<72} {"ops/s":>9} {"p50 ms":>8} {"p95 ms":>8} '
+        f'{"p99 ms":>8}')
+    for name, summary in results.items():
+        terminalreporter.write_line(
+            f'{name:<72} {summary["ops"]:>9.1f} {summary["p50"]:>8.3f} '
+            f'{summary["p95"]:>8.3f} {summary["p99"]:>8.3f}')
+    path = config.getoption('u2f_benchmark_json')
+    if path:
+        with open(path, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+@pytest.fixture
+def u2f_benchmark(request):
+    '''
+    Measure the latency of a function, setup returns the arguments of
+    a single call and is not measured.
+    '''
+    config = request.config
+    name = request.node.nodeid.split('::', 1)[-1]
+
+    def run(fn, *args, setup=None):
+        latencies = Latencies()
+        for i in range(config.getoption('u2f_benchmark_iterations')):
+            call_args = args if setup is None else setup()
+            with latencies.measure():
+                fn(*call_args)
+        summary = config.u2f_benchmark_results[name] = latencies.summary()
+
+        baseline = config.u2f_benchmark_baseline.get(name)
+        tolerance = config.getoption('u2f_benchmark_tolerance')
+        if baseline and summary['p50'] > baseline['p50'] * tolerance:
+            pytest.fail(
+                f'{name} regressed, median latency {summary["p50"]:.3f}ms '
+                f'was {baseline["p50"]:.3f}ms')
+        return summary
+    return run
+
+
 @pytest.fixture
 def webauthn(settings):
     settings.OTP_U2F_RP_ID = 'localhost.osso.ninja'
     webauthn = Webauthn()
     assert webauthn.rp_id == 'localhost.osso.ninja'
     return webauthn
+
+
+@pytest.fixture
+def rfactory(settings):
+    settings.ALLOWED_HOSTS = ['localhost.osso.ninja',  'testserver']
+    return RequestFactory(SERVER_NAME='localhost.osso.ninja')
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
+import os
 from uuid import UUID
 
 import factory
@@ -33,3 +34,4 @@ class U2fDeviceFactory(DjangoModelFactory):
     rp_id = 'localhost.osso.ninja'
     version = 'webauth'
     aaguid = UUID('00000000-0000-0000-0000-000000000000')
+    credential_id = factory.LazyFunction(lambda: os.urandom(64))
@@ -28,7 +28,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': ':memory:',
-    }
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+        'TEST': {'MIRROR': 'default'},
+    },
 }
 
 TEMPLATES = [
@@ -48,4 +53,8 @@ TEMPLATES = [
 
 KLEIDES_MFA_PATCH_ADMIN = False
 
+ROOT_URLCONF = 'tests.urls'
+
+STATIC_URL = '/static/'
+
 USE_TZ = True
@@ -0,0 +1,138 @@
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from fido2.utils import websafe_encode
+
+from otp_u2f.models import U2fDevice
+
+from .factories import U2fDeviceFactory, UserFactory
+
+
+class U2fDeviceAdminTestCase(TestCase):
+    def setUp(self):
+        self.admin = UserFactory(is_staff=True, is_superuser=True)
+        self.client.force_login(self.admin)
+        self.url = reverse('admin:otp_u2f_u2fdevice_changelist')
+
+    def test_changelist_queries(self):
+        U2fDeviceFactory.create_batch(3)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        U2fDeviceFactory.create_batch(7)
+        # The users are selected with the devices.
+        with self.assertNumQueries(5):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '10 u2f devices')
+
+    def test_search(self):
+        device = U2fDeviceFactory()
+        other = U2fDeviceFactory()
+
+        response = self.client.get(self.url, {'q': device.user.username})
+        self.assertEqual(list(response.context['cl'].result_list), [device])
+        response = self.client.get(
+            self.url, {'q': websafe_encode(other.credential_id)})
+        self.assertEqual(list(response.context['cl'].result_list), [other])
+        # Partial usernames do not match.
+        response = self.client.get(self.url, {'q': device.user.username[:-1]})
+        self.assertEqual(list(response.context['cl'].result_list), [])
+
+    def test_search_username_field(self):
+        device = U2fDeviceFactory()
+        device.user.email = 'device@example.com'
+        device.user.save()
+        User = type(device.user)
+        User.USERNAME_FIELD = 'email'
+        self.addCleanup(setattr, User, 'USERNAME_FIELD', 'username')
+
+        response = self.client.get(self.url, {'q': 'device@example.com'})
+        self.assertEqual(list(response.context['cl'].result_list), [device])
+
+    def test_add(self):
+        url = reverse('admin:otp_u2f_u2fdevice_add')
+        data = {
+            'user': self.admin.pk, 'name': 'Key', 'confirmed': 'on',
+            'rp_id': 'example.com', 'version': 'webauthn',
+            'aaguid': '00000000-0000-0000-0000-000000000000',
+            'credential': websafe_encode(b'credential'),
+            'public_key': websafe_encode(b'public key'), 'counter': 0,
+        }
+        response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 302)
+        device = U2fDevice.objects.get()
+        self.assertEqual(bytes(device.credential_id), b'credential')
+        self.assertEqual(bytes(device.public_key_data), b'public key')
+
+        # Empty, invalid and existing credential ids are rejected.
+        for credential in ['', '====', '!', websafe_encode(b'credential')]:
+            response = self.client.post(
+                url, {**data, 'credential': credential})
+            self.assertEqual(response.status_code, 200)
+            form = response.context['adminform'].form
+            self.assertIn('credential', form.errors)
+        self.assertEqual(U2fDevice.objects.count(), 1)
+
+        # The device keeps its credential id when it is changed.
+        response = self.client.post(
+            reverse('admin:otp_u2f_u2fdevice_change', args=[device.pk]),
+            {**data, 'name': 'Renamed'})
+        self.assertEqual(response.status_code, 302)
+        device.refresh_from_db()
+        self.assertEqual(device.name, 'Renamed')
+        self.assertEqual(bytes(device.credential_id), b'credential')
+
+    def test_filters(self):
+        device = U2fDeviceFactory(version='U2F_V2')
+        U2fDeviceFactory(version='webauthn', confirmed=False)
+        response = self.client.get(self.url, {'version': 'U2F_V2'})
+        self.assertEqual(list(response.context['cl'].result_list), [device])
+        response = self.client.get(self.url, {'confirmed__exact': '1'})
+        self.assertEqual(list(response.context['cl'].result_list), [device])
+
+    def test_rp_id_filter(self):
+        device = U2fDeviceFactory(rp_id='testserver')
+        legacy = U2fDeviceFactory(rp_id='https://testserver')
+        U2fDeviceFactory(rp_id='example.com')
+        response = self.client.get(self.url, {'rp_id': 'testserver'})
+        self.assertEqual(
+            set(response.context['cl'].result_list), {device, legacy})
+        # The choices are the domain of the site without a query.
+        self.assertContains(response, '?rp_id=testserver')
+        self.assertNotContains(response, '?rp_id=example.com')
+
+        with self.settings(OTP_U2F_RP_ID='example.com'):
+            response = self.client.get(self.url)
+        self.assertContains(response, '?rp_id=example.com')
+        self.assertNotContains(response, '?rp_id=testserver')
+
+    def post_action(self, action, devices):
+        return self.client.post(self.url, {
+            'action': action,
+            '_selected_action': [device.pk for device in devices],
+        }, follow=True)
+
+    def test_disable_enable(self):
+        devices = U2fDeviceFactory.create_batch(2)
+        other = U2fDeviceFactory()
+
+        response = self.post_action('disable_devices', devices)
+        self.assertContains(response, 'Disabled 2 devices.')
+        self.assertEqual(
+            list(U2fDevice.objects.filter(confirmed=True)), [other])
+
+        response = self.post_action('enable_devices', devices[:1])
+        self.assertContains(response, 'Enabled 1 device.')
+        self.assertEqual(
+            U2fDevice.objects.filter(confirmed=True).count(), 2)
+
+    def test_reset_throttling(self):
+        device = U2fDeviceFactory(
+            throttling_failure_count=5,
+            throttling_failure_timestamp=timezone.now())
+        response = self.post_action('reset_throttling', [device])
+        self.assertContains(response, 'Reset throttling of 1 device.')
+        device.refresh_from_db()
+        self.assertEqual(device.throttling_failure_count, 0)
+        self.assertIsNone(device.throttling_failure_timestamp)
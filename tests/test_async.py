@@ -0,0 +1,93 @@
+from base64 import urlsafe_b64decode
+
+from django.core.cache import cache
+
+from asgiref.sync import async_to_sync
+import pytest
+
+from otp_u2f.cache import ChallengeStore, CredentialCache
+from otp_u2f.forms import U2F_AUTHENTICATION_KEY, U2F_REGISTRATION_KEY
+from otp_u2f.models import DeviceClonedError, U2fDevice
+from otp_u2f.views import (
+    AsyncAuthenticateChallengeView, AsyncRegisterChallengeView)
+
+from .factories import U2fDeviceFactory, UserFactory
+
+CREDENTIAL = 'n8ZklynFZSmYNrICld-ShxDR64QVrov2FEmy-PaHVtVE_WCj1HpLfPMgdDBQEBK5tC7TY3U0iNGTDiWWfxLylg=='  # noqa
+PUBLIC_KEY = 'pQECAyYgASFYIKL35NsyHSsIXBqC2upUvILPoOzkuAPc2x1AT7Mkvm0fIlggJVbR-teZTDVVL7NMRLob3gZmnz0hzloFXHzOukIWIF8='  # noqa
+
+
+@pytest.fixture
+def device():
+    return U2fDeviceFactory(
+        credential=CREDENTIAL, public_key=PUBLIC_KEY, counter=1)
+
+
+@pytest.mark.django_db()
+def test_aget_credentials(device, settings):
+    credentials = async_to_sync(U2fDevice.aget_credentials)(device.user)
+    assert credentials == U2fDevice.get_credentials(device.user)
+
+    settings.OTP_U2F_CREDENTIAL_CACHE = 'default'
+    cache.clear()
+    credentials = async_to_sync(U2fDevice.aget_credentials)(device.user)
+    # The cache holds the credentials of all relying parties.
+    assert cache.get(CredentialCache('default').make_key(device.user.pk)) \
+        == [(device.rp_id, credential) for credential in credentials]
+    cache.clear()
+
+
+@pytest.mark.django_db()
+def test_aget_device(device):
+    credential_id = urlsafe_b64decode(CREDENTIAL)
+    assert async_to_sync(U2fDevice.aget_device)(
+        device.user, credential_id) == device
+    with pytest.raises(U2fDevice.DoesNotExist):
+        async_to_sync(U2fDevice.aget_device)(device.user, b'unknown')
+
+
+@pytest.mark.django_db()
+def test_aupdate_usage_counter(device):
+    async_to_sync(device.aupdate_usage_counter)(2)
+    assert device.counter == 2
+    with pytest.raises(DeviceClonedError):
+        async_to_sync(device.aupdate_usage_counter)(2)
+    async_to_sync(device.aincrement_failure_counter)()
+    assert device.throttling_failure_count == 2
+
+
+def test_challenge_store_async():
+    store = ChallengeStore()
+    async_to_sync(store.aset)('abc', {'challenge': 'abc'})
+    assert async_to_sync(store.apop)('abc') == {'challenge': 'abc'}
+    assert async_to_sync(store.apop)('abc') is None
+    cache.clear()
+
+
+@pytest.mark.django_db()
+def test_async_authenticate_challenge_view(rfactory, webauthn, device):
+    request = rfactory.post('/u2f/auth/challenge/')
+    request.session = {}
+    view = AsyncAuthenticateChallengeView()
+    view.setup(request)
+    view.get_unverified_user = lambda: device.user
+    assert AsyncAuthenticateChallengeView.view_is_async
+    response = async_to_sync(view.dispatch)(request)
+    assert response.status_code == 200
+    state = request.session[U2F_AUTHENTICATION_KEY]
+    key = webauthn.decode(response.content + b'===')['publicKey']
+    assert key['challenge'] == urlsafe_b64decode(state['challenge'] + '===')
+    assert len(key['allowCredentials']) == 1
+
+
+@pytest.mark.django_db()
+def test_async_register_challenge_view(rfactory, webauthn, device):
+    request = rfactory.post('/u2f/register/challenge/')
+    request.session = {}
+    request.user = UserFactory()
+    response = async_to_sync(AsyncRegisterChallengeView.as_view())(request)
+    assert response.status_code == 200
+    state = request.session[U2F_REGISTRATION_KEY]
+    key = webauthn.decode(response.content + b'===')['publicKey']
+    assert key['challenge'] == urlsafe_b64decode(state['challenge'] + '===')
+    assert key['user']['id'] == str(request.user.pk).encode()
@@ -0,0 +1,85 @@
+'''
+Benchmarks of the authentication and registration ceremonies as the number
+of devices per user grows.
+
+Run with ``pytest --u2f-benchmark tests/test_benchmarks.py``, save the results
+with ``--u2f-benchmark-json=PATH`` and compare a later run to them with
+``--u2f-benchmark-compare=PATH``.
+'''
+import pytest
+
+from otp_u2f.models import U2fDevice, hash_credential
+from otp_u2f.testing import ALGORITHMS, VirtualAuthenticator
+
+from .factories import UserFactory
+
+ORIGIN = 'https://localhost.osso.ninja'
+DEVICES = [1, 10, 100, 250]
+
+pytestmark = [pytest.mark.u2f_benchmark, pytest.mark.django_db()]
+
+
+def create_devices(webauthn, count, algorithm='ES256'):
+    user = UserFactory()
+    authenticator = VirtualAuthenticator(ORIGIN)
+    devices = []
+    for i in range(count):
+        credential = authenticator.create_credential(
+            algorithm if i == 0 else 'ES256')
+        device = U2fDevice(
+            user=user, name=f'Device {i}',
+            **credential.device_kwargs(webauthn.rp_id))
+        device.credential_hash = hash_credential(device.credential_id)
+        devices.append(device)
+    U2fDevice.objects.bulk_create(devices)
+    return user, authenticator
+
+
+@pytest.fixture(params=DEVICES, ids=lambda count: f'{count}-devices')
+def devices(request, webauthn):
+    return create_devices(webauthn, request.param)
+
+
+def test_authenticate_begin(u2f_benchmark, webauthn, devices):
+    user, authenticator = devices
+    u2f_benchmark(webauthn.authenticate_begin, user)
+
+
+def test_authenticate_complete(u2f_benchmark, webauthn, devices):
+    user, authenticator = devices
+    options, state = webauthn.authenticate_begin(user)
+    response = authenticator.authenticate(options)
+    u2f_benchmark(webauthn.authenticate_complete, state, response, user)
+
+
+@pytest.mark.parametrize('algorithm', ALGORITHMS)
+def test_authenticate_complete_algorithm(u2f_benchmark, webauthn, algorithm):
+    user, authenticator = create_devices(webauthn, 1, algorithm)
+    options, state = webauthn.authenticate_begin(user)
+    response = authenticator.authenticate(options)
+    u2f_benchmark(webauthn.authenticate_complete, state, response, user)
+
+
+def test_register_complete(u2f_benchmark, webauthn, devices):
+    user, authenticator = devices
+    options, state = webauthn.register_begin(user)
+    response = VirtualAuthenticator(ORIGIN).register(options)
+    u2f_benchmark(webauthn.register_complete, state, response)
+
+
+def test_get_credentials(u2f_benchmark, devices):
+    user, authenticator = devices
+    u2f_benchmark(U2fDevice.get_credentials, user)
+
+
+def test_verify_token(u2f_benchmark, devices):
+    user, authenticator = devices
+    device = U2fDevice.objects.filter(user=user).first()
+    credential = authenticator.credentials[bytes(device.credential_id)]
+
+    def setup():
+        options = device.generate_challenge()
+        return (authenticator.token(
+            authenticator.authenticate(options, credential)),)
+
+    u2f_benchmark(device.verify_token, setup=setup)
@@ -0,0 +1,274 @@
+from io import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+
+import pytest
+
+from otp_u2f.cache import (
+    ChallengeStore, CredentialCache, get_challenge_store, get_counter_store,
+    get_throttle_store)
+from otp_u2f.executor import VerificationBusy
+from otp_u2f.models import DeviceClonedError, U2fDevice
+
+from .factories import U2fDeviceFactory
+
+CREDENTIAL = 'n8ZklynFZSmYNrICld-ShxDR64QVrov2FEmy-PaHVtVE_WCj1HpLfPMgdDBQEBK5tC7TY3U0iNGTDiWWfxLylg=='  # noqa
+PUBLIC_KEY = 'pQECAyYgASFYIKL35NsyHSsIXBqC2upUvILPoOzkuAPc2x1AT7Mkvm0fIlggJVbR-teZTDVVL7NMRLob3gZmnz0hzloFXHzOukIWIF8='  # noqa
+
+
+@pytest.fixture
+def credential_cache(settings):
+    settings.OTP_U2F_CREDENTIAL_CACHE = 'default'
+    cache.clear()
+    yield CredentialCache('default')
+    cache.clear()
+
+
+@pytest.mark.django_db()
+def test_get_credentials_cached(credential_cache, django_assert_num_queries):
+    device = U2fDeviceFactory(credential=CREDENTIAL, public_key=PUBLIC_KEY)
+    with django_assert_num_queries(1):
+        credentials = U2fDevice.get_credentials(device.user)
+    with django_assert_num_queries(0):
+        assert U2fDevice.get_credentials(device.user) == credentials
+    assert credentials[0].credential_id == device.as_credential().credential_id
+
+
+@pytest.mark.django_db()
+def test_get_credentials_invalidated(
+        credential_cache, django_assert_num_queries):
+    device = U2fDeviceFactory(credential=CREDENTIAL, public_key=PUBLIC_KEY)
+    assert len(U2fDevice.get_credentials(device.user)) == 1
+
+    device.confirmed = False
+    device.save()
+    with django_assert_num_queries(1):
+        assert U2fDevice.get_credentials(device.user) == []
+
+    device.confirmed = True
+    device.save()
+    assert len(U2fDevice.get_credentials(device.user)) == 1
+    device.delete()
+    assert U2fDevice.get_credentials(device.user) == []
+
+
+@pytest.mark.django_db()
+def test_get_credentials_clone_invalidates(credential_cache):
+    device = U2fDeviceFactory(
+        credential=CREDENTIAL, public_key=PUBLIC_KEY, counter=5)
+    assert len(U2fDevice.get_credentials(device.user)) == 1
+    with pytest.raises(DeviceClonedError):
+        device.update_usage_counter(4)
+    assert U2fDevice.get_credentials(device.user) == []
+
+
+def test_single_flight(credential_cache, monkeypatch):
+    monkeypatch.setattr('otp_u2f.cache.CREDENTIAL_LOCK_WAIT', 0.2)
+    key = credential_cache.make_key(1)
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return ['credential']
+
+    # Another worker holds the lock and publishes the result while we wait.
+    cache.add(f'{key}:lock', 1)
+    monkeypatch.setattr(
+        'otp_u2f.cache.time.sleep', lambda s: cache.set(key, ['shared']))
+    assert credential_cache.get_credentials(1, loader) == ['shared']
+    assert calls == []
+
+    # The loading worker never finishes, fall back to loading ourselves.
+    cache.delete(key)
+    monkeypatch.setattr('otp_u2f.cache.time.sleep', lambda s: None)
+    assert credential_cache.get_credentials(1, loader) == ['credential']
+    assert calls == [1]
+
+
+def test_challenge_store(settings):
+    settings.OTP_U2F_CHALLENGE_PREFIX = 'test:'
+    settings.OTP_U2F_CHALLENGE_TIMEOUT = 10
+    store = get_challenge_store()
+    assert store.timeout == 10
+    store.set('abc', {'challenge': 'abc'})
+    assert cache.get('test:abc') == {'challenge': 'abc'}
+    assert store.pop('abc') == {'challenge': 'abc'}
+    # A challenge can only be used once.
+    assert cache.get('test:abc') is None
+    assert store.pop('abc') is None
+    assert store.pop('unknown') is None
+
+
+def test_challenge_store_claimed():
+    store = ChallengeStore()
+    store.set('abc', {'challenge': 'abc'})
+    # A concurrent request claimed the challenge but did not delete it yet.
+    cache.add(store.make_key('abc') + ':lock', 1)
+    assert store.pop('abc') is None
+    cache.clear()
+
+
+@pytest.fixture
+def throttle_store(settings):
+    settings.OTP_U2F_THROTTLE_CACHE = 'default'
+    settings.OTP_U2F_THROTTLE_FLUSH_INTERVAL = 60
+    cache.clear()
+    yield get_throttle_store()
+    cache.clear()
+
+
+@pytest.mark.django_db()
+def test_throttle_store(throttle_store, django_assert_num_queries):
+    device = U2fDeviceFactory(
+        credential=CREDENTIAL, public_key=PUBLIC_KEY,
+        throttling_failure_count=2)
+    # The first failure is written to the database, the following ones
+    # within the flush interval are only counted in the cache.
+    with django_assert_num_queries(1):
+        device.increment_failure_counter()
+    with django_assert_num_queries(0):
+        device.increment_failure_counter()
+    assert device.throttling_failure_count == 4
+    assert throttle_store.get(device.credential_hash) == (
+        4, device.throttling_failure_timestamp)
+    device.refresh_from_db()
+    assert device.throttling_failure_count == 3
+
+    # Throttled attempts are rejected before the device is loaded.
+    with django_assert_num_queries(0):
+        allowed, data = U2fDevice.verify_credential_is_allowed(
+            device.credential_id)
+    assert not allowed
+    assert data['failure_count'] == 4
+    assert not device.verify_is_allowed()[0]
+    assert device.throttling_failure_count == 4
+
+    # A successful authentication resets the store and the database.
+    device.update_usage_counter(device.counter + 1)
+    assert throttle_store.get(device.credential_hash) is None
+    assert U2fDevice.verify_credential_is_allowed(device.credential_id)[0]
+    device.refresh_from_db()
+    assert device.throttling_failure_count == 0
+
+
+@pytest.mark.django_db()
+def test_throttle_store_evicted(throttle_store):
+    device = U2fDeviceFactory(
+        credential=CREDENTIAL, public_key=PUBLIC_KEY)
+    device.increment_failure_counter()
+    device.increment_failure_counter()
+    cache.clear()
+    # The count continues from the last flushed state.
+    device.refresh_from_db()
+    device.increment_failure_counter()
+    assert device.throttling_failure_count == 2
+
+
+@pytest.fixture
+def counter_store(settings):
+    settings.OTP_U2F_COUNTER_CACHE = 'default'
+    settings.OTP_U2F_COUNTER_FLUSH_INTERVAL = 60
+    cache.clear()
+    yield get_counter_store()
+    cache.clear()
+
+
+@pytest.mark.django_db()
+def test_counter_store(counter_store, django_assert_num_queries):
+    device = U2fDeviceFactory(
+        credential=CREDENTIAL, public_key=PUBLIC_KEY, counter=1)
+    # The first counter is written to the database, the following ones
+    # within the flush interval are only stored in the cache.
+    with django_assert_num_queries(1):
+        device.update_usage_counter(2)
+    with django_assert_num_queries(0):
+        device.update_usage_counter(5)
+    assert device.counter == 5
+    device.refresh_from_db()
+    assert device.counter == 2
+
+    # Failures are reset in the database.
+    device.throttling_failure_count = 1
+    with django_assert_num_queries(1):
+        device.update_usage_counter(6)
+    assert device.throttling_failure_count == 0
+
+    # The stale counter of the database is compared to the cache.
+    device.refresh_from_db()
+    with pytest.raises(DeviceClonedError) as excinfo:
+        device.update_usage_counter(6)
+    assert 'expected counter > 6 but got 6 instead' in str(excinfo.value)
+    device.refresh_from_db()
+    assert device.counter == 6
+    assert device.throttling_failure_count == 1
+    assert not device.confirmed
+
+
+@pytest.mark.django_db()
+def test_counter_store_busy(counter_store, monkeypatch):
+    device = U2fDeviceFactory(credential=CREDENTIAL, public_key=PUBLIC_KEY)
+    monkeypatch.setattr('otp_u2f.cache.COUNTER_LOCK_WAIT', 0)
+    cache.set(f'{counter_store.make_key(device.credential_hash)}:lock', 1)
+    with pytest.raises(VerificationBusy):
+        device.update_usage_counter(1)
+    assert counter_store.get_many([device.credential_hash]) == {}
+
+
+@pytest.mark.django_db()
+def test_flush_counters(counter_store):
+    devices = [U2fDeviceFactory(counter=1) for i in range(3)]
+    for device in devices[:2]:
+        device.update_usage_counter(2)
+        device.update_usage_counter(3)
+    # The database counter is ahead of the evicted cache entry.
+    U2fDevice.objects.filter(pk=devices[1].pk).update(counter=4)
+    counter_store.update(devices[2].credential_hash, 7, 1)
+
+    # Only the counters that were not written are flushed.
+    out = StringIO()
+    call_command('u2f_flush_counters', batch_size=2, stdout=out)
+    assert out.getvalue() == 'Updated 1 counters\n'
+    assert [device.counter for device in U2fDevice.objects.order_by('pk')] \
+        == [3, 4, 1]
+    assert U2fDevice.flush_counters() == 0
+
+    # The counters of all devices are read to reconcile.
+    out = StringIO()
+    call_command('u2f_flush_counters', batch_size=2, all=True, stdout=out)
+    assert out.getvalue() == 'Updated 1 counters\n'
+    assert [device.counter for device in U2fDevice.objects.order_by('pk')] \
+        == [3, 4, 7]
+    assert U2fDevice.flush_counters(full=True) == 0
+
+
+@pytest.mark.django_db()
+def test_flush_dirty_counters(counter_store, django_assert_num_queries):
+    devices = [U2fDeviceFactory(counter=1) for i in range(5)]
+    U2fDeviceFactory.create_batch(3)
+    for device in devices:
+        device.update_usage_counter(2)
+        device.update_usage_counter(3)
+        device.update_usage_counter(4)
+    # A device is logged once until it is flushed.
+    assert cache.get('otp_u2f:counter-dirty:last') == 5
+
+    # Three batches of the dirty devices are selected and updated in
+    # a savepoint, the other devices are not read.
+    with django_assert_num_queries(3 * 3 + 5):
+        assert U2fDevice.flush_counters(batch_size=2) == 5
+    assert set(U2fDevice.objects.filter(
+        pk__in=[device.pk for device in devices]).values_list(
+            'counter', flat=True)) == {4}
+    assert U2fDevice.flush_counters() == 0
+
+    # A missing entry is retried once and then skipped.
+    devices[0].update_usage_counter(5)
+    devices[1].update_usage_counter(5)
+    cache.delete('otp_u2f:counter-dirty:6')
+    assert U2fDevice.flush_counters() == 0
+    assert U2fDevice.flush_counters() == 1
+    devices[1].refresh_from_db()
+    assert devices[1].counter == 5
+    devices[0].refresh_from_db()
+    assert devices[0].counter == 4
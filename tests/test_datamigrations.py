@@ -0,0 +1,164 @@
+from io import StringIO
+from types import SimpleNamespace
+
+from django.apps import apps
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+
+import pytest
+
+from otp_u2f import datamigrations
+from otp_u2f.management.commands import u2f_datamigrate
+from otp_u2f.models import U2fDevice
+from otp_u2f.operations import RunPythonChunked, check_unique
+
+from .factories import U2fDeviceFactory
+
+
+def rename(queryset):
+    for device in queryset:
+        queryset.filter(pk=device.pk).update(name=f'Device {device.pk}')
+
+
+@pytest.mark.django_db
+def test_chunks():
+    devices = U2fDeviceFactory.create_batch(7)
+    devices[2].delete()
+    chunks = list(datamigrations.chunks(U2fDevice.objects.all(), 2))
+    pks = [device.pk for device in devices]
+    assert [
+        (list(chunk.values_list('pk', flat=True)), end)
+        for chunk, end in chunks] == [
+        (pks[:2], pks[1]), (pks[3:5], pks[4]), (pks[5:7], pks[6])]
+    assert list(datamigrations.chunks(U2fDevice.objects.none(), 2)) == []
+
+
+@pytest.fixture
+def shared_cache(settings, tmp_path):
+    settings.CACHES = {
+        **settings.CACHES,
+        'shared': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': str(tmp_path / 'cache'),
+        },
+    }
+    settings.OTP_U2F_DATA_MIGRATION = {'CACHE': 'shared'}
+
+
+@pytest.mark.django_db(transaction=True)
+def test_run_resume(shared_cache):
+    devices = U2fDeviceFactory.create_batch(5)
+
+    def interrupt(queryset):
+        if queryset.filter(pk=devices[3].pk).exists():
+            raise KeyboardInterrupt
+        rename(queryset)
+
+    progress = []
+    with pytest.raises(KeyboardInterrupt):
+        datamigrations.run(
+            'rename', U2fDevice.objects.all(), interrupt, batch_size=2,
+            progress=progress.append)
+    assert progress == [devices[1].pk]
+    assert datamigrations.get_checkpoint('rename') == devices[1].pk
+    assert U2fDevice.objects.filter(name__startswith='Device ').count() == 2
+
+    migrated = []
+    datamigrations.run(
+        'rename', U2fDevice.objects.all(),
+        lambda queryset: migrated.extend(queryset), batch_size=2)
+    assert migrated == devices[2:]
+    assert datamigrations.get_checkpoint('rename') is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_run_checkpoint(shared_cache, settings):
+    devices = U2fDeviceFactory.create_batch(4)
+
+    # The checkpoint of another database is not used.
+    datamigrations.set_checkpoint('rename', devices[1].pk, 'other')
+    migrated = []
+    datamigrations.run(
+        'rename', U2fDevice.objects.all(),
+        lambda queryset: migrated.extend(queryset), batch_size=2)
+    assert migrated == devices
+    assert datamigrations.get_checkpoint('rename', 'other') == devices[1].pk
+
+    # The checkpoint is discarded when the rows up to it are not migrated.
+    datamigrations.set_checkpoint('rename', devices[1].pk)
+    U2fDevice.objects.filter(pk=devices[0].pk).update(name='Pending')
+    migrated = []
+    datamigrations.run(
+        'rename', U2fDevice.objects.all(),
+        lambda queryset: migrated.extend(queryset), batch_size=2,
+        pending=lambda queryset: queryset.filter(name='Pending'))
+    assert migrated == devices
+
+    # A cache that is not shared between processes is not used.
+    settings.OTP_U2F_DATA_MIGRATION = {'CACHE': 'default'}
+    datamigrations.set_checkpoint('rename', devices[1].pk)
+    assert datamigrations.get_checkpoint('rename') is None
+
+
+@pytest.mark.django_db
+def test_operation_defer(settings):
+    device = U2fDeviceFactory()
+    operation = RunPythonChunked(
+        'u2fdevice', 'rename', rename, deferrable=True)
+    schema_editor = SimpleNamespace(connection=connection)
+    state = SimpleNamespace(apps=apps)
+
+    settings.OTP_U2F_DATA_MIGRATION = {'DEFER': True}
+    operation.database_forwards('otp_u2f', schema_editor, state, state)
+    device.refresh_from_db()
+    assert device.name != f'Device {device.pk}'
+
+    settings.OTP_U2F_DATA_MIGRATION = {}
+    operation.database_forwards('otp_u2f', schema_editor, state, state)
+    device.refresh_from_db()
+    assert device.name == f'Device {device.pk}'
+
+
+@pytest.mark.django_db
+def test_u2f_datamigrate(monkeypatch):
+    devices = U2fDeviceFactory.create_batch(3)
+    operation = RunPythonChunked(
+        'u2fdevice', 'rename', rename, deferrable=True)
+    monkeypatch.setattr(
+        u2f_datamigrate, 'get_data_migrations',
+        lambda connection: {'rename': ('otp_u2f', operation)})
+
+    stdout = StringIO()
+    call_command('u2f_datamigrate', stdout=stdout)
+    assert stdout.getvalue() == 'rename\n'
+
+    stdout = StringIO()
+    call_command(
+        'u2f_datamigrate', 'rename', batch_size=2, sleep=0, stdout=stdout)
+    assert f'migrated up to pk {devices[1].pk} of {devices[2].pk}' in (
+        stdout.getvalue())
+    assert [device.name for device in U2fDevice.objects.order_by('pk')] == [
+        f'Device {device.pk}' for device in devices]
+
+    with pytest.raises(Exception, match='Unknown data migrations: other'):
+        call_command('u2f_datamigrate', 'other')
+
+
+@pytest.mark.django_db
+def test_get_data_migrations():
+    # The data migrations of this app can not be deferred.
+    assert u2f_datamigrate.get_data_migrations(connection) == {}
+
+
+@pytest.mark.django_db
+def test_check_unique():
+    U2fDeviceFactory(name='Key')
+    U2fDeviceFactory(name='Other')
+    check_unique(U2fDevice.objects.all(), ['name'])
+
+    U2fDeviceFactory.create_batch(2, name='Key')
+    U2fDeviceFactory.create_batch(2, name='Spare')
+    with pytest.raises(IntegrityError, match=r'name in otp_u2f_u2fdevice: Key, Spare$'):  # noqa
+        check_unique(U2fDevice.objects.all(), ['name'])
+    with pytest.raises(IntegrityError, match=r': Key, \.\.\.$'):
+        check_unique(U2fDevice.objects.all(), ['name'], limit=1)
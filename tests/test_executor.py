@@ -0,0 +1,87 @@
+import threading
+
+from asgiref.sync import async_to_sync
+import pytest
+
+from otp_u2f.executor import (
+    VerificationBusy, VerificationExecutor, get_executor)
+from otp_u2f.utils import Webauthn
+
+from .factories import U2fDeviceFactory
+
+STATE = {
+    'challenge': 'bnRQVde1p9L_W70ll7_HOxY3WMRME57IIVJURPr16Sk',
+    'user_verification': None,
+}
+RESPONSE = 'pGlzaWduYXR1cmVYSDBGAiEAjJz5c08jnc4kxvA1mCtd_oUfejhqbpKvp69q1CU6gqICIQDE8HZY1kwAaBOAm_WdhtLH0WUB-rd6FcDIEX477ddhQmxjcmVkZW50aWFsSWRYQJ_GZJcpxWUpmDayApXfkocQ0euEFa6L9hRJsvj2h1bVRP1go9R6S3zzIHQwUBASubQu02N1NIjRkw4lln8S8pZuY2xpZW50RGF0YUpTT05YknsidHlwZSI6IndlYmF1dGhuLmdldCIsImNoYWxsZW5nZSI6ImJuUlFWZGUxcDlMX1c3MGxsN19IT3hZM1dNUk1FNTdJSVZKVVJQcjE2U2siLCJvcmlnaW4iOiJodHRwczovL2xvY2FsaG9zdC5vc3NvLm5pbmphOjUwMDAiLCJjcm9zc09yaWdpbiI6ZmFsc2V9cWF1dGhlbnRpY2F0b3JEYXRhWCUSXIrubSsKmsf2hd4Z9cy0vPwqgMw1u7Eoq5rF5711UQEAAAAE'  # noqa
+
+
+@pytest.fixture
+def device():
+    return U2fDeviceFactory(
+        credential='n8ZklynFZSmYNrICld-ShxDR64QVrov2FEmy-PaHVtVE_WCj1HpLfPMgdDBQEBK5tC7TY3U0iNGTDiWWfxLylg==',  # noqa
+        public_key='pQECAyYgASFYIKL35NsyHSsIXBqC2upUvILPoOzkuAPc2x1AT7Mkvm0fIlggJVbR-teZTDVVL7NMRLob3gZmnz0hzloFXHzOukIWIF8=')  # noqa
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('backend', ['thread', 'process'])
+def test_executor_authenticate_complete(settings, webauthn, device, backend):
+    settings.OTP_U2F_VERIFICATION_EXECUTOR = {
+        'BACKEND': backend, 'MAX_WORKERS': 1}
+    credential, authenticator = Webauthn().authenticate_complete(
+        STATE, webauthn.decode(RESPONSE), device.user)
+    assert credential.aaguid == device.aaguid.bytes
+    assert authenticator.counter == 4
+    assert get_executor().stats()['completed'] == 1
+
+
+@pytest.mark.django_db()
+def test_executor_aauthenticate_complete(settings, webauthn, device):
+    settings.OTP_U2F_VERIFICATION_EXECUTOR = {'MAX_WORKERS': 1}
+    credential, authenticator = async_to_sync(
+        Webauthn().aauthenticate_complete)(
+            STATE, webauthn.decode(RESPONSE), device.user)
+    assert authenticator.counter == 4
+
+
+def test_executor_saturated():
+    executor = VerificationExecutor(max_workers=1, max_queue=1)
+    release = threading.Event()
+    try:
+        running = executor.submit(release.wait)
+        queued = executor.submit(release.wait)
+        with pytest.raises(VerificationBusy):
+            executor.submit(release.wait)
+        stats = executor.stats()
+        assert stats['running'] == 1
+        assert stats['queued'] == 1
+        assert stats['rejected'] == 1
+    finally:
+        release.set()
+    running.result(1)
+    queued.result(1)
+    assert executor.stats()['pending'] == 0
+    assert executor.stats()['completed'] == 2
+    executor.shutdown()
+
+
+def test_executor_timeout():
+    executor = VerificationExecutor(max_workers=1, timeout=0.01)
+    release = threading.Event()
+    try:
+        with pytest.raises(VerificationBusy):
+            executor.run(release.wait)
+    finally:
+        release.set()
+        executor.shutdown()
+
+
+def test_get_executor(settings):
+    settings.OTP_U2F_VERIFICATION_EXECUTOR = None
+    assert get_executor() is None
+    settings.OTP_U2F_VERIFICATION_EXECUTOR = {'MAX_QUEUE': 2}
+    executor = get_executor()
+    assert executor is get_executor()
+    assert executor.max_queue == 2
+    settings.OTP_U2F_VERIFICATION_EXECUTOR = {'MAX_QUEUE': 3}
+    assert get_executor() is not executor
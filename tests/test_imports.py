@@ -0,0 +1,66 @@
+'''
+Import time of the app in a new interpreter.
+
+fido2 and the cryptography backends are only imported when a ceremony runs,
+processes that load the app or its urls but never use them do not pay for
+them.
+'''
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+SETUP = '''
+import json, sys
+import django
+django.setup()
+{imports}
+json.dump(sorted(sys.modules), sys.stdout)
+'''
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_setup(*imports):
+    '''
+    Return the modules that are imported by django.setup() and the imports
+    in a new interpreter.
+    '''
+    env = {
+        **os.environ,
+        'DJANGO_SETTINGS_MODULE': 'tests.settings',
+        'PYTHONPATH': os.pathsep.join(
+            filter(None, [ROOT, os.environ.get('PYTHONPATH')])),
+    }
+    code = SETUP.format(imports='\n'.join(
+        f'import {module}' for module in imports))
+    result = subprocess.run(
+        [sys.executable, '-c', code], env=env, capture_output=True,
+        text=True, check=True)
+    return json.loads(result.stdout)
+
+
+def get_heavy_modules(modules):
+    return [
+        module for module in modules
+        if module.split('.')[0] in ('fido2', 'cryptography')
+        and module not in ('fido2', 'fido2.features')]
+
+
+def test_setup_imports():
+    modules = run_setup()
+    assert 'otp_u2f.models' in modules
+    assert 'otp_u2f.admin' in modules
+    assert get_heavy_modules(modules) == []
+
+    # Nor are they imported by the urls, views and forms.
+    modules = run_setup('otp_u2f.urls', 'otp_u2f.forms', 'otp_u2f.tokens')
+    assert 'otp_u2f.views' in modules
+    assert get_heavy_modules(modules) == []
+
+
+@pytest.mark.u2f_benchmark
+def test_setup_import_time(u2f_benchmark):
+    # Including the startup of the interpreter.
+    u2f_benchmark(run_setup)
@@ -1,16 +1,19 @@
 from base64 import urlsafe_b64decode
+import json
 
 from django.contrib.auth.models import AnonymousUser
-from django.test import RequestFactory
 
 import pytest
 
 from kleides_mfa.registry import registry
 
+from otp_u2f.executor import VerificationBusy, get_executor
 from otp_u2f.forms import (
     U2F_AUTHENTICATION_KEY, U2F_REGISTRATION_KEY, U2fDeviceCreateForm,
     U2fVerifyForm)
-from otp_u2f.views import AuthenticateChallengeView, RegisterChallengeView
+from otp_u2f import tokens
+from otp_u2f.views import (
+    U2F_STATE_HEADER, AuthenticateChallengeView, RegisterChallengeView)
 
 from .factories import U2fDeviceFactory, UserFactory
 
@@ -32,12 +35,6 @@ REG_STATE = {
 REG_DATA = {'otp_token': 'om5jbGllbnREYXRhSlNPTliVeyJ0eXBlIjoid2ViYXV0aG4uY3JlYXRlIiwiY2hhbGxlbmdlIjoiTWpsN3FjN0lSTnJqVWdUc3NmT2RDbTBVejR1Xzk0ZGUwYi1mZVhEQXAtVSIsIm9yaWdpbiI6Imh0dHBzOi8vbG9jYWxob3N0Lm9zc28ubmluamE6NTAwMCIsImNyb3NzT3JpZ2luIjpmYWxzZX1xYXR0ZXN0YXRpb25PYmplY3RY4qNjZm10ZG5vbmVnYXR0U3RtdKBoYXV0aERhdGFYxBJciu5tKwqax_aF3hn1zLS8_CqAzDW7sSirmsXnvXVRQQAAAAAAAAAAAAAAAAAAAAAAAAAAAEBbDIQ3s6clvoqFBL80OfigZuJU9K4jGYrCj7vuv_ycbYEqGjJCVi-4be5LxZrrzxiL-1k0UbuZeFFoLeVS1YKfpQECAyYgASFYIGX54GU6pZBsdbVEw6B7sGCrtKUaHmu62JTMBLd_U64_IlggERQvKwWtfZX8mvREWzv1mrTh2tsLvHlcCCH4247nZpM='}  # noqa
 
 
-@pytest.fixture
-def rfactory(settings):
-    settings.ALLOWED_HOSTS = ['localhost.osso.ninja',  'testserver']
-    return RequestFactory(SERVER_NAME='localhost.osso.ninja')
-
-
 @pytest.mark.django_db()
 def test_plugin():
     plugin = registry.get_plugin('u2f')
@@ -84,6 +81,62 @@ def test_register_challenge_view(rfactory, webauthn):
     assert key['user']['name'] == request.user.username
 
 
+@pytest.mark.django_db()
+def test_json_challenge_views(rfactory, webauthn):
+    request = rfactory.post(
+        '/u2f/auth/challenge/', HTTP_ACCEPT='application/json')
+    request.session = {}
+    view = AuthenticateChallengeView()
+    view.setup(request)
+    view.unverified_user = UserFactory()
+    response = view.post(request)
+    assert response['Content-Type'] == 'application/json'
+    assert response['Vary'] == 'Accept'
+    key = json.loads(response.content)['publicKey']
+    state = request.session[U2F_AUTHENTICATION_KEY]
+    assert key['challenge'] == state['challenge']
+    assert key['extensions'] == {'appid': 'http://localhost.osso.ninja'}
+
+    request = rfactory.post(
+        '/u2f/register/challenge/', HTTP_ACCEPT='application/json')
+    request.session = {}
+    request.user = UserFactory()
+    response = RegisterChallengeView.as_view()(request)
+    key = json.loads(response.content)['publicKey']
+    state = request.session[U2F_REGISTRATION_KEY]
+    assert key['challenge'] == state['challenge']
+    assert key['user']['name'] == request.user.username
+
+
+@pytest.mark.django_db()
+def test_stateless_challenge_views(rfactory, webauthn, settings):
+    settings.OTP_U2F_STATELESS_CHALLENGES = True
+    user = UserFactory()
+    request = rfactory.post('/u2f/auth/challenge/')
+    request.session = {}
+    view = AuthenticateChallengeView()
+    view.setup(request)
+    view.unverified_user = user
+    response = view.post(request)
+    assert response.status_code == 200
+    assert request.session == {}
+    state = tokens.loads(
+        response[U2F_STATE_HEADER], U2F_AUTHENTICATION_KEY, user)
+    key = webauthn.decode(response.content + b'===')['publicKey']
+    assert key['challenge'] == urlsafe_b64decode(state['challenge'] + '===')
+
+    request = rfactory.post('/u2f/register/challenge/')
+    request.session = {}
+    request.user = user
+    response = RegisterChallengeView.as_view()(request)
+    assert response.status_code == 200
+    assert request.session == {}
+    state = tokens.loads(
+        response[U2F_STATE_HEADER], U2F_REGISTRATION_KEY, user)
+    key = webauthn.decode(response.content + b'===')['publicKey']
+    assert key['challenge'] == urlsafe_b64decode(state['challenge'] + '===')
+
+
 @pytest.mark.django_db()
 def test_register_form(rfactory):
     user = UserFactory()
@@ -102,6 +155,19 @@ def test_register_form(rfactory):
     assert device.counter == 0
 
 
+@pytest.mark.django_db()
+def test_register_form_duplicate(rfactory):
+    U2fDeviceFactory(credential=REG_CREDENTIAL, public_key=REG_PUBLIC_KEY)
+    plugin = registry.get_plugin('u2f')
+    request = rfactory.post('/u2f/register/')
+    request.session = {U2F_REGISTRATION_KEY: REG_STATE}
+    request.user = UserFactory()
+
+    form = U2fDeviceCreateForm(data=REG_DATA, plugin=plugin, request=request)
+    assert not form.is_valid()
+    assert 'The device is already registered' in form.errors['__all__']
+
+
 @pytest.mark.django_db()
 def test_register_form_failure(rfactory):
     user = UserFactory()
@@ -121,6 +187,13 @@ def test_register_form_failure(rfactory):
     assert not form.is_valid()
     assert 'The registration request is invalid' in form.errors['__all__']
 
+    request.session = {U2F_REGISTRATION_KEY: REG_STATE}
+    form = U2fDeviceCreateForm(
+        data={'otp_token': '{"rawId": "AA", "response": []}'},
+        plugin=plugin, request=request)
+    assert not form.is_valid()
+    assert 'The registration request is invalid' in form.errors['__all__']
+
     request = rfactory.get('/u2f/create/', SERVER_NAME='testserver')
     request.session = {U2F_REGISTRATION_KEY: REG_STATE}
     request.user = user
@@ -183,6 +256,14 @@ def test_authenticate_form_failure(rfactory, settings):
     assert not form.is_valid()
     assert 'The authentication request is invalid' in form.errors['__all__']
 
+    for token in ('{"response": {}}', '{"rawId": "AA", "response": []}'):
+        request.session = {U2F_AUTHENTICATION_KEY: AUTH_STATE}
+        form = U2fVerifyForm(
+            data={'otp_token': token}, device=device, unverified_user=user,
+            plugin=plugin, request=request)
+        assert not form.is_valid()
+        assert 'The authentication request is invalid' in form.errors['__all__']  # noqa
+
     request.session = {U2F_AUTHENTICATION_KEY: AUTH_STATE}
     # Test authenticator counter.
     form = U2fVerifyForm(
@@ -191,3 +272,115 @@ def test_authenticate_form_failure(rfactory, settings):
     assert not form.is_valid()
     assert not form.device.confirmed
     assert f'Device authentication failure (reason: Device appears to be cloned, expected counter > 5 but got 4 instead. The device otp_u2f.u2fdevice/{device.pk} has been disabled.)' in form.errors['__all__']  # noqa
+
+
+@pytest.mark.django_db()
+def test_authenticate_form_busy(rfactory, settings, monkeypatch):
+    device = U2fDeviceFactory(
+        credential=AUTH_CREDENTIAL, public_key=AUTH_PUBLIC_KEY)
+    plugin = registry.get_plugin('u2f')
+    request = rfactory.post('/u2f/authenticate/')
+    request.session = {U2F_AUTHENTICATION_KEY: AUTH_STATE}
+    request.user = AnonymousUser()
+
+    # A saturated executor rejects the verification without counting it as
+    # a failure of the device.
+    def run(*args):
+        raise VerificationBusy('Too many pending verifications')
+
+    settings.OTP_U2F_VERIFICATION_EXECUTOR = {}
+    monkeypatch.setattr(get_executor(), 'run', run)
+    form = U2fVerifyForm(
+        data=AUTH_DATA, device=device, unverified_user=device.user,
+        plugin=plugin, request=request)
+    assert not form.is_valid()
+    assert 'The server is busy, try again' in form.errors['__all__']
+    device.refresh_from_db()
+    assert device.throttling_failure_count == 0
+
+
+@pytest.mark.django_db()
+def test_stateless_forms(rfactory, settings):
+    settings.OTP_U2F_STATELESS_CHALLENGES = True
+    user = UserFactory()
+    plugin = registry.get_plugin('u2f')
+    request = rfactory.post('/u2f/register/')
+    request.session = {U2F_REGISTRATION_KEY: REG_STATE}
+    request.user = user
+
+    # The session state is not used.
+    form = U2fDeviceCreateForm(data=REG_DATA, plugin=plugin, request=request)
+    assert not form.is_valid()
+    assert 'The registration request has expired, try again' in form.errors['__all__']  # noqa
+
+    data = dict(REG_DATA, otp_state=tokens.dumps(
+        REG_STATE, U2F_REGISTRATION_KEY, user))
+    form = U2fDeviceCreateForm(data=data, plugin=plugin, request=request)
+    assert form.is_valid(), form.errors
+    assert request.session == {U2F_REGISTRATION_KEY: REG_STATE}
+    form.save()
+
+    device = U2fDeviceFactory(
+        credential=AUTH_CREDENTIAL, public_key=AUTH_PUBLIC_KEY)
+    request = rfactory.post('/u2f/authenticate/')
+    request.session = {}
+    request.user = AnonymousUser()
+    data = dict(AUTH_DATA, otp_state=tokens.dumps(
+        AUTH_STATE, U2F_AUTHENTICATION_KEY, device.user))
+    form = U2fVerifyForm(
+        data=data, device=device, unverified_user=device.user,
+        plugin=plugin, request=request)
+    assert form.is_valid(), form.errors
+    assert form.device.counter == 4
+
+    # The token can not be replayed.
+    form = U2fVerifyForm(
+        data=data, device=device, unverified_user=device.user,
+        plugin=plugin, request=request)
+    assert not form.is_valid()
+    assert 'The authentication request has expired, try again' in form.errors['__all__']  # noqa
+
+
+@pytest.mark.django_db()
+def test_inline_challenge(rfactory, webauthn, settings):
+    device = U2fDeviceFactory(
+        credential=AUTH_CREDENTIAL, public_key=AUTH_PUBLIC_KEY)
+    plugin = registry.get_plugin('u2f')
+    request = rfactory.get('/u2f/authenticate/')
+    request.session = {}
+    request.user = AnonymousUser()
+
+    form = U2fVerifyForm(
+        device=device, unverified_user=device.user, plugin=plugin,
+        request=request)
+    assert form.inline_challenge is None
+
+    settings.OTP_U2F_INLINE_CHALLENGE = True
+    form = U2fVerifyForm(
+        device=device, unverified_user=device.user, plugin=plugin,
+        request=request)
+    challenge = form.inline_challenge
+    assert challenge['state'] == ''
+    state = request.session[U2F_AUTHENTICATION_KEY]
+    key = webauthn.decode(challenge['options'] + '===')['publicKey']
+    assert key['challenge'] == urlsafe_b64decode(state['challenge'] + '===')
+    assert len(key['allowCredentials']) == 1
+    assert challenge['json']['publicKey']['challenge'] == state['challenge']
+
+    settings.OTP_U2F_STATELESS_CHALLENGES = True
+    request.session = {}
+    form = U2fVerifyForm(
+        device=device, unverified_user=device.user, plugin=plugin,
+        request=request)
+    challenge = form.inline_challenge
+    assert request.session == {}
+    state = tokens.loads(
+        challenge['state'], U2F_AUTHENTICATION_KEY, device.user)
+    key = webauthn.decode(challenge['options'] + '===')['publicKey']
+    assert key['challenge'] == urlsafe_b64decode(state['challenge'] + '===')
+
+    # Bound forms use the challenge endpoint to try again.
+    form = U2fVerifyForm(
+        data={}, device=device, unverified_user=device.user, plugin=plugin,
+        request=request)
+    assert form.inline_challenge is None
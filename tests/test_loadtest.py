@@ -0,0 +1,37 @@
+from io import StringIO
+
+from django.core.management import call_command
+
+import pytest
+
+from otp_u2f.models import U2fDevice
+
+
+@pytest.mark.django_db(transaction=True)
+def test_u2f_loadtest(settings):
+    settings.PASSWORD_HASHERS = [
+        'django.contrib.auth.hashers.MD5PasswordHasher']
+    stdout = StringIO()
+    call_command(
+        'u2f_loadtest', users=1, duration=0.5, register=True, stdout=stdout)
+    output = stdout.getvalue()
+    for phase in ('login', 'authenticate', 'verify', 'register', 'create'):
+        assert f'\n{phase} ' in output
+    assert 'error:' not in output
+    assert 'counter is' not in output
+    # The users and devices are removed.
+    assert not U2fDevice.objects.exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_u2f_loadtest_shared_device(settings):
+    settings.PASSWORD_HASHERS = [
+        'django.contrib.auth.hashers.MD5PasswordHasher']
+    stdout = StringIO()
+    call_command(
+        'u2f_loadtest', users=1, duration=0.5, shared_device=True,
+        keep=True, stdout=stdout)
+    device = U2fDevice.objects.get()
+    assert device.confirmed
+    assert device.counter > 0
+    assert f'{device.counter} logins' in stdout.getvalue()
@@ -0,0 +1,185 @@
+from base64 import b64encode
+import datetime
+import json
+import os
+from uuid import UUID, uuid4
+
+from django.urls import reverse
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.x509.oid import NameOID
+
+from fido2.utils import websafe_encode
+
+import pytest
+
+from otp_u2f import metadata
+from otp_u2f.models import U2fDevice
+from otp_u2f.testing import VirtualAuthenticator
+
+from .factories import UserFactory
+
+ORIGIN = 'https://localhost.osso.ninja'
+
+
+def make_certificate(name, key, issuer=None, issuer_key=None):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)])
+    return x509.CertificateBuilder().subject_name(subject).issuer_name(
+        issuer.subject if issuer else subject).public_key(
+        key.public_key()).serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - datetime.timedelta(days=1)) \
+        .not_valid_after(now + datetime.timedelta(days=1)) \
+        .add_extension(
+            x509.BasicConstraints(ca=issuer is None, path_length=None),
+            critical=True) \
+        .sign(issuer_key or key, hashes.SHA256())
+
+
+def make_blob(entries, key=None, chain=()):
+    header = {'alg': 'ES256', 'typ': 'JWT', 'x5c': [
+        b64encode(cert.public_bytes(Encoding.DER)).decode()
+        for cert in chain]}
+    payload = {'no': 1, 'nextUpdate': '2030-01-01', 'entries': entries}
+    message = '.'.join(
+        websafe_encode(json.dumps(part).encode())
+        for part in (header, payload)).encode()
+    signature = key.sign(message, ec.ECDSA(hashes.SHA256())) if key else b'-'
+    return message + b'.' + websafe_encode(signature).encode()
+
+
+def make_entry(aaguid, description, status='FIDO_CERTIFIED'):
+    return {
+        'aaguid': str(aaguid),
+        'metadataStatement': {
+            'aaguid': str(aaguid),
+            'description': description,
+            'attestationRootCertificates': [],
+        },
+        'statusReports': [
+            {'status': 'NOT_FIDO_CERTIFIED'}, {'status': status}],
+    }
+
+
+@pytest.fixture
+def blob(tmp_path, settings):
+    path = tmp_path / 'blob.jwt'
+    settings.OTP_U2F_METADATA = {'PATH': str(path)}
+    return path
+
+
+def test_metadata_index(blob):
+    aaguid = uuid4()
+    blob.write_bytes(make_blob([
+        make_entry(aaguid, 'Security Key'),
+        # Entries without an aaguid are skipped.
+        {'aaguidless': True, 'statusReports': []},
+    ]))
+    index = metadata.get_metadata()
+    assert len(index) == 1
+    assert index.get(aaguid) == ('Security Key', 'FIDO_CERTIFIED', ())
+    assert index.get(uuid4()) is None
+    # The blob is parsed once.
+    assert metadata.get_metadata() is index
+
+    # A changed blob is parsed again.
+    blob.write_bytes(make_blob([make_entry(aaguid, 'Security Key 2')]))
+    stat = blob.stat()
+    os.utime(blob, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    index = metadata.get_metadata()
+    assert index.get(aaguid).description == 'Security Key 2'
+
+    # An invalid blob keeps the previous index.
+    blob.write_bytes(b'invalid')
+    assert metadata.get_metadata() is index
+
+
+def test_metadata_signature(blob, tmp_path, settings):
+    root_key = ec.generate_private_key(ec.SECP256R1())
+    root = make_certificate('Root', root_key)
+    leaf_key = ec.generate_private_key(ec.SECP256R1())
+    leaf = make_certificate('Leaf', leaf_key, root, root_key)
+    trust_root = tmp_path / 'root.pem'
+    trust_root.write_bytes(root.public_bytes(Encoding.PEM))
+    settings.OTP_U2F_METADATA = {
+        'PATH': str(blob), 'TRUST_ROOT': str(trust_root)}
+
+    aaguid = uuid4()
+    blob.write_bytes(make_blob(
+        [make_entry(aaguid, 'Security Key')], leaf_key, [leaf]))
+    assert metadata.get_metadata().get(aaguid).description == 'Security Key'
+
+    # The blob must be signed by the trust root.
+    other_key = ec.generate_private_key(ec.SECP256R1())
+    blob.write_bytes(make_blob(
+        [make_entry(aaguid, 'Forged Key')], other_key,
+        [make_certificate('Leaf', other_key)]))
+    index = metadata.MetadataIndex.parse(blob.read_bytes())
+    assert index.get(aaguid).description == 'Forged Key'
+    with pytest.raises(Exception):
+        metadata.MetadataIndex.parse(
+            blob.read_bytes(), metadata.read_certificate(str(trust_root)))
+
+
+@pytest.mark.django_db()
+def test_register_policy(webauthn, blob, settings):
+    user = UserFactory()
+    known, revoked, unknown = uuid4(), uuid4(), uuid4()
+    blob.write_bytes(make_blob([
+        make_entry(known, 'Security Key'),
+        make_entry(revoked, 'Revoked Key', 'REVOKED'),
+    ]))
+
+    def register(aaguid):
+        authenticator = VirtualAuthenticator(ORIGIN, aaguid.bytes)
+        options, state = webauthn.register_begin(user)
+        return webauthn.register_complete(
+            state, authenticator.register(options))
+
+    assert register(known).credential_data.aaguid == known.bytes
+    assert register(unknown).credential_data.aaguid == unknown.bytes
+    with pytest.raises(ValueError, match='status is REVOKED'):
+        register(revoked)
+
+    settings.OTP_U2F_METADATA = {'PATH': str(blob), 'REQUIRE_METADATA': True}
+    with pytest.raises(ValueError, match='unknown'):
+        register(unknown)
+
+    settings.OTP_U2F_METADATA = {
+        'PATH': str(blob), 'DENIED_AAGUIDS': [str(known)]}
+    with pytest.raises(ValueError, match='not allowed'):
+        register(known)
+
+    settings.OTP_U2F_METADATA = {'ALLOWED_AAGUIDS': [known]}
+    register(known)
+    with pytest.raises(ValueError, match='not allowed'):
+        register(unknown)
+
+    # Self attestation can not be verified with the metadata.
+    settings.OTP_U2F_METADATA = {
+        'PATH': str(blob), 'VERIFY_ATTESTATION': True}
+    with pytest.raises(ValueError, match='attestation'):
+        register(known)
+
+
+@pytest.mark.django_db()
+def test_admin_authenticator(client, blob):
+    aaguid = UUID('2fc0579f-8113-47ea-b116-bb5a8db9202a')
+    blob.write_bytes(make_blob([make_entry(aaguid, 'YubiKey 5 NFC')]))
+    admin = UserFactory(is_staff=True, is_superuser=True)
+    client.force_login(admin)
+    device = U2fDevice.objects.create(
+        user=admin, name='Key', aaguid=aaguid, credential_id=b'1',
+        public_key_data=b'')
+    U2fDevice.objects.create(
+        user=admin, name='Other', aaguid=uuid4(), credential_id=b'2',
+        public_key_data=b'')
+
+    response = client.get(reverse('admin:otp_u2f_u2fdevice_changelist'))
+    assert response.content.count(b'YubiKey 5 NFC') == 1
+    response = client.get(reverse(
+        'admin:otp_u2f_u2fdevice_change', args=[device.pk]))
+    assert b'YubiKey 5 NFC' in response.content
@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from otp_u2f import metrics
+from otp_u2f.models import U2fDevice
+from otp_u2f.testing import VirtualAuthenticator
+from otp_u2f.views import PrometheusMetricsView
+
+from .factories import UserFactory
+
+
+@pytest.fixture
+def backend(settings):
+    settings.OTP_U2F_METRICS_BACKEND = 'otp_u2f.metrics.PrometheusBackend'
+    return metrics.get_backend()
+
+
+def test_prometheus_backend():
+    backend = metrics.PrometheusBackend(buckets=[0.1, 1])
+    backend.increment('requests_total', labels={'path': '/"\\\n'})
+    backend.increment('requests_total', 2, labels={'path': '/"\\\n'})
+    backend.observe('latency_seconds', 0.1)
+    backend.observe('latency_seconds', 0.5)
+    backend.observe('latency_seconds', 5)
+    assert backend.render() == (
+        '# TYPE requests_total counter\n'
+        'requests_total{path="/\\"\\\\\\n"} 3\n'
+        '# TYPE latency_seconds histogram\n'
+        'latency_seconds_bucket{le="0.1"} 1\n'
+        'latency_seconds_bucket{le="1"} 2\n'
+        'latency_seconds_bucket{le="+Inf"} 3\n'
+        'latency_seconds_sum 5.6\n'
+        'latency_seconds_count 3\n')
+
+
+def test_disabled_backend(settings):
+    settings.OTP_U2F_METRICS_BACKEND = None
+    assert metrics.get_backend() is None
+    metrics.increment(metrics.CHALLENGES)
+    with metrics.timer(metrics.CHALLENGE_SECONDS):
+        pass
+
+
+@pytest.mark.parametrize('fail', [False, True])
+def test_timed(backend, fail):
+    def run():
+        if fail:
+            raise ValueError
+
+    async def arun():
+        run()
+
+    name = f'call_{"fail" if fail else "success"}'
+    timed = metrics.timed(f'{name}_seconds', f'{name}_total', purpose='test')
+    for function in (timed(run), lambda: asyncio.run(timed(arun)())):
+        try:
+            function()
+        except ValueError:
+            assert fail
+
+    labels = (('purpose', 'test'),)
+    # Failed calls are observed but not counted.
+    assert backend.histograms[(f'{name}_seconds', labels)]['count'] == 2
+    assert backend.counters.get((f'{name}_total', labels), 0) == (
+        0 if fail else 2)
+
+
+@pytest.mark.django_db()
+def test_verification_metrics(backend, webauthn):
+    authenticator = VirtualAuthenticator('https://localhost.osso.ninja')
+    device = U2fDevice.objects.create(
+        user=UserFactory(),
+        **authenticator.create_credential().device_kwargs(webauthn.rp_id))
+
+    token = authenticator.token(
+        authenticator.authenticate(device.generate_challenge()))
+    assert device.verify_token(token)
+    assert not device.verify_token(token)
+    U2fDevice.objects.filter(pk=device.pk).update(counter=10)
+    token = authenticator.token(
+        authenticator.authenticate(device.generate_challenge()))
+    assert not device.verify_token(token)
+
+    counters = backend.counters
+    labels = (('purpose', 'authenticate'),)
+    assert counters[(metrics.CHALLENGES, labels)] == 2
+    assert counters[(metrics.CHALLENGE_MISSES, (('purpose', 'token'),))] == 1
+    assert counters[(metrics.VERIFICATIONS, (('result', 'success'),))] == 1
+    assert counters[(metrics.VERIFICATIONS, (('result', 'cloned'),))] == 1
+    assert counters[(metrics.CLONE_DETECTIONS, ())] == 1
+    histograms = backend.histograms
+    assert histograms[(metrics.CHALLENGE_SECONDS, labels)]['count'] == 2
+    assert histograms[(
+        metrics.SIGNATURE_SECONDS, (('operation', 'assertion'),))
+    ]['count'] == 2
+    assert histograms[(metrics.COUNTER_UPDATE_SECONDS, ())]['count'] == 2
+    assert histograms[(
+        metrics.CREDENTIALS_SECONDS, (('source', 'database'),))
+    ]['count'] == 4
+
+
+def test_prometheus_metrics_view(rfactory, settings, backend):
+    backend.increment(metrics.THROTTLED)
+    response = PrometheusMetricsView.as_view()(rfactory.get('/metrics'))
+    assert response['Content-Type'] == 'text/plain; version=0.0.4'
+    assert b'otp_u2f_throttled_total 1' in response.content
@@ -0,0 +1,186 @@
+from base64 import urlsafe_b64decode
+
+from django.core.cache import cache
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+import pytest
+
+from otp_u2f.cache import get_challenge_store
+from otp_u2f.models import DeviceClonedError, U2fDevice, hash_credential
+from otp_u2f.testing import VirtualCredential
+
+from .factories import U2fDeviceFactory
+
+CREDENTIAL = 'n8ZklynFZSmYNrICld-ShxDR64QVrov2FEmy-PaHVtVE_WCj1HpLfPMgdDBQEBK5tC7TY3U0iNGTDiWWfxLylg=='  # noqa
+PUBLIC_KEY = 'pQECAyYgASFYIKL35NsyHSsIXBqC2upUvILPoOzkuAPc2x1AT7Mkvm0fIlggJVbR-teZTDVVL7NMRLob3gZmnz0hzloFXHzOukIWIF8='  # noqa
+
+
+@pytest.mark.django_db()
+def test_binary_credential():
+    device = U2fDeviceFactory(credential=CREDENTIAL, public_key=PUBLIC_KEY)
+    device.refresh_from_db()
+    assert bytes(device.credential_id) == urlsafe_b64decode(CREDENTIAL)
+    assert bytes(device.public_key_data) == urlsafe_b64decode(PUBLIC_KEY)
+    assert device.credential_hash == hash_credential(
+        urlsafe_b64decode(CREDENTIAL))
+    # The base64 representation is still available.
+    assert device.credential == CREDENTIAL
+    assert device.public_key == PUBLIC_KEY
+    # Missing padding is accepted.
+    device.credential = CREDENTIAL.rstrip('=')
+    assert device.credential == CREDENTIAL
+
+
+@pytest.mark.django_db()
+def test_get_device():
+    device = U2fDeviceFactory(credential=CREDENTIAL, public_key=PUBLIC_KEY)
+    U2fDeviceFactory(user=device.user)
+    credential_id = urlsafe_b64decode(CREDENTIAL)
+    assert U2fDevice.get_device(device.user, credential_id) == device
+    with pytest.raises(U2fDevice.DoesNotExist):
+        U2fDevice.get_device(device.user, credential_id[:-1])
+
+    device.confirmed = False
+    device.save(update_fields=['confirmed'])
+    with pytest.raises(U2fDevice.DoesNotExist):
+        U2fDevice.get_device(device.user, credential_id)
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('credential_cache', [None, 'default'])
+def test_rp_ids(settings, credential_cache):
+    settings.OTP_U2F_CREDENTIAL_CACHE = credential_cache
+    cache.clear()
+    device = U2fDeviceFactory(
+        **VirtualCredential().device_kwargs('example.com'))
+    legacy_device = U2fDeviceFactory(
+        user=device.user,
+        **VirtualCredential('U2F_V2').device_kwargs('https://example.com'))
+    other_device = U2fDeviceFactory(
+        user=device.user, **VirtualCredential().device_kwargs('example.org'))
+    rp_ids = ('example.com', 'https://example.com')
+
+    def credential_ids(*args):
+        return {
+            credential.credential_id
+            for credential in U2fDevice.get_credentials(*args)}
+
+    assert credential_ids(device.user, rp_ids) == {
+        device.credential_id, legacy_device.credential_id}
+    assert credential_ids(device.user) == {
+        device.credential_id, legacy_device.credential_id,
+        other_device.credential_id}
+    assert U2fDevice.get_device(
+        device.user, device.credential_id, rp_ids) == device
+    with pytest.raises(U2fDevice.DoesNotExist):
+        U2fDevice.get_device(device.user, other_device.credential_id, rp_ids)
+    with pytest.raises(U2fDevice.DoesNotExist):
+        U2fDevice.get_discoverable_device(
+            other_device.credential_id, str(device.user.pk).encode(), rp_ids)
+    cache.clear()
+
+
+@pytest.mark.django_db(transaction=True, databases=['default', 'replica'])
+def test_read_replicas(settings):
+    settings.OTP_U2F_READ_REPLICAS = {'DATABASES': ['replica']}
+    cache.clear()
+    device = U2fDeviceFactory(credential=CREDENTIAL, public_key=PUBLIC_KEY)
+    credential_id = urlsafe_b64decode(CREDENTIAL)
+
+    def reads(alias, function, *args):
+        with CaptureQueriesContext(connections[alias]) as queries:
+            function(*args)
+        return len(queries)
+
+    # The registration pins the user to the primary.
+    assert reads('default', U2fDevice.get_credentials, device.user) == 1
+    cache.clear()
+    assert reads('replica', U2fDevice.get_credentials, device.user) == 1
+    assert reads('replica', U2fDevice.get_device, device.user, credential_id)
+    replica_device = U2fDevice.get_device(device.user, credential_id)
+    # Writes of the device go to the primary.
+    assert replica_device._state.db == 'default'
+
+    replica_device.update_usage_counter(1)
+    assert reads('default', U2fDevice.get_device, device.user, credential_id)
+    cache.clear()
+    assert reads(
+        'replica', U2fDevice.get_discoverable_device, credential_id,
+        str(device.user_id).encode())
+
+
+@pytest.fixture(params=[True, False], ids=['returning', 'fallback'])
+def update_returning(request, monkeypatch):
+    if not request.param:
+        monkeypatch.setattr(
+            'otp_u2f.db.supports_update_returning', lambda connection: False)
+    return request.param
+
+
+@pytest.mark.django_db()
+def test_update_usage_counter(update_returning, django_assert_num_queries):
+    device = U2fDeviceFactory(
+        counter=1, throttling_failure_count=2,
+        throttling_failure_timestamp=timezone.now())
+    with django_assert_num_queries(1):
+        device.update_usage_counter(5)
+    assert device.counter == 5
+    assert device.throttling_failure_count == 0
+    assert device.throttling_failure_timestamp is None
+    device.refresh_from_db()
+    assert device.counter == 5
+    assert device.throttling_failure_count == 0
+    assert device.throttling_failure_timestamp is None
+    assert device.confirmed
+
+
+@pytest.mark.django_db()
+def test_update_usage_counter_cloned(update_returning):
+    device = U2fDeviceFactory(counter=5)
+    # The stale in-memory counter is replaced by the stored counter.
+    device.counter = 0
+    with pytest.raises(DeviceClonedError) as excinfo:
+        device.update_usage_counter(5)
+    assert 'expected counter > 5 but got 5 instead' in str(excinfo.value)
+    assert device.counter == 5
+    assert device.throttling_failure_count == 1
+    assert not device.confirmed
+    device.refresh_from_db()
+    assert device.counter == 5
+    assert device.throttling_failure_count == 1
+    assert device.throttling_failure_timestamp is not None
+    assert not device.confirmed
+
+
+@pytest.mark.django_db()
+def test_increment_failure_counter(update_returning):
+    device = U2fDeviceFactory()
+    U2fDevice.objects.filter(pk=device.pk).update(throttling_failure_count=3)
+    device.increment_failure_counter()
+    assert device.throttling_failure_count == 4
+    assert device.throttling_failure_timestamp is not None
+    device.refresh_from_db()
+    assert device.throttling_failure_count == 4
+
+    U2fDevice.objects.filter(pk=device.pk).delete()
+    with pytest.raises(U2fDevice.DoesNotExist):
+        device.increment_failure_counter()
+
+
+@pytest.mark.django_db()
+def test_verify_token(monkeypatch):
+    device = U2fDeviceFactory(credential=CREDENTIAL, public_key=PUBLIC_KEY)
+    monkeypatch.setattr(
+        U2fDevice, 'verify_webauthn', lambda self, state, response: True)
+    get_challenge_store().set('abc', {'challenge': 'abc'})
+    token = device.webauthn.encode({
+        'clientData': {'challenge': 'abc'},
+        'credentialId': urlsafe_b64decode(CREDENTIAL)})
+    assert device.verify_token(token)
+    # The challenge can not be replayed.
+    assert not device.verify_token(token)
+    assert not device.verify_token('invalid')
+    assert not device.verify_token('{"response": {}}')
+    assert not device.verify_token('{"rawId": "AA", "response": []}')
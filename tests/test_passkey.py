@@ -0,0 +1,173 @@
+from django.contrib.auth.models import AnonymousUser
+from django.test import Client
+
+import pytest
+
+from kleides_mfa.views.mixins import VERIFIED_SESSION_KEY
+
+from otp_u2f.forms import U2F_PASSKEY_KEY, U2fPasskeyForm
+from otp_u2f.models import U2fDevice
+from otp_u2f.testing import VirtualAuthenticator, encode
+from otp_u2f import tokens
+
+from .factories import UserFactory
+
+ORIGIN = 'https://localhost.osso.ninja'
+
+
+@pytest.fixture
+def passkey(webauthn, settings):
+    settings.OTP_U2F_PASSKEY_LOGIN = True
+    user = UserFactory()
+    authenticator = VirtualAuthenticator(ORIGIN)
+    credential = authenticator.create_credential(
+        user_handle=str(user.pk).encode())
+    device = U2fDevice.objects.create(
+        user=user, name='Passkey',
+        **credential.device_kwargs(webauthn.rp_id))
+    return device, authenticator
+
+
+@pytest.mark.django_db()
+def test_register_resident_key(webauthn, settings):
+    user = UserFactory()
+    options, state = webauthn.register_begin(user)
+    selection = options['publicKey']['authenticatorSelection']
+    assert selection['residentKey'] == 'discouraged'
+
+    settings.OTP_U2F_PASSKEY_LOGIN = True
+    options, state = webauthn.register_begin(user)
+    selection = options['publicKey']['authenticatorSelection']
+    assert selection['residentKey'] == 'preferred'
+
+
+@pytest.mark.django_db()
+def test_passkey_form(rfactory, webauthn, passkey):
+    device, authenticator = passkey
+    request = rfactory.post('/u2f/passkey/login/')
+    request.session = {}
+    options, state = webauthn.passkey_begin()
+    key = options['publicKey']
+    assert 'allowCredentials' not in key
+    assert key['userVerification'] == 'required'
+
+    request.session = {U2F_PASSKEY_KEY: state}
+    response = authenticator.authenticate(options)
+    form = U2fPasskeyForm(request, data={'otp_token': encode(response)})
+    assert form.is_valid(), form.errors
+    assert form.get_user() == device.user
+    assert form.get_device() == device
+    device.refresh_from_db()
+    assert device.counter == 1
+
+    # The user handle must match the user of the device.
+    options, state = webauthn.passkey_begin()
+    request.session = {U2F_PASSKEY_KEY: state}
+    response = authenticator.authenticate(options)
+    response['userHandle'] = b'0'
+    form = U2fPasskeyForm(request, data={'otp_token': encode(response)})
+    assert not form.is_valid()
+    assert 'The device is not available' in form.errors['__all__']
+    assert form.get_user() is None
+
+    # Inactive users can not log in.
+    device.user.is_active = False
+    device.user.save()
+    options, state = webauthn.passkey_begin()
+    request.session = {U2F_PASSKEY_KEY: state}
+    response = authenticator.authenticate(options)
+    form = U2fPasskeyForm(request, data={'otp_token': encode(response)})
+    assert not form.is_valid()
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('counter_cache', [None, 'default'])
+def test_passkey_zero_counter(rfactory, webauthn, settings, counter_cache):
+    settings.OTP_U2F_PASSKEY_LOGIN = True
+    settings.OTP_U2F_COUNTER_CACHE = counter_cache
+    user = UserFactory()
+    authenticator = VirtualAuthenticator(ORIGIN)
+    credential = authenticator.create_credential(
+        user_handle=str(user.pk).encode(), fixed_counter=True)
+    device = U2fDevice.objects.create(
+        user=user, name='Passkey',
+        **credential.device_kwargs(webauthn.rp_id))
+    request = rfactory.post('/u2f/passkey/login/')
+
+    # Synced passkeys always report a counter of 0.
+    for i in range(2):
+        options, state = webauthn.passkey_begin()
+        request.session = {U2F_PASSKEY_KEY: state}
+        response = authenticator.authenticate(options)
+        form = U2fPasskeyForm(request, data={'otp_token': encode(response)})
+        assert form.is_valid(), form.errors
+    device.refresh_from_db()
+    assert device.confirmed
+    assert device.counter == 0
+
+    # A counter of 0 after a higher counter is a clone.
+    device.counter = 5
+    device.save()
+    options, state = webauthn.passkey_begin()
+    request.session = {U2F_PASSKEY_KEY: state}
+    response = authenticator.authenticate(options)
+    form = U2fPasskeyForm(request, data={'otp_token': encode(response)})
+    assert not form.is_valid()
+    device.refresh_from_db()
+    assert not device.confirmed
+
+
+@pytest.mark.django_db()
+def test_passkey_stateless_form(rfactory, webauthn, passkey, settings):
+    settings.OTP_U2F_STATELESS_CHALLENGES = True
+    device, authenticator = passkey
+    request = rfactory.post('/u2f/passkey/login/')
+    request.session = {}
+    options, state = webauthn.passkey_begin()
+    data = {
+        'otp_token': encode(authenticator.authenticate(options)),
+        'otp_state': tokens.dumps(state, U2F_PASSKEY_KEY, AnonymousUser()),
+    }
+    form = U2fPasskeyForm(request, data=data)
+    assert form.is_valid(), form.errors
+    assert form.get_user() == device.user
+
+
+@pytest.mark.django_db()
+def test_passkey_views(webauthn, passkey, settings):
+    device, authenticator = passkey
+    client = Client(HTTP_HOST='localhost.osso.ninja')
+    settings.ALLOWED_HOSTS = ['localhost.osso.ninja']
+
+    settings.OTP_U2F_PASSKEY_LOGIN = False
+    assert client.post('/u2f/passkey/', secure=True).status_code == 404
+    assert client.get('/u2f/passkey/login/', secure=True).status_code == 404
+
+    settings.OTP_U2F_PASSKEY_LOGIN = True
+    response = client.get('/u2f/passkey/login/', secure=True)
+    assert response.status_code == 200
+    assert b'u2f-passkey-form' in response.content
+
+    response = client.post('/u2f/passkey/', secure=True)
+    assert response.status_code == 200
+    options = webauthn.decode(response.content + b'===')
+    assert 'allowCredentials' not in options['publicKey']
+
+    response = client.post(
+        '/u2f/passkey/login/?next=/done/',
+        {'otp_token': encode(authenticator.authenticate(options))},
+        secure=True)
+    assert response.status_code == 302
+    assert response['Location'] == '/done/'
+    assert client.session['_auth_user_id'] == str(device.user.pk)
+    assert VERIFIED_SESSION_KEY in client.session
+    assert client.session['otp_device_id'] == device.persistent_id
+
+    # The challenge is used once.
+    client.logout()
+    response = client.post(
+        '/u2f/passkey/login/',
+        {'otp_token': encode(authenticator.authenticate(options))},
+        secure=True)
+    assert response.status_code == 200
+    assert b'The authentication request has expired' in response.content
@@ -0,0 +1,81 @@
+import pytest
+
+from otp_u2f.models import U2fDevice
+from otp_u2f.testing import ALGORITHMS, Latencies, VirtualAuthenticator
+
+from .factories import UserFactory
+
+ORIGIN = 'https://localhost.osso.ninja'
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('algorithm', ALGORITHMS)
+def test_virtual_authenticate(webauthn, algorithm):
+    user = UserFactory()
+    authenticator = VirtualAuthenticator(ORIGIN)
+    credential = authenticator.create_credential(algorithm)
+    device = U2fDevice.objects.create(
+        user=user, **credential.device_kwargs(webauthn.rp_id))
+
+    options, state = webauthn.authenticate_begin(user)
+    response = authenticator.authenticate(options)
+    result, authenticator_data = webauthn.authenticate_complete(
+        state, response, user)
+    assert result.credential_id == device.credential_id
+    assert authenticator_data.counter == 1
+
+    # The signature is bound to the challenge.
+    options, state = webauthn.authenticate_begin(user)
+    with pytest.raises(ValueError):
+        webauthn.authenticate_complete(state, response, user)
+    response = authenticator.authenticate(options)
+    signature = response['signature']
+    response['signature'] = (
+        signature[:10] + bytes([signature[10] ^ 1]) + signature[11:])
+    with pytest.raises(ValueError):
+        webauthn.authenticate_complete(state, response, user)
+
+
+@pytest.mark.django_db()
+@pytest.mark.parametrize('algorithm', ['ES256', 'EdDSA', 'RS256'])
+def test_virtual_register(webauthn, algorithm):
+    user = UserFactory()
+    authenticator = VirtualAuthenticator(ORIGIN)
+    options, state = webauthn.register_begin(user)
+    auth_data = webauthn.register_complete(
+        state, authenticator.register(options, algorithm))
+    credential = authenticator.credentials[
+        auth_data.credential_data.credential_id]
+    assert auth_data.credential_data.public_key == credential.cose_key
+
+    with pytest.raises(ValueError):
+        authenticator.register(options, 'U2F_V2')
+
+
+@pytest.mark.django_db()
+def test_virtual_verify_token(webauthn):
+    user = UserFactory()
+    authenticator = VirtualAuthenticator(ORIGIN)
+    device = U2fDevice.objects.create(
+        user=user,
+        **authenticator.create_credential().device_kwargs(webauthn.rp_id))
+
+    options = device.generate_challenge()
+    token = authenticator.token(authenticator.authenticate(options))
+    assert device.verify_token(token)
+    assert device.counter == 1
+    assert not device.verify_token(token)
+
+
+def test_latencies():
+    latencies = Latencies()
+    assert latencies.summary()['p99'] == 0.0
+    for ms in range(1, 101):
+        latencies.add(ms / 1000)
+    summary = latencies.summary(duration=2)
+    assert summary['count'] == 100
+    assert summary['ops'] == 50
+    assert summary['p50'] == pytest.approx(50)
+    assert summary['p95'] == pytest.approx(95)
+    assert summary['p99'] == pytest.approx(99)
+    assert summary['max'] == pytest.approx(100)
@@ -0,0 +1,53 @@
+from django.core.cache import cache
+
+import pytest
+
+from otp_u2f import tokens
+
+from .factories import UserFactory
+
+STATE = {'challenge': 'abc', 'user_verification': 'discouraged'}
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+    yield
+    cache.clear()
+
+
+@pytest.mark.django_db()
+def test_tokens():
+    user = UserFactory()
+    token = tokens.dumps(STATE, 'authenticate', user)
+    assert tokens.loads(token, 'authenticate', user) == STATE
+    with pytest.raises(tokens.InvalidToken, match='Token already used'):
+        tokens.loads(token, 'authenticate', user)
+
+
+@pytest.mark.django_db()
+def test_tokens_invalid(settings):
+    user = UserFactory()
+    token = tokens.dumps(STATE, 'authenticate', user)
+    with pytest.raises(tokens.InvalidToken, match='Invalid token'):
+        tokens.loads(token, 'register', user)
+    with pytest.raises(tokens.InvalidToken, match='Invalid token'):
+        tokens.loads(token, 'authenticate', UserFactory())
+    with pytest.raises(tokens.InvalidToken, match='Invalid token'):
+        tokens.loads(token[:-4], 'authenticate', user)
+    with pytest.raises(tokens.InvalidToken, match='Malformed token'):
+        tokens.loads('a', 'authenticate', user)
+
+    settings.OTP_U2F_CHALLENGE_TIMEOUT = -1
+    token = tokens.dumps(STATE, 'authenticate', user)
+    with pytest.raises(tokens.InvalidToken, match='Expired token'):
+        tokens.loads(token, 'authenticate', user)
+
+
+@pytest.mark.django_db()
+def test_tokens_secret_key_fallbacks(settings):
+    user = UserFactory()
+    token = tokens.dumps(STATE, 'authenticate', user)
+    settings.SECRET_KEY_FALLBACKS = [settings.SECRET_KEY]
+    settings.SECRET_KEY = 'new secret key'
+    assert tokens.loads(token, 'authenticate', user) == STATE
@@ -0,0 +1,77 @@
+from contextlib import nullcontext
+import logging
+
+from django.http import HttpResponse
+
+from asgiref.sync import async_to_sync, sync_to_async
+import pytest
+
+from otp_u2f import tracing
+from otp_u2f.middleware import ServerTimingMiddleware
+from otp_u2f.models import U2fDevice
+from otp_u2f.testing import VirtualAuthenticator
+
+from .factories import UserFactory
+
+spans = []
+
+
+def record_span(name):
+    spans.append(name)
+    return nullcontext()
+
+
+@pytest.fixture
+def login(webauthn):
+    authenticator = VirtualAuthenticator('https://localhost.osso.ninja')
+    device = U2fDevice.objects.create(
+        user=UserFactory(),
+        **authenticator.create_credential().device_kwargs(webauthn.rp_id))
+
+    def login():
+        options = device.generate_challenge()
+        assert device.verify_token(
+            authenticator.token(authenticator.authenticate(options)))
+        response = HttpResponse()
+        response['Server-Timing'] = 'db;dur=1'
+        return response
+    return login
+
+
+def get_timing_names(response):
+    return [
+        timing.split(';')[0]
+        for timing in response['Server-Timing'].split(', ')]
+
+
+@pytest.mark.django_db()
+def test_server_timing_middleware(rfactory, login, settings, caplog):
+    settings.OTP_U2F_TRACE_HOOK = 'tests.test_tracing.record_span'
+    spans.clear()
+    middleware = ServerTimingMiddleware(lambda request: login())
+    with caplog.at_level(logging.DEBUG, logger='otp_u2f.tracing'):
+        response = middleware(rfactory.get('/'))
+
+    names = [
+        tracing.CHALLENGE, tracing.CHALLENGE_SET, tracing.DECODE,
+        tracing.CHALLENGE_GET, tracing.SIGNATURE, tracing.COUNTER]
+    assert get_timing_names(response) == ['db'] + names
+    assert spans == names
+    assert [record.otp_u2f_span for record in caplog.records] == names
+
+
+@pytest.mark.django_db(transaction=True)
+def test_server_timing_middleware_async(rfactory, login):
+    async def view(request):
+        return await sync_to_async(login)()
+
+    response = async_to_sync(ServerTimingMiddleware(view))(rfactory.get('/'))
+    assert tracing.SIGNATURE in get_timing_names(response)
+
+
+@pytest.mark.django_db()
+def test_spans_without_middleware(login):
+    # Spans are only recorded within the middleware.
+    login()
+    token = tracing.start()
+    assert tracing.stop(token) == []
@@ -0,0 +1,122 @@
+import json
+
+from django.core.management import call_command
+
+import pytest
+
+from otp_u2f.models import U2fDevice
+
+from .factories import U2fDeviceFactory, UserFactory
+
+
+def export(tmp_path, **kwargs):
+    path = tmp_path / 'devices.jsonl'
+    call_command('u2f_export', output=str(path), verbosity=0, **kwargs)
+    return path
+
+
+@pytest.mark.django_db
+def test_export(tmp_path):
+    devices = U2fDeviceFactory.create_batch(3, counter=7)
+    path = export(tmp_path, batch_size=2)
+    rows = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [row['user'] for row in rows] == [
+        [device.user.username] for device in devices]
+    assert rows[0] == {
+        'user': [devices[0].user.username],
+        'name': devices[0].name,
+        'confirmed': True,
+        'rp_id': devices[0].rp_id,
+        'version': devices[0].version,
+        'aaguid': str(devices[0].aaguid),
+        'credential': devices[0].credential,
+        'public_key': devices[0].public_key,
+        'counter': 7,
+    }
+
+    path = export(tmp_path, after=devices[1].pk)
+    assert len(path.read_text().splitlines()) == 1
+
+
+@pytest.mark.django_db
+def test_import(tmp_path):
+    devices = U2fDeviceFactory.create_batch(3)
+    path = export(tmp_path)
+    U2fDevice.objects.all().delete()
+    # The user of the last device does not exist.
+    devices[-1].user.delete()
+
+    call_command('u2f_import', str(path), batch_size=2, verbosity=0)
+    imported = U2fDevice.objects.order_by('pk')
+    assert [
+        (device.user, device.credential, device.public_key)
+        for device in imported] == [
+        (device.user, device.credential, device.public_key)
+        for device in devices[:2]]
+    assert imported[0].credential_hash == devices[0].credential_hash
+
+    # Existing devices are skipped unless they are updated.
+    U2fDevice.objects.update(counter=5)
+    call_command('u2f_import', str(path), verbosity=0)
+    assert set(U2fDevice.objects.values_list('counter', flat=True)) == {5}
+    U2fDevice.objects.update(name='Renamed')
+    call_command('u2f_import', str(path), update=True, verbosity=0)
+    assert not U2fDevice.objects.filter(name='Renamed').exists()
+    # The counter is never lowered.
+    assert set(U2fDevice.objects.values_list('counter', flat=True)) == {5}
+    assert U2fDevice.objects.count() == 2
+
+
+@pytest.mark.django_db
+def test_import_update(tmp_path, capsys):
+    device, other, enabled, disabled = U2fDeviceFactory.create_batch(
+        4, counter=7)
+    U2fDevice.objects.filter(pk=enabled.pk).update(confirmed=False)
+    path = export(tmp_path)
+    U2fDevice.objects.filter(pk=device.pk).update(counter=3)
+    # The credential of the other device now belongs to another user.
+    owner = UserFactory()
+    U2fDevice.objects.filter(pk=other.pk).update(user=owner, counter=100)
+    # Disabled devices are not enabled again, exported disabled devices are
+    # disabled.
+    U2fDevice.objects.filter(pk=disabled.pk).update(confirmed=False)
+    U2fDevice.objects.filter(pk=enabled.pk).update(confirmed=True)
+
+    call_command('u2f_import', str(path), update=True)
+    for instance in (device, other, enabled, disabled):
+        instance.refresh_from_db()
+    assert (device.counter, device.confirmed) == (7, True)
+    assert (other.user, other.counter) == (owner, 100)
+    assert not enabled.confirmed
+    assert not disabled.confirmed
+    captured = capsys.readouterr()
+    assert 'skipped 0 devices of unknown users and 1 devices of other users' in captured.out  # noqa
+    assert f'Device {other.credential} belongs to another user' in captured.err
+
+
+@pytest.mark.django_db
+def test_import_resume(tmp_path):
+    user = UserFactory()
+    devices = U2fDeviceFactory.create_batch(4, user=user)
+    path = export(tmp_path)
+    U2fDevice.objects.all().delete()
+    lines = path.read_text().splitlines()
+    path.write_text('\n'.join(lines[:3] + ['{"invalid"'] + lines[3:]))
+    checkpoint = tmp_path / 'checkpoint'
+
+    with pytest.raises(Exception, match='Line 4 is invalid'):
+        call_command(
+            'u2f_import', str(path), batch_size=2,
+            checkpoint=str(checkpoint), verbosity=0)
+    # The first batch was committed.
+    assert checkpoint.read_text() == '2'
+    assert U2fDevice.objects.count() == 2
+
+    path.write_text('\n'.join(lines[:3] + [''] + lines[3:]))
+    call_command(
+        'u2f_import', str(path), batch_size=2, checkpoint=str(checkpoint),
+        verbosity=0)
+    assert not checkpoint.exists()
+    imported = U2fDevice.objects.order_by('pk')
+    assert [device.credential for device in imported] == [
+        device.credential for device in devices]
@@ -1,8 +1,15 @@
 from base64 import urlsafe_b64decode, urlsafe_b64encode
+import json
+
+from fido2.utils import websafe_encode
 
 import pytest
 
-from .factories import U2fDeviceFactory
+from otp_u2f.models import U2fDevice
+from otp_u2f.testing import VirtualAuthenticator, encode_json
+from otp_u2f.utils import Webauthn, clear_servers, get_server
+
+from .factories import U2fDeviceFactory, UserFactory
 
 
 def ub64_decode(s):
@@ -60,6 +67,9 @@ def test_webauthn_authenticate_begin(webauthn):
         credential='xQ2Uq68EUbvH_6ITMGcABDdb9N0Pkmf-g8gaU2uOrB33MfvtJBfwf4YJBmml803DbJ_jOtm4omGsNJwo7iRMRg==',  # noqa
         public_key='BHKBOcZ38yDS9eJshaol7Uhbl_YIuLKLATusEtHfZdzTPGCJPaW5Tq1fgYrgi3ddCdUI53BgdzIUNQT__WSYd9I===')  # noqa
 
+    # Devices of other relying parties are not allowed.
+    U2fDeviceFactory(user=device.user, rp_id='example.org')
+
     request, state = webauthn.authenticate_begin(device.user)
     key = request['publicKey']
     assert key['challenge'] == ub64_decode(state['challenge'])
@@ -91,3 +101,61 @@ def test_webauthn_authenticate_complete(webauthn):
     assert webauthn.encode(credential.public_key) == device.public_key
     assert authenticator.rp_id_hash.hex() == '125c8aee6d2b0a9ac7f685de19f5ccb4bcfc2a80cc35bbb128ab9ac5e7bd7551'  # noqa
     assert authenticator.counter == 4
+
+
+def test_webauthn_server_pool(settings, webauthn):
+    settings.OTP_U2F_SERVER_POOL_SIZE = 2
+    clear_servers()
+    server = Webauthn().server
+    assert server is Webauthn().server
+    assert server is get_server(
+        'localhost.osso.ninja', None, 'https://localhost.osso.ninja')
+
+    # The least recently used server is discarded.
+    other = get_server('example.com', 'Example', 'https://example.com')
+    get_server('example.org', 'Example', 'https://example.org')
+    assert Webauthn().server is not server
+    assert get_server(
+        'example.com', 'Example', 'https://example.com') is not other
+
+    server = Webauthn().server
+    clear_servers()
+    assert Webauthn().server is not server
+
+
+@pytest.mark.django_db()
+def test_webauthn_json(webauthn):
+    user = UserFactory()
+    authenticator = VirtualAuthenticator('https://localhost.osso.ninja')
+
+    options, state = webauthn.register_begin(user)
+    key = json.loads(webauthn.encode_json(options))['publicKey']
+    assert key['challenge'] == state['challenge']
+    assert key['user']['id'] == websafe_encode(str(user.pk).encode())
+    assert key['pubKeyCredParams'][0] == {'type': 'public-key', 'alg': -7}
+    response = authenticator.register(options)
+    data = webauthn.decode(encode_json(response) + '===')
+    assert data['attestationObject'] == response['attestationObject']
+    assert data['clientDataJSON'] == response['clientDataJSON']
+    auth_data = webauthn.register_complete(state, data)
+    credential = authenticator.credentials[
+        auth_data.credential_data.credential_id]
+    U2fDevice.objects.create(
+        user=user, **credential.device_kwargs(webauthn.rp_id))
+
+    options, state = webauthn.authenticate_begin(user)
+    key = json.loads(webauthn.encode_json(options))['publicKey']
+    assert key['allowCredentials'] == [
+        {'type': 'public-key', 'id': websafe_encode(credential.credential_id)}]
+    response = authenticator.authenticate(options)
+    assert webauthn.decode(encode_json(response)) == response
+    webauthn.authenticate_complete(
+        state, webauthn.decode(encode_json(response)), user)
+
+    with pytest.raises(ValueError):
+        webauthn.decode('{"response": {}')
+    for data in ('{"response": {}}', '{"rawId": "AA", "response": []}',
+                 '{"rawId": 1, "response": {}}', '{"response": null}',
+                 '{"rawId": "AA", "response": {"signature": {}}}'):
+        with pytest.raises(ValueError):
+            webauthn.decode(data)
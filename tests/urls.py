@@ -0,0 +1,8 @@
+from django.contrib import admin
+from django.urls import include, path
+
+urlpatterns = [
+    path('admin/', admin.site.urls),
+    path('mfa/', include('kleides_mfa.urls')),
+    path('u2f/', include('otp_u2f.urls')),
+]